@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at deca@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+
+''' landmarks and segmentation masks of the training images in a few memory-mapped files
+    names.txt           image path per row
+    landmarks.npy       float32 [N, 68, 2]
+    masks.bin           bit-packed binary masks (vis_parsing_anno > 0.5), concatenated
+    mask_offsets.npy    int64 [N, 3], byte offset, height, width of each mask; height 0 if the image has no mask
+datasets then read a row instead of opening two .npy files per image, and masks take 1 bit instead of 32 per pixel.
+'''
+import os, sys
+import numpy as np
+
+class AnnotationIndex(object):
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, 'names.txt')) as f:
+            self.ids = {name: i for i, name in enumerate(f.read().splitlines())}
+        self.kpts = np.load(os.path.join(index_dir, 'landmarks.npy'), mmap_mode='r')
+        self.mask_offsets = np.load(os.path.join(index_dir, 'mask_offsets.npy'))
+        self.mask_bits = np.memmap(os.path.join(index_dir, 'masks.bin'), dtype=np.uint8, mode='r')
+
+    def __contains__(self, image_path):
+        return image_path in self.ids
+
+    def landmarks(self, image_path):
+        '''
+        image_path: must be in the index (image_path in index), datasets fall back to the .npy files otherwise
+        return: float32 [68, 2]
+        '''
+        return np.array(self.kpts[self.ids[image_path]])
+
+    def mask(self, image_path, h, w):
+        '''
+        return: binary mask, [h, w] of the segmentation, all ones ([h, w]) if the image has no segmentation
+        '''
+        offset, mh, mw = self.mask_offsets[self.ids[image_path]]
+        if mh == 0:
+            return np.ones((h, w))
+        bits = self.mask_bits[offset:offset + (mh*mw + 7)//8]
+        return np.unpackbits(bits, count=mh*mw).reshape(mh, mw).astype(np.float32)
+
+def build_annotation_index(datasets, output_dir):
+    '''
+    datasets: list of datasets with group_paths(idx)
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {}
+    for dataset in datasets:
+        for idx in range(len(dataset)):
+            for image_path, kpt_path, seg_path in dataset.group_paths(idx):
+                paths[image_path] = (kpt_path, seg_path)
+    names = list(paths.keys())
+    kpts = np.lib.format.open_memmap(os.path.join(output_dir, 'landmarks.npy'), mode='w+', dtype=np.float32, shape=(len(names), 68, 2))
+    mask_offsets = np.zeros([len(names), 3], dtype=np.int64)
+    offset = 0
+    with open(os.path.join(output_dir, 'masks.bin'), 'wb') as f:
+        for i, image_path in enumerate(names):
+            kpt_path, seg_path = paths[image_path]
+            if not os.path.isfile(kpt_path):
+                raise FileNotFoundError(f'no landmarks for {image_path}: {kpt_path}')
+            kpts[i] = np.load(kpt_path)[:,:2]
+            if os.path.isfile(seg_path):
+                mask = np.load(seg_path) > 0.5
+                bits = np.packbits(mask.reshape(-1))
+                f.write(bits.tobytes())
+                mask_offsets[i] = [offset, mask.shape[0], mask.shape[1]]
+                offset += len(bits)
+    kpts.flush()
+    np.save(os.path.join(output_dir, 'mask_offsets.npy'), mask_offsets)
+    with open(os.path.join(output_dir, 'names.txt'), 'w') as f:
+        f.write('\n'.join(names))
+    return len(names)
+
+if __name__ == '__main__':
+    # python -m decalib.datasets.annotation_index --cfg configs/release_version/deca_coarse.yml --output /path/to/index
+    import argparse
+    from ..utils.config import get_cfg_defaults, update_cfg
+    from . import build_datasets
+    parser = argparse.ArgumentParser(description='DECA: build the memory-mapped landmark and mask index')
+    parser.add_argument('--cfg', type=str, default=None, help='cfg file path, the datasets in dataset.training_data are indexed')
+    parser.add_argument('--output', type=str, required=True, help='output folder of the index')
+    args = parser.parse_args()
+
+    cfg = get_cfg_defaults()
+    if args.cfg is not None:
+        cfg = update_cfg(cfg, args.cfg)
+    cfg.dataset.shard_dir = ''
+    cfg.dataset.annotation_index = ''
+    datasets = build_datasets.build_train(cfg.dataset).datasets
+    datasets += build_datasets.build_val(cfg.dataset).datasets
+    n = build_annotation_index([dataset for dataset in datasets if hasattr(dataset, 'group_paths')], args.output)
+    print(f'indexed landmarks and masks of {n} images in {args.output}')
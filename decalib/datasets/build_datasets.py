@@ -9,22 +9,33 @@ from skimage.io import imread, imsave
 from skimage.transform import estimate_transform, warp, resize, rescale
 from glob import glob
 
-from .vggface import VGGFace2Dataset
+from .vggface import VGGFace2Dataset, VGGFace2HQDataset
 from .ethnicity import EthnicityDataset
 from .aflw2000 import AFLW2000
 from .now import NoWDataset
 from .vox import VoxelDataset
+from .train_datasets import COCODataset, CelebAHQDataset
+from .shards import ShardedFaceDataset
+from .annotation_index import AnnotationIndex
 
 def build_train(config, is_train=True):
+    if config.shard_dir:
+        # training_data packed with python -m decalib.datasets.shards
+        return ShardedFaceDataset(config.shard_dir, K=config.K, image_size=config.image_size, scale=[config.scale_min, config.scale_max], trans_scale=config.trans_scale, isSingle=config.isSingle, crop_on_device=config.crop_on_device)
+    if config.crop_on_device and ('coco' in config.training_data or 'celebahq' in config.training_data):
+        # their samples have no landmark box (bbox) to crop on device, they can not be batched with the others
+        raise ValueError('coco and celebahq do not support dataset.crop_on_device, set it to False')
+    # one memory-mapped landmark/mask index shared by all datasets (python -m decalib.datasets.annotation_index)
+    annotations = AnnotationIndex(config.annotation_index) if config.annotation_index else None
     data_list = []
     if 'vox2' in config.training_data:
-        data_list.append(VoxelDataset(dataname='vox2', K=config.K, image_size=config.image_size, scale=[config.scale_min, config.scale_max], trans_scale=config.trans_scale, isSingle=config.isSingle))
+        data_list.append(VoxelDataset(dataname='vox2', K=config.K, image_size=config.image_size, scale=[config.scale_min, config.scale_max], trans_scale=config.trans_scale, isSingle=config.isSingle, annotations=annotations, crop_on_device=config.crop_on_device))
     if 'vggface2' in config.training_data:
-        data_list.append(VGGFace2Dataset(K=config.K, image_size=config.image_size, scale=[config.scale_min, config.scale_max], trans_scale=config.trans_scale, isSingle=config.isSingle))
+        data_list.append(VGGFace2Dataset(K=config.K, image_size=config.image_size, scale=[config.scale_min, config.scale_max], trans_scale=config.trans_scale, isSingle=config.isSingle, annotations=annotations, crop_on_device=config.crop_on_device))
     if 'vggface2hq' in config.training_data:
-        data_list.append(VGGFace2HQDataset(K=config.K, image_size=config.image_size, scale=[config.scale_min, config.scale_max], trans_scale=config.trans_scale, isSingle=config.isSingle))
+        data_list.append(VGGFace2HQDataset(K=config.K, image_size=config.image_size, scale=[config.scale_min, config.scale_max], trans_scale=config.trans_scale, isSingle=config.isSingle, annotations=annotations, crop_on_device=config.crop_on_device))
     if 'ethnicity' in config.training_data:
-        data_list.append(EthnicityDataset(K=config.K, image_size=config.image_size, scale=[config.scale_min, config.scale_max], trans_scale=config.trans_scale, isSingle=config.isSingle))
+        data_list.append(EthnicityDataset(K=config.K, image_size=config.image_size, scale=[config.scale_min, config.scale_max], trans_scale=config.trans_scale, isSingle=config.isSingle, annotations=annotations, crop_on_device=config.crop_on_device))
     if 'coco' in config.training_data:
         data_list.append(COCODataset(image_size=config.image_size, scale=[config.scale_min, config.scale_max], trans_scale=config.trans_scale))
     if 'celebahq' in config.training_data:
@@ -34,9 +45,10 @@ def build_train(config, is_train=True):
     return dataset
 
 def build_val(config, is_train=True):
+    annotations = AnnotationIndex(config.annotation_index) if config.annotation_index else None
     data_list = []
     if 'vggface2' in config.eval_data:
-        data_list.append(VGGFace2Dataset(isEval=True, K=config.K, image_size=config.image_size, scale=[config.scale_min, config.scale_max], trans_scale=config.trans_scale, isSingle=config.isSingle))
+        data_list.append(VGGFace2Dataset(isEval=True, K=config.K, image_size=config.image_size, scale=[config.scale_min, config.scale_max], trans_scale=config.trans_scale, isSingle=config.isSingle, annotations=annotations))
     if 'now' in config.eval_data:
         data_list.append(NoWDataset())
     if 'aflw2000' in config.eval_data:
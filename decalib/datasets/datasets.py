@@ -15,6 +15,7 @@
 
 import os, sys
 import torch
+import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader
 import torchvision.transforms as transforms
 import numpy as np
@@ -26,6 +27,9 @@ from glob import glob
 import scipy.io
 
 from . import detectors
+from .detection_cache import DetectionCache, image_hash
+from .image_io import read_image
+from ..utils.tensor_cropper import crop_tensor
 
 def video2sequence(video_path, sample_step=10):
     videofolder = os.path.splitext(video_path)[0]
@@ -45,10 +49,22 @@ def video2sequence(video_path, sample_step=10):
     print('video frames are stored in {}'.format(videofolder))
     return imagepath_list
 
+def imread_rgb(imagepath):
+    ''' uint8 rgb [h, w, 3] at full resolution
+    '''
+    return read_image(imagepath)[0]
+
 class TestData(Dataset):
-    def __init__(self, testpath, iscrop=True, crop_size=224, scale=1.25, face_detector='fan', sample_step=10):
+    def __init__(self, testpath, iscrop=True, crop_size=224, scale=1.25, face_detector='fan', sample_step=10, max_original_size=0,
+                 detect_batch_size=8, detect_size=640, detection_cache=None, multi_face=False):
         '''
             testpath: folder, imagepath_list, image path, video path
+            max_original_size: longer side of the image returned by load_original, 0 to keep the full resolution
+            detect_batch_size: number of images (or video frames) the face detector runs on at once
+            detect_size: detection resolution of the batched images
+            detection_cache: path to a sqlite file keeping detected boxes by image content, None to always detect
+            multi_face: one sample per detected face (named imagename_face{k}) instead of one per image,
+                all images are detected when the dataset is built to know the number of samples
         '''
         if isinstance(testpath, list):
             self.imagepath_list = testpath
@@ -67,16 +83,44 @@ class TestData(Dataset):
         self.scale = scale
         self.iscrop = iscrop
         self.resolution_inp = crop_size
-        if face_detector == 'fan':
-            self.face_detector = detectors.FAN()
-        # elif face_detector == 'mtcnn':
-        #     self.face_detector = detectors.MTCNN()
+        self.max_original_size = max_original_size
+        if face_detector in detectors.DETECTORS:
+            self.face_detector = detectors.build_detector(face_detector)
         else:
-            print(f'please check the detector: {face_detector}')
+            print(f'please check the detector: {face_detector}, available: {sorted(detectors.DETECTORS.keys())}')
             exit()
+        self.detector_batcher = detectors.DetectorBatcher(self.face_detector, batch_size=detect_batch_size, det_size=detect_size)
+        self.detected = {}
+        self.num_detected = 0
+        self.multi_face = multi_face
+        if detection_cache is not None:
+            self.detection_cache = DetectionCache(detection_cache, detector=f'{face_detector}_{detect_size}' + ('_multi' if multi_face else ''))
+        else:
+            self.detection_cache = None
+        # (image index, face index, box, box type) per sample
+        self.samples = [(index, None, None, None) for index in range(len(self.imagepath_list))]
+        if self.multi_face and self.iscrop:
+            self.samples = []
+            for index, imagepath in enumerate(self.imagepath_list):
+                if self.has_kpt(imagepath):
+                    self.samples.append((index, None, None, None))
+                    continue
+                boxes, bbox_type, _ = self.detect(index)
+                if len(boxes) == 0:
+                    self.samples.append((index, None, [0], bbox_type))
+                else:
+                    self.samples += [(index, k, box, bbox_type) for k, box in enumerate(boxes)]
 
     def __len__(self):
-        return len(self.imagepath_list)
+        return len(self.samples)
+
+    def image_groups(self):
+        ''' sample indices grouped by image, the faces of one image can go through DECA as one batch
+        '''
+        groups = {}
+        for i, sample in enumerate(self.samples):
+            groups.setdefault(sample[0], []).append(i)
+        return list(groups.values())
 
     def bbox2point(self, left, right, top, bottom, type='bbox'):
         ''' bbox from detector and landmarks are different
@@ -91,16 +135,58 @@ class TestData(Dataset):
             raise NotImplementedError
         return old_size, center
 
+    def has_kpt(self, imagepath):
+        return os.path.exists(os.path.splitext(imagepath)[0]+'.mat') or os.path.exists(os.path.splitext(imagepath)[0]+'.txt')
+
+    def detect(self, index):
+        ''' boxes are detected for the following detect_batch_size images at once and kept until they are requested,
+        images found in the detection cache skip the detector
+        return: boxes, bbox type, the full resolution image when it was decoded for the detector (else None)
+        '''
+        if index not in self.detected:
+            # only the images of the latest detector batch are kept, with several dataloader workers the
+            # look-ahead also detects images that another worker will load
+            self.detected = {i: (boxes, types, None) for i, (boxes, types, _) in self.detected.items()}
+            indices = [index] + [i for i in range(index+1, min(index + self.detector_batcher.batch_size, len(self.imagepath_list)))
+                                 if i not in self.detected and not self.has_kpt(self.imagepath_list[i])]
+            todo = indices
+            if self.detection_cache is not None:
+                keys = {i: image_hash(np.fromfile(self.imagepath_list[i], dtype=np.uint8)) for i in indices}
+                cached = self.detection_cache.get_many(list(set(keys.values())))
+                self.detected.update({i: cached[keys[i]] + (None,) for i in indices if keys[i] in cached})
+                todo = [i for i in indices if i not in self.detected]
+            if len(todo) > 0:
+                images = [imread_rgb(self.imagepath_list[i]) for i in todo]
+                boxes, types = self.detector_batcher.run(images, multi_face=self.multi_face)
+                # the decoded images are kept with the boxes, __getitem__ does not decode them again
+                self.detected.update(zip(todo, zip(boxes, types, images)))
+                self.num_detected += len(todo)
+                if self.detection_cache is not None:
+                    self.detection_cache.put_many([keys[i] for i in todo], boxes, types)
+        return self.detected.pop(index)
+
+    def prewarm(self):
+        ''' run the detector over all images without kpt files to fill the detection cache
+        return: number of images that were not cached yet
+        '''
+        num_detected = self.num_detected
+        for index in range(len(self.imagepath_list)):
+            if index not in self.detected and not self.has_kpt(self.imagepath_list[index]):
+                self.detect(index)
+        self.detected = {}
+        return self.num_detected - num_detected
+
     def __getitem__(self, index):
-        imagepath = self.imagepath_list[index]
+        ''' decode and locate the face only, cropping is done batched on device with crop()
+        '''
+        image_index, face_index, bbox, bbox_type = self.samples[index]
+        imagepath = self.imagepath_list[image_index]
         imagename = os.path.splitext(os.path.split(imagepath)[-1])[0]
-        image = np.array(imread(imagepath))
-        if len(image.shape) == 2:
-            image = image[:,:,None].repeat(1,1,3)
-        if len(image.shape) == 3 and image.shape[2] > 3:
-            image = image[:,:,:3]
-
-        h, w, _ = image.shape
+        if face_index is not None:
+            imagename = f'{imagename}_face{face_index:02d}'
+        # the crop box is known before decoding for kpt files and multi_face samples, the image can then be
+        # decoded at the reduced resolution the crop allows
+        image = None
         if self.iscrop:
             # provide kpt as txt file, or mat file (for AFLW2000)
             kpt_matpath = os.path.splitext(imagepath)[0]+'.mat'
@@ -116,28 +202,77 @@ class TestData(Dataset):
                 top = np.min(kpt[:,1]); bottom = np.max(kpt[:,1])
                 old_size, center = self.bbox2point(left, right, top, bottom, type='kpt68')
             else:
-                bbox, bbox_type = self.face_detector.run(image)
+                if bbox is None:
+                    bbox, bbox_type, image = self.detect(image_index)
+                    factor = 1
                 if len(bbox) < 4:
                     print('no face detected! run original image')
+                    if image is None:
+                        image, factor = read_image(imagepath)
+                    h, w, _ = image.shape
                     left = 0; right = h-1; top=0; bottom=w-1
                 else:
                     left = bbox[0]; right=bbox[2]
                     top = bbox[1]; bottom=bbox[3]
                 old_size, center = self.bbox2point(left, right, top, bottom, type=bbox_type)
             size = int(old_size*self.scale)
-            src_pts = np.array([[center[0]-size/2, center[1]-size/2], [center[0] - size/2, center[1]+size/2], [center[0]+size/2, center[1]-size/2]])
+            if image is None:
+                image, factor = read_image(imagepath, (self.resolution_inp - 1)/size)
         else:
-            src_pts = np.array([[0, 0], [0, h-1], [w-1, 0]])
-        
-        DST_PTS = np.array([[0,0], [0,self.resolution_inp - 1], [self.resolution_inp - 1, 0]])
-        tform = estimate_transform('similarity', src_pts, DST_PTS)
-        
-        image = image/255.
+            image, factor = read_image(imagepath)
+            h, w, _ = image.shape
+            center = np.array([(w-1)/2., (h-1)/2.])
+            size = (w-1 + h-1)/2.
 
-        dst_image = warp(image, tform.inverse, output_shape=(self.resolution_inp, self.resolution_inp))
-        dst_image = dst_image.transpose(2,0,1)
-        return {'image': torch.tensor(dst_image).float(),
+        # similarity transform from original image to crop, the square box maps to [0, resolution_inp-1]
+        s = (self.resolution_inp - 1)/size
+        tform = np.array([[s, 0, -s*(center[0]-size/2)], [0, s, -s*(center[1]-size/2)], [0, 0, 1]])
+        # crop box in the decoded image
+        h, w, _ = image.shape
+        center = (center - (factor - 1)/2.)/factor; size = size/factor
+        # only keep the pixels under the crop box (+ a border for bilinear sampling), zero padded like warp_affine,
+        # the full resolution image is never held per sample
+        x0 = int(np.floor(center[0] - size/2)) - 1; x1 = int(np.ceil(center[0] + size/2)) + 2
+        y0 = int(np.floor(center[1] - size/2)) - 1; y1 = int(np.ceil(center[1] + size/2)) + 2
+        region = np.zeros([y1 - y0, x1 - x0, 3], dtype=np.uint8)
+        region[max(-y0, 0):min(h, y1) - y0, max(-x0, 0):min(w, x1) - x0] = image[max(y0, 0):min(h, y1), max(x0, 0):min(w, x1)]
+        return {'image': torch.from_numpy(region.transpose(2,0,1).copy()),
                 'imagename': imagename,
-                'tform': torch.tensor(tform.params).float(),
-                'original_image': torch.tensor(image.transpose(2,0,1)).float(),
-                }
\ No newline at end of file
+                'imagepath': imagepath,
+                'center': torch.tensor(center - np.array([x0, y0])).float(),
+                'size': torch.tensor([size]).float(),
+                'tform': torch.tensor(tform).float(),
+                }
+
+    def crop(self, data, device='cuda'):
+        ''' crop a sample, a collated batch or a list of samples to the network input, on device
+        return: images, [bz, 3, crop_size, crop_size], range 0-1
+        '''
+        if isinstance(data, (list, tuple)):
+            # regions differ in size, zero pad them at the bottom/right (outside every crop box) to crop them at once
+            h = max([sample['image'].shape[-2] for sample in data]); w = max([sample['image'].shape[-1] for sample in data])
+            image = torch.stack([F.pad(sample['image'], (0, w - sample['image'].shape[-1], 0, h - sample['image'].shape[-2])) for sample in data])
+            center = torch.stack([sample['center'] for sample in data]); size = torch.stack([sample['size'] for sample in data])
+        else:
+            image = data['image']; center = data['center']; size = data['size']
+        if image.ndim == 3:
+            image = image[None]; center = center[None]; size = size[None]
+        image = image.to(device).float()/255.
+        images, _ = crop_tensor(image, center.to(device), size.to(device), self.resolution_inp)
+        return images
+
+    def load_original(self, data):
+        ''' read the original image of a sample (or of a list of samples from one image) only when it is needed,
+        e.g. render_orig, downscaled so that its longer side is at most max_original_size
+        return: original_image, uint8 [3, h, w]; tform, original image to crop, [3, 3] ([n, 3, 3] for a list)
+        '''
+        samples = data if isinstance(data, (list, tuple)) else [data]
+        image = imread_rgb(samples[0]['imagepath'])
+        tform = torch.stack([sample['tform'] for sample in samples]).numpy()
+        h, w, _ = image.shape
+        if self.max_original_size > 0 and max(h, w) > self.max_original_size:
+            factor = self.max_original_size/max(h, w)
+            image = cv2.resize(image, (int(round(w*factor)), int(round(h*factor))), interpolation=cv2.INTER_AREA)
+            tform = np.matmul(tform, np.diag([1./factor, 1./factor, 1.]))
+        tform = torch.tensor(tform).float()
+        return torch.from_numpy(image.transpose(2,0,1).copy()), tform if samples is data else tform[0]
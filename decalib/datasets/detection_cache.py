@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at deca@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+
+import os, sys
+import json
+import hashlib
+import sqlite3
+import argparse
+
+def image_hash(buf):
+    ''' content hash of the encoded image file, renamed or copied images share their detections
+    '''
+    return hashlib.sha1(buf.tobytes()).hexdigest()
+
+class DetectionCache(object):
+    def __init__(self, db_path, detector='fan'):
+        '''
+        on-disk detection results, content hash of the image -> detected box and box type
+        detector: name of the backend (and its settings), results of different detectors are kept apart
+        the crop (center, size, tform) is derived from the box, so crop_size/scale can change without invalidating it
+        '''
+        self.db_path = db_path
+        self.detector = detector
+        self.conn = None
+        self.pid = None
+
+    def connect(self):
+        # one connection per process, dataloader workers are forked after construction
+        if self.conn is None or self.pid != os.getpid():
+            folder = os.path.dirname(os.path.abspath(self.db_path))
+            os.makedirs(folder, exist_ok=True)
+            self.conn = sqlite3.connect(self.db_path, timeout=60)
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS detections (
+                    hash TEXT NOT NULL,
+                    detector TEXT NOT NULL,
+                    bbox TEXT NOT NULL,
+                    bbox_type TEXT NOT NULL,
+                    PRIMARY KEY (hash, detector)
+                )
+            ''')
+            self.conn.commit()
+            self.pid = os.getpid()
+        return self.conn
+
+    def get_many(self, keys):
+        '''
+        return: dict, hash -> (bbox, bbox_type) for the keys that are cached
+        '''
+        conn = self.connect()
+        out = {}
+        # sqlite limits the number of bound parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            rows = conn.execute('SELECT hash, bbox, bbox_type FROM detections WHERE detector=? AND hash IN ({})'.format(','.join('?'*len(chunk))),
+                                [self.detector] + list(chunk)).fetchall()
+            for key, bbox, bbox_type in rows:
+                out[key] = (json.loads(bbox), bbox_type)
+        return out
+
+    def put_many(self, keys, boxes, types):
+        conn = self.connect()
+        # a box, or the list of boxes of all faces, numpy scalars are stored as float
+        rows = [(key, self.detector, json.dumps(bbox, default=float), bbox_type) for key, bbox, bbox_type in zip(keys, boxes, types)]
+        conn.executemany('INSERT OR REPLACE INTO detections (hash, detector, bbox, bbox_type) VALUES (?, ?, ?, ?)', rows)
+        conn.commit()
+
+    def __len__(self):
+        return self.connect().execute('SELECT COUNT(*) FROM detections WHERE detector=?', (self.detector,)).fetchone()[0]
+
+if __name__ == '__main__':
+    # prewarm the cache, e.g. python -m decalib.datasets.detection_cache -i TestSamples/examples --cache data/detections.db
+    from .datasets import TestData
+    parser = argparse.ArgumentParser(description='DECA: detection cache prewarming')
+    parser.add_argument('-i', '--inputpath', default='TestSamples/examples', type=str,
+                        help='path to the test data, can be image folder, image path, image list, video')
+    parser.add_argument('--cache', default='data/detections.db', type=str,
+                        help='path to the sqlite detection cache' )
+    parser.add_argument('--detector', default='fan', type=str,
+                        help='detector for cropping face, check decalib/detectors.py for details' )
+    parser.add_argument('--detect_batch_size', default=8, type=int,
+                        help='number of images or video frames the face detector runs on at once' )
+    parser.add_argument('--sample_step', default=10, type=int,
+                        help='sample images from video data for every step' )
+    parser.add_argument('--multi_face', default=False, type=lambda x: x.lower() in ['true', '1'],
+                        help='cache all faces of each image, for TestData(multi_face=True)' )
+    args = parser.parse_args()
+    testdata = TestData(args.inputpath, face_detector=args.detector, sample_step=args.sample_step,
+                        detect_batch_size=args.detect_batch_size, detection_cache=args.cache, multi_face=args.multi_face)
+    # multi_face datasets already detect when they are built
+    testdata.prewarm()
+    print(f'detected {testdata.num_detected} of {len(testdata.imagepath_list)} images, {len(testdata.detection_cache)} entries in {args.cache}')
@@ -13,13 +13,71 @@
 # For comments or questions, please email us at deca@tue.mpg.de
 # For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
 
+from abc import ABC, abstractmethod
 import numpy as np
 import torch
+import cv2
 
-class FAN(object):
-    def __init__(self):
+DETECTORS = {}
+
+def register(name, **defaults):
+    def wrapper(cls):
+        DETECTORS[name] = (cls, defaults)
+        return cls
+    return wrapper
+
+def build_detector(name, **kwargs):
+    ''' detector backends by name, check DETECTORS for the available ones
+    '''
+    if name not in DETECTORS:
+        raise ValueError(f'unknown face detector: {name}, available: {sorted(DETECTORS.keys())}')
+    cls, defaults = DETECTORS[name]
+    return cls(**dict(defaults, **kwargs))
+
+def largest_box(boxes):
+    ''' boxes: [n, >=4], left, top, right, bottom (score)
+    '''
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(len(boxes), -1)
+    areas = (boxes[:,2] - boxes[:,0])*(boxes[:,3] - boxes[:,1])
+    return [float(c) for c in boxes[np.argmax(areas), :4]]
+
+def select_boxes(faces, multi_face=False):
+    ''' faces: [n, >=4] detections in one image
+    return: the largest box ([0] if there is none), or the list of all boxes if multi_face
+    '''
+    if multi_face:
+        return [[float(c) for c in face[:4]] for face in faces]
+    return largest_box(faces) if len(faces) > 0 else [0]
+
+class Detector(ABC):
+    ''' all backends implement run_batch(images, multi_face=False) -> boxes, types,
+    a box is [left, top, right, bottom] or [0] if no face is found, the type selects the crop rule in bbox2point.
+    with multi_face, each image gets the list of all its boxes instead (empty if no face is found)
+    '''
+    def run(self, image):
+        '''
+        image: 0-255, uint8, rgb, [h, w, 3]
+        return: detected box, box type
+        '''
+        boxes, types = self.run_batch([image])
+        return boxes[0], types[0]
+
+    @abstractmethod
+    def run_batch(self, images, multi_face=False):
+        '''
+        images: 0-255, uint8, rgb, [bz, h, w, 3]
+        return: detected box list and box type per image
+        '''
+
+@register('fan')
+class FAN(Detector):
+    def __init__(self, device=None):
+        '''
+        68 landmarks (s3fd + landmark network), the box is taken from the landmarks
+        '''
         import face_alignment
-        self.model = face_alignment.FaceAlignment(face_alignment.LandmarksType.TWO_D, flip_input=False)             # face-alignment 更新
+        device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.model = face_alignment.FaceAlignment(face_alignment.LandmarksType.TWO_D, flip_input=False, device=device)             # face-alignment 更新
 
     def run(self, image):
         '''
@@ -36,25 +94,152 @@ class FAN(object):
             bbox = [left,top, right, bottom]
             return bbox, 'kpt68'
 
-class MTCNN(object):
-    def __init__(self, device = 'cpu'):
+    @torch.no_grad()
+    def run_batch(self, images, multi_face=False):
+        '''
+        images: 0-255, uint8, rgb, [bz, h, w, 3] or list of [h, w, 3] with the same size
+        return: detected box list and box type per image
+        '''
+        batch = torch.from_numpy(np.ascontiguousarray(np.stack(images).transpose(0,3,1,2))).float().to(self.model.device)
+        out = self.model.get_landmarks_from_batch(batch)
+        boxes = []
+        for kpt in out:
+            if kpt is None or len(kpt) == 0:
+                boxes.append([] if multi_face else [0])
+                continue
+            # landmarks of all faces are concatenated
+            kpt = np.asarray(kpt).reshape(-1, 68, 2)
+            faces = np.concatenate([kpt.min(1), kpt.max(1)], axis=1)
+            # keep the first face as run() does
+            boxes.append(select_boxes(faces, multi_face) if multi_face else [float(c) for c in faces[0]])
+        return boxes, ['kpt68']*len(boxes)
+
+@register('sfd', detector='sfd')
+@register('blazeface', detector='blazeface')
+class FaceBox(Detector):
+    def __init__(self, detector='blazeface', device=None):
+        '''
+        box only detectors of face_alignment, no landmark network.
+        blazeface runs at 128/256 px and is the fastest, sfd is the detector used inside FAN
+        '''
+        import importlib
+        device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = device
+        self.model = importlib.import_module(f'face_alignment.detection.{detector}').FaceDetector(device=device)
+
+    @torch.no_grad()
+    def run_batch(self, images, multi_face=False):
+        batch = torch.from_numpy(np.ascontiguousarray(np.stack(images).transpose(0,3,1,2))).float().to(self.device)
+        out = self.model.detect_from_batch(batch)
+        boxes = [select_boxes(faces if faces is not None else [], multi_face) for faces in out]
+        return boxes, ['bbox']*len(boxes)
+
+@register('mtcnn')
+class MTCNN(Detector):
+    def __init__(self, device=None):
         '''
         https://github.com/timesler/facenet-pytorch/blob/master/examples/infer.ipynb
         '''
         from facenet_pytorch import MTCNN as mtcnn
-        self.device = device
-        self.model = mtcnn(keep_all=True)
-    def run(self, input):
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.model = mtcnn(keep_all=True, device=self.device)
+
+    def run_batch(self, images, multi_face=False):
+        # facenet_pytorch detects a batch of equally sized images at once
+        out, probs = self.model.detect(np.stack(images))
+        boxes = []
+        for bbox, prob in zip(out, probs):
+            if bbox is None or len(bbox) == 0:
+                boxes.append([] if multi_face else [0])
+            elif multi_face:
+                boxes.append(select_boxes(bbox, multi_face))
+            else:
+                boxes.append([float(c) for c in bbox[np.argmax(prob)]])
+        return boxes, ['bbox']*len(boxes)
+
+@register('haar')
+class Haar(Detector):
+    def __init__(self, model_path=None):
         '''
-        image: 0-255, uint8, rgb, [h, w, 3]
-        return: detected box
+        opencv haar cascade, as in Software/camera.py, cpu only
         '''
-        out = self.model.detect(input[None,...])
-        if out[0][0] is None:
-            return [0]
-        else:
-            bbox = out[0][0].squeeze()
-            return bbox, 'bbox'
+        model_path = model_path or cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+        self.model = cv2.CascadeClassifier(model_path)
 
+    def run_batch(self, images, multi_face=False):
+        boxes = []
+        for image in images:
+            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+            faces = self.model.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+            # x, y, w, h -> left, top, right, bottom
+            faces = np.asarray(faces, dtype=np.float32).reshape(-1, 4)
+            faces[:,2:] += faces[:,:2]
+            boxes.append(select_boxes(faces, multi_face))
+        return boxes, ['bbox']*len(boxes)
 
+@register('opencv_dnn')
+class OpenCVDNN(Detector):
+    def __init__(self, prototxt='data/deploy.prototxt', model_path='data/res10_300x300_ssd_iter_140000.caffemodel', threshold=0.5):
+        '''
+        opencv res10 ssd face detector (caffe), the whole batch goes through the network in one blob
+        https://github.com/opencv/opencv/tree/master/samples/dnn/face_detector
+        '''
+        self.model = cv2.dnn.readNetFromCaffe(prototxt, model_path)
+        self.threshold = threshold
+
+    def run_batch(self, images, multi_face=False):
+        h, w, _ = images[0].shape
+        blob = cv2.dnn.blobFromImages([image[:,:,::-1] for image in images], 1.0, (300, 300), (104., 177., 123.), swapRB=False, crop=False)
+        self.model.setInput(blob)
+        # [1, 1, n, 7]: image id, label, confidence, left, top, right, bottom (normalized)
+        out = self.model.forward().reshape(-1, 7)
+        out = out[out[:,2] > self.threshold]
+        boxes = []
+        for i in range(len(images)):
+            faces = out[out[:,0] == i, 3:7]*np.array([w, h, w, h])
+            boxes.append(select_boxes(faces, multi_face))
+        return boxes, ['bbox']*len(boxes)
+
+class DetectorBatcher(object):
+    def __init__(self, detector, batch_size=8, det_size=640):
+        '''
+        run a face detector on groups of images instead of one image at a time:
+        images are downscaled to a common detection resolution (longer side at most det_size) and
+        zero padded to det_size x det_size, so one forward pass covers the whole group.
+        detector: a backend or its name in DETECTORS
+        '''
+        if isinstance(detector, str):
+            detector = build_detector(detector)
+        self.detector = detector
+        self.batch_size = batch_size
+        self.det_size = det_size
 
+    def run(self, images, multi_face=False):
+        '''
+        images: list of 0-255, uint8, rgb, [h, w, 3], sizes can differ
+        return: detected box list (list of boxes per image if multi_face) and box type per image,
+            in the coordinates of each input image
+        '''
+        boxes = []; types = []
+        for i in range(0, len(images), self.batch_size):
+            batch_boxes, batch_types = self._run(images[i:i+self.batch_size], multi_face)
+            boxes += batch_boxes; types += batch_types
+        return boxes, types
+
+    def _run(self, images, multi_face=False):
+        batch = np.zeros([len(images), self.det_size, self.det_size, 3], dtype=np.uint8)
+        factors = []
+        for i, image in enumerate(images):
+            h, w, _ = image.shape
+            factor = min(self.det_size/max(h, w), 1.)
+            if factor < 1:
+                image = cv2.resize(image, (max(int(w*factor), 1), max(int(h*factor), 1)), interpolation=cv2.INTER_AREA)
+            batch[i, :image.shape[0], :image.shape[1]] = image
+            factors.append(factor)
+        boxes, types = self.detector.run_batch(batch, multi_face=multi_face)
+        rescale = lambda box, factor: box if len(box) < 4 else [c/factor for c in box]
+        if multi_face:
+            boxes = [[rescale(box, factor) for box in faces] for faces, factor in zip(boxes, factors)]
+        else:
+            boxes = [rescale(box, factor) for box, factor in zip(boxes, factors)]
+        return boxes, types
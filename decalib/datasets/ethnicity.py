@@ -9,8 +9,11 @@ from skimage.transform import estimate_transform, warp, resize, rescale
 from glob import glob
 from torch.utils.data import Dataset, DataLoader, ConcatDataset
 
+from .image_io import read_image, reduced_to_original, loose_size, loose_batch, mask_loader, append_loose_crop
+from .feature_cache import sample_id
+
 class EthnicityDataset(Dataset):
-    def __init__(self, K, image_size, scale, trans_scale = 0, isTemporal=False, isEval=False, isSingle=False):
+    def __init__(self, K, image_size, scale, trans_scale = 0, isTemporal=False, isEval=False, isSingle=False, annotations=None, crop_on_device=False):
         '''
         K must be less than 6
         '''
@@ -30,12 +33,17 @@ class EthnicityDataset(Dataset):
         self.isSingle = isSingle
         if isSingle:
             self.K = 1
+        # AnnotationIndex with the landmarks and masks of all images, None to read the .npy files
+        self.annotations = annotations
+        # return uint8 loose crops and landmark boxes, the random crop is done batched by the trainer
+        self.crop_on_device = crop_on_device
+        self.loose_size = loose_size(image_size, scale, trans_scale)
 
     def __len__(self):
         return len(self.data_lines)
 
     def __getitem__(self, idx):
-        images_list = []; kpt_list = []; mask_list = []
+        images_list = []; kpt_list = []; mask_list = []; bbox_list = []; id_list = []
         for i in range(self.K):
             name = self.data_lines[idx, i]
             if name[0]=='n':
@@ -51,14 +59,25 @@ class EthnicityDataset(Dataset):
             seg_path = os.path.join(self.segfolder, name + '.npy')  
             kpt_path = os.path.join(self.kptfolder, name + '.npy')
                                             
-            image = imread(image_path)/255.
-            kpt = np.load(kpt_path)[:,:2]
-            mask = self.load_mask(seg_path, image.shape[0], image.shape[1])
+            # images missing from the index fall back to the .npy files
+            if self.annotations is not None and image_path in self.annotations:
+                kpt = self.annotations.landmarks(image_path)
+            else:
+                kpt = np.load(kpt_path)[:,:2]
+
+            id_list.append(sample_id(image_path))
+            load_mask = mask_loader(image_path, seg_path, self.load_mask, self.annotations)
+            if self.crop_on_device:
+                append_loose_crop((images_list, kpt_list, mask_list, bbox_list), image_path, kpt, load_mask, self.loose_size, self.scale[1] + 2*self.trans_scale)
+                continue
 
             ### crop information
-            tform = self.crop(image, kpt)
+            tform = self.crop(kpt)
+            # uint8, jpegs are decoded at the reduced resolution the crop allows
+            image, factor = read_image(image_path, tform.scale)
+            mask = load_mask(image.shape[0]*factor, image.shape[1]*factor)
             ## crop 
-            cropped_image = warp(image, tform.inverse, output_shape=(self.image_size, self.image_size))
+            cropped_image = warp(image, np.linalg.inv(tform.params.dot(reduced_to_original(factor))), output_shape=(self.image_size, self.image_size))
             cropped_mask = warp(mask, tform.inverse, output_shape=(self.image_size, self.image_size))
             cropped_kpt = np.dot(tform.params, np.hstack([kpt, np.ones([kpt.shape[0],1])]).T).T # np.linalg.inv(tform.params)
 
@@ -69,29 +88,51 @@ class EthnicityDataset(Dataset):
             kpt_list.append(cropped_kpt)
             mask_list.append(cropped_mask)
 
+        if self.crop_on_device:
+            return loose_batch(images_list, kpt_list, mask_list, bbox_list, self.isSingle, id_list)
         ###
         images_array = torch.from_numpy(np.array(images_list)).type(dtype = torch.float32) #K,224,224,3
         kpt_array = torch.from_numpy(np.array(kpt_list)).type(dtype = torch.float32) #K,224,224,3
         mask_array = torch.from_numpy(np.array(mask_list)).type(dtype = torch.float32) #K,224,224,3
+        id_array = torch.tensor(id_list, dtype=torch.int64) #K
 
         if self.isSingle:
             images_array = images_array.squeeze()
             kpt_array = kpt_array.squeeze()
             mask_array = mask_array.squeeze()
+            id_array = id_array[0]
                     
         data_dict = {
             'image': images_array,
             'landmark': kpt_array,
-            'mask': mask_array
+            'mask': mask_array,
+            'image_id': id_array
         }
         
         return data_dict
 
-    def crop(self, image, kpt):
+    def group_paths(self, idx):
+        ''' image, landmark and segmentation paths of all images item idx can sample from, used to pack shards
+        '''
+        paths = []
+        for name in self.data_lines[idx, :self.K]:
+            if name[0]=='n':
+                imagefolder = '/ps/scratch/face2d3d/train/'
+                kptfolder = '/ps/scratch/face2d3d/train_annotated_torch7/'
+                segfolder = '/ps/scratch/face2d3d/texture_in_the_wild_code/VGGFace2_seg/test_crop_size_400_batch/'
+            elif name[0]=='A':
+                imagefolder = '/ps/scratch/face2d3d/race_per_7000/'
+                kptfolder = '/ps/scratch/face2d3d/race_per_7000_annotated_torch7_new/'
+                segfolder = '/ps/scratch/face2d3d/texture_in_the_wild_code/race7000_seg/test_crop_size_400_batch/'
+            else:
+                imagefolder = self.imagefolder; kptfolder = self.kptfolder; segfolder = self.segfolder
+            paths.append((os.path.join(imagefolder, name + '.jpg'), os.path.join(kptfolder, name + '.npy'), os.path.join(segfolder, name + '.npy')))
+        return paths
+
+    def crop(self, kpt):
         left = np.min(kpt[:,0]); right = np.max(kpt[:,0]); 
         top = np.min(kpt[:,1]); bottom = np.max(kpt[:,1])
 
-        h, w, _ = image.shape
         old_size = (right - left + bottom - top)/2
         center = np.array([right - (right - left) / 2.0, bottom - (bottom - top) / 2.0 ])#+ old_size*0.1])
         # translate center
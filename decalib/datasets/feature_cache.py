@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at deca@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+
+import os, sys
+import hashlib
+import sqlite3
+import numpy as np
+
+def sample_id(name):
+    ''' int64 id of a training image, returned by the training datasets as 'image_id'
+    name: the source image path, also for packed shards (stored as path.txt), so a cache filled from the raw
+        datasets hits when training on their shards and the other way round
+    '''
+    return int(hashlib.sha1(name.encode('utf-8')).hexdigest()[:15], 16)
+
+class FeatureCache(object):
+    def __init__(self, db_path):
+        '''
+        on-disk face recognition features of the training images, image id -> float32 feature
+        features of an image are computed once, on the crop of its first occurrence (or the fixed crop of the
+        precompute script), and reused for the random crops of later epochs
+        '''
+        self.db_path = db_path
+        self.conn = None
+        self.pid = None
+
+    def connect(self):
+        # one connection per process, dataloader workers and ddp ranks open their own
+        if self.conn is None or self.pid != os.getpid():
+            folder = os.path.dirname(os.path.abspath(self.db_path))
+            os.makedirs(folder, exist_ok=True)
+            self.conn = sqlite3.connect(self.db_path, timeout=60)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS features (id INTEGER PRIMARY KEY, feature BLOB NOT NULL)')
+            self.conn.commit()
+            self.pid = os.getpid()
+        return self.conn
+
+    def get_many(self, ids):
+        '''
+        return: dict, id -> feature for the ids that are cached
+        '''
+        conn = self.connect()
+        out = {}
+        # sqlite limits the number of bound parameters
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            rows = conn.execute('SELECT id, feature FROM features WHERE id IN ({})'.format(','.join('?'*len(chunk))), list(chunk)).fetchall()
+            for key, feature in rows:
+                out[key] = np.frombuffer(feature, dtype=np.float32)
+        return out
+
+    def put_many(self, ids, features):
+        conn = self.connect()
+        rows = [(key, np.ascontiguousarray(feature, dtype=np.float32).tobytes()) for key, feature in zip(ids, features)]
+        conn.executemany('INSERT OR REPLACE INTO features (id, feature) VALUES (?, ?)', rows)
+        conn.commit()
+
+    def __len__(self):
+        return self.connect().execute('SELECT COUNT(*) FROM features').fetchone()[0]
+
+if __name__ == '__main__':
+    # precompute, e.g. python -m decalib.datasets.feature_cache --cfg configs/release_version/deca_coarse.yml --cache data/id_features.db
+    import argparse
+    import torch
+    from torch.utils.data import DataLoader
+    from tqdm import tqdm
+    from ..utils.config import get_cfg_defaults, update_cfg
+    from ..utils import lossfunc
+    from . import build_datasets
+    parser = argparse.ArgumentParser(description='DECA: precompute the identity features of the training images')
+    parser.add_argument('--cfg', type=str, default=None, help='cfg file path, the datasets in dataset.training_data (or dataset.shard_dir) are used')
+    parser.add_argument('--cache', type=str, required=True, help='path to the sqlite feature cache')
+    parser.add_argument('--batch_size', type=int, default=16)
+    args = parser.parse_args()
+
+    cfg = get_cfg_defaults()
+    if args.cfg is not None:
+        cfg = update_cfg(cfg, args.cfg)
+    # one fixed crop per image, at the middle of the training crop scales
+    cfg.dataset.scale_min = cfg.dataset.scale_max = (cfg.dataset.scale_min + cfg.dataset.scale_max)/2
+    cfg.dataset.trans_scale = 0.
+    cfg.dataset.crop_on_device = False
+    dataset = build_datasets.build_train(cfg.dataset)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, num_workers=cfg.dataset.num_workers)
+    id_loss = lossfunc.VGGFace2Loss(pretrained_model=cfg.model.fr_model_path).cuda()
+    cache = FeatureCache(args.cache)
+    for batch in tqdm(dataloader, desc='identity features'):
+        ids = batch['image_id'].view(-1).tolist()
+        cached = cache.get_many(ids)
+        missing = [i for i, key in enumerate(ids) if key not in cached]
+        if len(missing) == 0:
+            continue
+        images = batch['image'].view(-1, 3, cfg.dataset.image_size, cfg.dataset.image_size)[missing].cuda()
+        with torch.no_grad():
+            features = id_loss.target_features(images).cpu().numpy()
+        cache.put_many([ids[i] for i in missing], features)
+    print(f'{len(cache)} identity features in {args.cache}')
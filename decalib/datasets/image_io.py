@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at deca@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+
+import os
+import numpy as np
+import cv2
+import torch
+from skimage.transform import estimate_transform
+
+# exif orientation is ignored, like skimage.io.imread, the annotations are in the stored pixel layout
+REDUCED_FLAGS = {factor: flag | cv2.IMREAD_IGNORE_ORIENTATION for factor, flag in
+                 {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}.items()}
+
+def reduction_factor(scale):
+    ''' largest jpeg reduction (1, 2, 4 or 8) that still leaves at least one decoded pixel per output pixel
+    scale: output size / size of the crop box in the original image
+    '''
+    for factor in [8, 4, 2]:
+        if scale*factor <= 1:
+            return factor
+    return 1
+
+def reduced_to_original(factor):
+    ''' [3, 3], pixel coordinates in an image decoded at 1/factor to coordinates in the original,
+    a reduced pixel averages a factor x factor block, its center is at factor*x + (factor-1)/2
+    '''
+    offset = (factor - 1)/2.
+    return np.array([[factor, 0, offset], [0, factor, offset], [0, 0, 1]])
+
+def read_image(imagepath, scale=1.):
+    '''
+    decode an image as uint8 rgb [h, w, 3], also handles grayscale/alpha and non-ascii paths.
+    scale: output size / size of the crop box in the original image. when the crop is downscaled by at least 2, 4 or 8,
+        jpegs are decoded at that reduced size directly in the DCT domain (libjpeg scaled decoding), which is much
+        cheaper than a full decode followed by the warp. other formats are always decoded at full size
+    return: image, factor, the image is 1/factor of the original resolution
+    '''
+    buf = np.fromfile(imagepath, dtype=np.uint8)
+    factor = reduction_factor(scale) if os.path.splitext(imagepath)[-1].lower() in ['.jpg', '.jpeg'] else 1
+    image = cv2.imdecode(buf, REDUCED_FLAGS[factor])
+    if image is None:
+        raise IOError(f'can not decode image {imagepath}')
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), factor
+
+def landmark_box(kpt):
+    ''' center and size of the landmark box, as used by the training datasets
+    '''
+    left = np.min(kpt[:,0]); right = np.max(kpt[:,0]);
+    top = np.min(kpt[:,1]); bottom = np.max(kpt[:,1])
+    old_size = (right - left + bottom - top)/2
+    center = np.array([right - (right - left) / 2.0, bottom - (bottom - top) / 2.0 ])
+    return center, old_size
+
+def loose_size(image_size, scale, trans_scale=0.):
+    ''' resolution of a loose crop that keeps every random crop (scale in [scale_min, scale_max], translation up to
+    trans_scale) at least at image_size
+    '''
+    return int(np.ceil(image_size*(scale[1] + 2*trans_scale)/scale[0]))
+
+def loose_crop(image_path, kpt, load_mask, out_size, scale):
+    '''
+    crop an out_size square around the landmarks, scale times the landmark box wide. random training crops are all
+    inside it, so they can be taken later, batched on device (Trainer.crop_batch), or stored (shards)
+    kpt: [68, 2] in the original image
+    load_mask: (h, w) -> mask of the original image
+    return: image, uint8 [out_size, out_size, 3]; mask, uint8 0-255 [out_size, out_size];
+        kpt, [68, 3] (x, y, 1) in the crop; bbox, [3] center x, center y, landmark box size in the crop
+    '''
+    center, old_size = landmark_box(kpt)
+    size = old_size*scale
+    src_pts = np.array([[center[0]-size/2, center[1]-size/2], [center[0] - size/2, center[1]+size/2], [center[0]+size/2, center[1]-size/2]])
+    DST_PTS = np.array([[0,0], [0,out_size - 1], [out_size - 1, 0]])
+    tform = estimate_transform('similarity', src_pts, DST_PTS)
+
+    image, factor = read_image(image_path, tform.scale)
+    mask = load_mask(image.shape[0]*factor, image.shape[1]*factor)
+    cropped_image = cv2.warpAffine(image, tform.params.dot(reduced_to_original(factor))[:2], (out_size, out_size), flags=cv2.INTER_LINEAR)
+    cropped_mask = cv2.warpAffine(mask.astype(np.float32), tform.params[:2], (out_size, out_size), flags=cv2.INTER_LINEAR)
+    cropped_kpt = np.dot(tform.params, np.hstack([kpt, np.ones([kpt.shape[0],1])]).T).T
+    bbox = np.array([(out_size - 1)/2., (out_size - 1)/2., old_size*tform.scale])
+    return cropped_image, np.round(cropped_mask*255).astype(np.uint8), cropped_kpt, bbox
+
+def mask_loader(image_path, seg_path, load_mask, annotations=None):
+    ''' (h, w) -> mask of a training image, from the annotation index when it has the image, else load_mask(seg_path, h, w)
+    '''
+    def load(h, w):
+        if annotations is not None and image_path in annotations:
+            return annotations.mask(image_path, h, w)
+        return load_mask(seg_path, h, w)
+    return load
+
+def append_loose_crop(lists, image_path, kpt, load_mask, out_size, scale):
+    ''' loose_crop of one image, appended to lists: (images_list, kpt_list, mask_list, bbox_list) as taken by loose_batch
+    '''
+    images_list, kpt_list, mask_list, bbox_list = lists
+    cropped_image, cropped_mask, cropped_kpt, bbox = loose_crop(image_path, kpt, load_mask, out_size, scale)
+    images_list.append(cropped_image.transpose(2,0,1))
+    kpt_list.append(cropped_kpt)
+    mask_list.append(cropped_mask)
+    bbox_list.append(bbox)
+
+def loose_batch(images_list, kpt_list, mask_list, bbox_list, isSingle=False, id_list=None):
+    ''' data dict of K loose crops, images and masks stay uint8
+    '''
+    data_dict = {
+        'image': torch.from_numpy(np.array(images_list)), #K,3,h,w
+        'landmark': torch.from_numpy(np.array(kpt_list)).type(dtype = torch.float32), #K,68,3
+        'mask': torch.from_numpy(np.array(mask_list)), #K,h,w
+        'bbox': torch.from_numpy(np.array(bbox_list)).type(dtype = torch.float32), #K,3
+    }
+    if id_list is not None:
+        data_dict['image_id'] = torch.tensor(id_list, dtype=torch.int64) #K
+    if isSingle:
+        data_dict = {key: data_dict[key][0] for key in data_dict}
+    return data_dict
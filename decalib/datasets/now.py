@@ -10,7 +10,11 @@ from glob import glob
 from torch.utils.data import Dataset, DataLoader, ConcatDataset
 
 class NoWDataset(Dataset):
-    def __init__(self, ring_elements=6, crop_size=224, scale=1.6):
+    def __init__(self, ring_elements=6, crop_size=224, scale=1.6, folder=None, return_original=True):
+        '''
+        folder: NoW dataset folder (imagepathsvalidation.txt, final_release_version/...), None for the paths below
+        return_original: False leaves the full resolution image out of the samples
+        '''
         # folder = '/ps/scratch/yfeng/other-github/now_evaluation/data/NoW_Dataset'
         # self.data_path = os.path.join(folder, 'imagepathsvalidation.txt')
         # with open(self.data_path) as f:
@@ -19,15 +23,21 @@ class NoWDataset(Dataset):
         # self.imagefolder = os.path.join(folder, 'final_release_version', 'iphone_pictures')
         # self.bbxfolder = os.path.join(folder, 'final_release_version', 'detected_face')
 
-        self.data_path = 'C:/Users/Administrator/Desktop/Now/imagepathsvalidation.txt'
+        if folder is not None:
+            self.data_path = os.path.join(folder, 'imagepathsvalidation.txt')
+            self.imagefolder = os.path.join(folder, 'final_release_version', 'iphone_pictures')
+            self.bbxfolder = os.path.join(folder, 'final_release_version', 'detected_face')
+        else:
+            self.data_path = 'C:/Users/Administrator/Desktop/Now/imagepathsvalidation.txt'
+            self.imagefolder = 'C:/Users/Administrator/Desktop/Now/NoW_Dataset/final_release_version/iphone_pictures/validation_set/1-10'
+            self.bbxfolder = 'C:/Users/Administrator/Desktop/Now/NoW_Dataset/final_release_version/detected_face/validation_set/1-10'
         with open(self.data_path) as f:
             self.data_lines = f.readlines()        
-        self.imagefolder = 'C:/Users/Administrator/Desktop/Now/NoW_Dataset/final_release_version/iphone_pictures/validation_set/1-10'
-        self.bbxfolder = 'C:/Users/Administrator/Desktop/Now/NoW_Dataset/final_release_version/detected_face/validation_set/1-10'
 
 
         self.crop_size = crop_size
         self.scale = scale
+        self.return_original = return_original
             
     def __len__(self):
         return len(self.data_lines)
@@ -56,8 +66,10 @@ class NoWDataset(Dataset):
         image = image/255.
         dst_image = warp(image, tform.inverse, output_shape=(self.crop_size, self.crop_size))
         dst_image = dst_image.transpose(2,0,1)
-        return {'image': torch.tensor(dst_image).float(),
+        data = {'image': torch.tensor(dst_image).float(),
                 'imagename': self.data_lines[index].strip().replace('.jpg', ''),
                 'tform': torch.tensor(tform.params).float(),
-                'original_image': torch.tensor(image.transpose(2,0,1)).float(),
-                }
\ No newline at end of file
+                }
+        if self.return_original:
+            data['original_image'] = torch.tensor(image.transpose(2,0,1)).float()
+        return data
\ No newline at end of file
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+#
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at deca@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+
+''' packed training shards
+training items (the K-image groups of VGGFace2/Vox/Ethnicity) are stored pre-cropped in tar shards, webdataset layout:
+    {key}.{k}.jpg       image k of the item, cropped around the landmarks at the largest crop scale
+    {key}.{k}.kpt.npy   68 landmarks in the packed crop, float32 [68, 2]
+    {key}.{k}.mask.png  segmentation mask in the packed crop, uint8 0-255
+and index.json lists the shards and packing settings. shards are read sequentially, so training on network storage
+does large reads instead of three small random ones per image.
+'''
+import os, sys
+import io
+import json
+import tarfile
+import numpy as np
+import cv2
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+from skimage.transform import estimate_transform, warp
+
+from .image_io import loose_crop, loose_batch, landmark_box
+from .feature_cache import sample_id
+
+def pack_image(image_path, kpt_path, seg_path, pack_size, scale_max, trans_scale):
+    ''' crop one image so that every crop the datasets can sample (scale up to scale_max, translation up to trans_scale)
+    lies inside the packed image
+    '''
+    def load_mask(h, w):
+        if os.path.isfile(seg_path):
+            return (np.load(seg_path) > 0.5).astype(np.float32)
+        return np.ones((h, w), dtype=np.float32)
+    kpt = np.load(kpt_path)[:,:2]
+    packed_image, packed_mask, packed_kpt, _ = loose_crop(image_path, kpt, load_mask, pack_size, scale_max + 2*trans_scale)
+
+    kpt_bytes = io.BytesIO(); np.save(kpt_bytes, packed_kpt[:,:2].astype(np.float32))
+    return {'jpg': cv2.imencode('.jpg', cv2.cvtColor(packed_image, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes(),
+            'kpt.npy': kpt_bytes.getvalue(),
+            'mask.png': cv2.imencode('.png', packed_mask)[1].tobytes(),
+            # source image, its image_id matches the one of the raw datasets (feature cache)
+            'path.txt': image_path.encode('utf-8')}
+
+def add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+def pack_shards(datasets, output_dir, pack_size=288, scale_max=1.8, trans_scale=0., items_per_shard=1000):
+    '''
+    datasets: dict, name -> dataset with group_paths(idx)
+    pack_size: resolution of the packed crops, at least image_size*scale_max/scale_min to keep full resolution at scale_min
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    shards = []; tar = None
+    for dataname, dataset in datasets.items():
+        for idx in range(len(dataset)):
+            if tar is None or shards[-1]['num_items'] == items_per_shard:
+                if tar is not None:
+                    tar.close()
+                shards.append({'path': f'shard_{len(shards):06d}.tar', 'num_items': 0})
+                tar = tarfile.open(os.path.join(output_dir, shards[-1]['path']), 'w')
+            key = f'{dataname}_{idx:08d}'
+            records = []
+            for image_path, kpt_path, seg_path in dataset.group_paths(idx):
+                try:
+                    records.append(pack_image(image_path, kpt_path, seg_path, pack_size, scale_max, trans_scale))
+                except Exception as e:
+                    print(f'skip {image_path}: {e}')
+            if len(records) == 0:
+                continue
+            for k, record in enumerate(records):
+                for ext, data in record.items():
+                    add_bytes(tar, f'{key}.{k}.{ext}', data)
+            shards[-1]['num_items'] += 1
+    if tar is not None:
+        tar.close()
+    index = {'pack_size': pack_size, 'scale_max': scale_max, 'trans_scale': trans_scale,
+             'num_items': sum([shard['num_items'] for shard in shards]), 'shards': shards}
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+def read_shard(path):
+    ''' stream the items of a shard in order
+    yield: list of records (dict, ext -> bytes, and '__key__') of one item
+    '''
+    key = None; records = {}
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            item_key, k, ext = member.name.split('.', 2)
+            if item_key != key:
+                if key is not None:
+                    yield [records[k] for k in sorted(records.keys(), key=int)]
+                key = item_key; records = {}
+            # __key__ names the image, e.g. for its image_id
+            records.setdefault(k, {'__key__': f'{item_key}.{k}'})[ext] = tar.extractfile(member).read()
+    if key is not None:
+        yield [records[k] for k in sorted(records.keys(), key=int)]
+
+class ShardedFaceDataset(IterableDataset):
+    def __init__(self, shard_dir, K, image_size, scale, trans_scale = 0, isSingle=False, shuffle_buffer=256, crop_on_device=False):
+        '''
+        training items read from packed shards, with the same random crop scale/translation as the original datasets.
+        shards are split across dataloader workers and visited in random order, items are shuffled within a buffer
+        crop_on_device: return the packed uint8 crops and landmark boxes, the random crop is done by the trainer
+        '''
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, 'index.json')) as f:
+            self.index = json.load(f)
+        self.K = K
+        self.image_size = image_size
+        self.scale = scale #[scale_min, scale_max]
+        self.trans_scale = trans_scale #[dx, dy]
+        self.isSingle = isSingle
+        if isSingle:
+            self.K = 1
+        self.shuffle_buffer = shuffle_buffer
+        self.crop_on_device = crop_on_device
+        if scale[1] > self.index['scale_max'] or trans_scale > self.index['trans_scale']:
+            print(f'crop scale {scale[1]}/translation {trans_scale} exceed the packed crops ({self.index["scale_max"]}/{self.index["trans_scale"]}), borders will be black')
+
+    def __len__(self):
+        return self.index['num_items']
+
+    def __iter__(self):
+        shards = [shard['path'] for shard in self.index['shards']]
+        if dist.is_available() and dist.is_initialized():
+            # distributed training, every process reads its own shards
+            shards = shards[dist.get_rank()::dist.get_world_size()]
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            # workers share the numpy seed, reseed so they do not sample the same crops
+            np.random.seed((torch.initial_seed() + worker_info.id) % 2**32)
+            shards = shards[worker_info.id::worker_info.num_workers]
+        buffer = []
+        for i in np.random.permutation(len(shards)):
+            for records in read_shard(os.path.join(self.shard_dir, shards[i])):
+                buffer.append(records)
+                if len(buffer) >= self.shuffle_buffer:
+                    yield self.load_item(buffer.pop(np.random.randint(len(buffer))))
+        np.random.shuffle(buffer)
+        for records in buffer:
+            yield self.load_item(records)
+
+    def load_item(self, records):
+        images_list = []; kpt_list = []; mask_list = []; bbox_list = []; id_list = []
+
+        replace = len(records) < self.K
+        for i in np.random.choice(len(records), self.K, replace=replace):
+            record = records[i]
+            # shards packed without the source path fall back to the shard key
+            id_list.append(sample_id(record['path.txt'].decode('utf-8') if 'path.txt' in record else record['__key__']))
+            image = cv2.cvtColor(cv2.imdecode(np.frombuffer(record['jpg'], np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+            kpt = np.load(io.BytesIO(record['kpt.npy']))
+            mask = cv2.imdecode(np.frombuffer(record['mask.png'], np.uint8), cv2.IMREAD_UNCHANGED)
+
+            if self.crop_on_device:
+                center, old_size = landmark_box(kpt)
+                images_list.append(image.transpose(2,0,1))
+                kpt_list.append(np.hstack([kpt, np.ones([kpt.shape[0],1])]))
+                mask_list.append(mask)
+                bbox_list.append(np.array([center[0], center[1], old_size]))
+                continue
+            mask = mask/255.
+
+            ### crop information
+            tform = self.crop(kpt)
+            ## crop
+            cropped_image = warp(image, tform.inverse, output_shape=(self.image_size, self.image_size))
+            cropped_mask = warp(mask, tform.inverse, output_shape=(self.image_size, self.image_size))
+            cropped_kpt = np.dot(tform.params, np.hstack([kpt, np.ones([kpt.shape[0],1])]).T).T # np.linalg.inv(tform.params)
+
+            # normalized kpt
+            cropped_kpt[:,:2] = cropped_kpt[:,:2]/self.image_size * 2  - 1
+
+            images_list.append(cropped_image.transpose(2,0,1))
+            kpt_list.append(cropped_kpt)
+            mask_list.append(cropped_mask)
+
+        if self.crop_on_device:
+            return loose_batch(images_list, kpt_list, mask_list, bbox_list, self.isSingle, id_list)
+        ###
+        images_array = torch.from_numpy(np.array(images_list)).type(dtype = torch.float32) #K,224,224,3
+        kpt_array = torch.from_numpy(np.array(kpt_list)).type(dtype = torch.float32) #K,224,224,3
+        mask_array = torch.from_numpy(np.array(mask_list)).type(dtype = torch.float32) #K,224,224,3
+        id_array = torch.tensor(id_list, dtype=torch.int64) #K
+
+        if self.isSingle:
+            images_array = images_array.squeeze()
+            kpt_array = kpt_array.squeeze()
+            mask_array = mask_array.squeeze()
+            id_array = id_array[0]
+
+        data_dict = {
+            'image': images_array,
+            'landmark': kpt_array,
+            'mask': mask_array,
+            'image_id': id_array
+        }
+
+        return data_dict
+
+    def crop(self, kpt):
+        left = np.min(kpt[:,0]); right = np.max(kpt[:,0]);
+        top = np.min(kpt[:,1]); bottom = np.max(kpt[:,1])
+
+        old_size = (right - left + bottom - top)/2
+        center = np.array([right - (right - left) / 2.0, bottom - (bottom - top) / 2.0 ])
+        # translate center
+        trans_scale = (np.random.rand(2)*2 -1) * self.trans_scale
+        center = center + trans_scale*old_size # 0.5
+
+        scale = np.random.rand() * (self.scale[1] - self.scale[0]) + self.scale[0]
+        size = int(old_size*scale)
+
+        # crop image
+        src_pts = np.array([[center[0]-size/2, center[1]-size/2], [center[0] - size/2, center[1]+size/2], [center[0]+size/2, center[1]-size/2]])
+        DST_PTS = np.array([[0,0], [0,self.image_size - 1], [self.image_size - 1, 0]])
+        tform = estimate_transform('similarity', src_pts, DST_PTS)
+        return tform
+
+if __name__ == '__main__':
+    # python -m decalib.datasets.shards --cfg configs/release_version/deca_coarse.yml --output /path/to/shards
+    import argparse
+    from ..utils.config import get_cfg_defaults, update_cfg
+    from . import build_datasets
+    parser = argparse.ArgumentParser(description='DECA: pack training data into shards')
+    parser.add_argument('--cfg', type=str, default=None, help='cfg file path, the datasets in dataset.training_data are packed')
+    parser.add_argument('--output', type=str, required=True, help='output folder of the shards')
+    parser.add_argument('--items_per_shard', type=int, default=1000, help='training items (image groups) per tar shard')
+    parser.add_argument('--pack_size', type=int, default=0, help='resolution of the packed crops, 0 for image_size*scale_max/scale_min')
+    args = parser.parse_args()
+
+    cfg = get_cfg_defaults()
+    if args.cfg is not None:
+        cfg = update_cfg(cfg, args.cfg)
+    cfg.dataset.shard_dir = ''
+    datasets = build_datasets.build_train(cfg.dataset).datasets
+    pack_size = args.pack_size or int(np.ceil(cfg.dataset.image_size*cfg.dataset.scale_max/cfg.dataset.scale_min))
+    index = pack_shards({f'{type(dataset).__name__}{i}': dataset for i, dataset in enumerate(datasets)}, args.output, pack_size=pack_size, scale_max=cfg.dataset.scale_max,
+                        trans_scale=cfg.dataset.trans_scale, items_per_shard=args.items_per_shard)
+    print(f'packed {index["num_items"]} items into {len(index["shards"])} shards in {args.output}')
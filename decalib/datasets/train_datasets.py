@@ -10,6 +10,7 @@ from skimage.transform import estimate_transform, warp, resize, rescale
 from glob import glob
 
 from . import detectors
+from .feature_cache import sample_id
 
 def build_dataloader(config, is_train=True):
     data_list = []
@@ -254,6 +255,7 @@ class COCODataset(Dataset):
                 'image': images_array*2. - 1,
                 'landmark': kpt_array,
                 # 'mask': mask_array
+                'image_id': torch.tensor(sample_id(image_path), dtype=torch.int64),
             }
             
             return data_dict
@@ -346,6 +348,7 @@ class CelebAHQDataset(Dataset):
                 'image': images_array,
                 'landmark': kpt_array,
                 # 'mask': mask_array
+                'image_id': torch.tensor(sample_id(image_path), dtype=torch.int64),
             }
             
             return data_dict
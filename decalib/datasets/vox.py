@@ -9,8 +9,11 @@ from skimage.transform import estimate_transform, warp, resize, rescale
 from glob import glob
 from torch.utils.data import Dataset, DataLoader, ConcatDataset
 
+from .image_io import read_image, reduced_to_original, loose_size, loose_batch, mask_loader, append_loose_crop
+from .feature_cache import sample_id
+
 class VoxelDataset(Dataset):
-    def __init__(self, K, image_size, scale, trans_scale = 0, dataname='vox2', n_train=100000, isTemporal=False, isEval=False, isSingle=False):
+    def __init__(self, K, image_size, scale, trans_scale = 0, dataname='vox2', n_train=100000, isTemporal=False, isEval=False, isSingle=False, annotations=None, crop_on_device=False):
         self.K = K
         self.image_size = image_size
         if dataname == 'vox1':
@@ -67,6 +70,11 @@ class VoxelDataset(Dataset):
         self.isSingle = isSingle
         if isSingle:
             self.K = 1
+        # AnnotationIndex with the landmarks and masks of all images, None to read the .npy files
+        self.annotations = annotations
+        # return uint8 loose crops and landmark boxes, the random crop is done batched by the trainer
+        self.crop_on_device = crop_on_device
+        self.loose_size = loose_size(image_size, scale, trans_scale)
 
     def __len__(self):
         return len(self.face_list)
@@ -77,7 +85,7 @@ class VoxelDataset(Dataset):
         name_list = self.face_dict[key]
         ind = np.random.randint(low=0, high=len(name_list))
 
-        images_list = []; kpt_list = []; fullname_list = []; mask_list = []
+        images_list = []; kpt_list = []; fullname_list = []; mask_list = []; bbox_list = []; id_list = []
         if self.isTemporal:
             random_start = np.random.randint(low=0, high=len(name_list)-self.K)
             sample_list = range(random_start, random_start + self.K)
@@ -90,14 +98,25 @@ class VoxelDataset(Dataset):
             kpt_path = (os.path.join(self.kptfolder, person_id, video_id, face_id, name + self.kpt_suffix))
             seg_path = (os.path.join(self.segfolder, person_id, video_id, face_id, name + '.npy'))
                                             
-            image = imread(image_path)/255.
-            kpt = np.load(kpt_path)[:,:2]
-            mask = self.load_mask(seg_path, image.shape[0], image.shape[1])
+            # images missing from the index fall back to the .npy files
+            if self.annotations is not None and image_path in self.annotations:
+                kpt = self.annotations.landmarks(image_path)
+            else:
+                kpt = np.load(kpt_path)[:,:2]
+
+            id_list.append(sample_id(image_path))
+            load_mask = mask_loader(image_path, seg_path, self.load_mask, self.annotations)
+            if self.crop_on_device:
+                append_loose_crop((images_list, kpt_list, mask_list, bbox_list), image_path, kpt, load_mask, self.loose_size, self.scale[1] + 2*self.trans_scale)
+                continue
 
             ### crop information
-            tform = self.crop(image, kpt)
+            tform = self.crop(kpt)
+            # uint8, jpegs are decoded at the reduced resolution the crop allows
+            image, factor = read_image(image_path, tform.scale)
+            mask = load_mask(image.shape[0]*factor, image.shape[1]*factor)
             ## crop 
-            cropped_image = warp(image, tform.inverse, output_shape=(self.image_size, self.image_size))
+            cropped_image = warp(image, np.linalg.inv(tform.params.dot(reduced_to_original(factor))), output_shape=(self.image_size, self.image_size))
             cropped_mask = warp(mask, tform.inverse, output_shape=(self.image_size, self.image_size))
             cropped_kpt = np.dot(tform.params, np.hstack([kpt, np.ones([kpt.shape[0],1])]).T).T # np.linalg.inv(tform.params)
 
@@ -108,29 +127,42 @@ class VoxelDataset(Dataset):
             kpt_list.append(cropped_kpt)
             mask_list.append(cropped_mask)
 
+        if self.crop_on_device:
+            return loose_batch(images_list, kpt_list, mask_list, bbox_list, self.isSingle, id_list)
         ###
         images_array = torch.from_numpy(np.array(images_list)).type(dtype = torch.float32) #K,224,224,3
         kpt_array = torch.from_numpy(np.array(kpt_list)).type(dtype = torch.float32) #K,224,224,3
         mask_array = torch.from_numpy(np.array(mask_list)).type(dtype = torch.float32) #K,224,224,3
+        id_array = torch.tensor(id_list, dtype=torch.int64) #K
 
         if self.isSingle:
             images_array = images_array.squeeze()
             kpt_array = kpt_array.squeeze()
             mask_array = mask_array.squeeze()
+            id_array = id_array[0]
                     
         data_dict = {
             'image': images_array,
             'landmark': kpt_array,
-            'mask': mask_array
+            'mask': mask_array,
+            'image_id': id_array
         }
         
         return data_dict
 
-    def crop(self, image, kpt):
+    def group_paths(self, idx):
+        ''' image, landmark and segmentation paths of all images item idx can sample from, used to pack shards
+        '''
+        key = self.face_list[idx]
+        person_id, video_id, face_id = key.split('/')
+        return [(os.path.join(self.imagefolder, person_id, video_id, face_id, name + '.png'),
+                 os.path.join(self.kptfolder, person_id, video_id, face_id, name + self.kpt_suffix),
+                 os.path.join(self.segfolder, person_id, video_id, face_id, name + '.npy')) for name in self.face_dict[key]]
+
+    def crop(self, kpt):
         left = np.min(kpt[:,0]); right = np.max(kpt[:,0]); 
         top = np.min(kpt[:,1]); bottom = np.max(kpt[:,1])
 
-        h, w, _ = image.shape
         old_size = (right - left + bottom - top)/2
         center = np.array([right - (right - left) / 2.0, bottom - (bottom - top) / 2.0 ])#+ old_size*0.1])
         # translate center
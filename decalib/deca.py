@@ -30,6 +30,7 @@ from .models.FLAME import FLAME, FLAMETex
 from .models.decoders import Generator
 from .utils import util
 from .utils.rotation_converter import batch_euler2axis
+from .models.lbs import batch_rodrigues
 from .utils.tensor_cropper import transform_points
 from .datasets import datasets
 from .utils.config import cfg
@@ -59,13 +60,23 @@ class DECA(nn.Module):
         self.uv_face_mask = F.interpolate(mask, [model_cfg.uv_size, model_cfg.uv_size]).to(self.device)
         # displacement correction
         fixed_dis = np.load(model_cfg.fixed_displacement_path)                                                                                  # 读取位移贴图npy数据
-        self.fixed_uv_dis = torch.tensor(fixed_dis).float().to(self.device)
+        fixed_dis = torch.tensor(fixed_dis).float()
+        if fixed_dis.shape[-1] != model_cfg.uv_size:
+            fixed_dis = F.interpolate(fixed_dis[None,None,:,:], [model_cfg.uv_size, model_cfg.uv_size], mode='bilinear', align_corners=False)[0,0]
+        self.fixed_uv_dis = fixed_dis.to(self.device)
         # mean texture
         mean_texture = imread(model_cfg.mean_tex_path).astype(np.float32)/255.                                                                  # 读取mean texture,归一化，维度转化为(1,3,512,512)
         mean_texture = torch.from_numpy(mean_texture.transpose(2,0,1))[None,:,:,:].contiguous()
         self.mean_texture = F.interpolate(mean_texture, [model_cfg.uv_size, model_cfg.uv_size]).to(self.device)
         # dense mesh template, for save detail mesh                                                                                             
-        self.dense_template = np.load(model_cfg.dense_template_path, allow_pickle=True, encoding='latin1').item()                               # 数组元素读取并转化为字典
+        self.dense_template = None
+        if os.path.exists(model_cfg.dense_template_path):
+            self.dense_template = np.load(model_cfg.dense_template_path, allow_pickle=True, encoding='latin1').item()                           # 数组元素读取并转化为字典
+        if self.dense_template is None or self.dense_template['img_size'] != model_cfg.uv_size:
+            # released template only exists for 256, generate it for other uv sizes
+            self.dense_template = self.render.generate_dense_template(self.uv_face_mask)
+        # process the detail map in bands of rows for large uv sizes, 0 for the whole map at once
+        self.detail_tile_rows = model_cfg.detail_tile_rows
 
     def _create_model(self, model_cfg):
         # set up parameters
@@ -82,7 +93,7 @@ class DECA(nn.Module):
         self.flame = FLAME(model_cfg).to(self.device)                                                                                           # 配置文件以及通用模型读入
         if model_cfg.use_tex:
             self.flametex = FLAMETex(model_cfg).to(self.device)
-        self.D_detail = Generator(latent_dim=self.n_detail+self.n_cond, out_channels=1, out_scale=model_cfg.max_z, sample_mode = 'bilinear').to(self.device)
+        self.D_detail = Generator(latent_dim=self.n_detail+self.n_cond, out_channels=1, out_scale=model_cfg.max_z, sample_mode = 'bilinear', out_size=model_cfg.uv_size).to(self.device)
         # resume model
         model_path = self.cfg.pretrained_modelpath
         if os.path.exists(model_path):
@@ -117,15 +128,13 @@ class DECA(nn.Module):
     def displacement2normal(self, uv_z, coarse_verts, coarse_normals):
         ''' Convert displacement map into detail normal map
         '''
-        batch_size = uv_z.shape[0]
         uv_coarse_vertices = self.render.world2uv(coarse_verts).detach()
         uv_coarse_normals = self.render.world2uv(coarse_normals).detach()
     
         uv_z = uv_z*self.uv_face_eye_mask
         uv_detail_vertices = uv_coarse_vertices + uv_z*uv_coarse_normals + self.fixed_uv_dis[None,None,:,:]*uv_coarse_normals.detach()
-        dense_vertices = uv_detail_vertices.permute(0,2,3,1).reshape([batch_size, -1, 3])
-        uv_detail_normals = util.vertex_normals(dense_vertices, self.render.dense_faces.expand(batch_size, -1, -1))
-        uv_detail_normals = uv_detail_normals.reshape([batch_size, uv_coarse_vertices.shape[2], uv_coarse_vertices.shape[3], 3]).permute(0,3,1,2)
+        # the dense mesh is the regular uv grid, normals come from finite differences on the grid
+        uv_detail_normals = util.grid_vertex_normals(uv_detail_vertices, tile_rows=self.detail_tile_rows)
         uv_detail_normals = uv_detail_normals*self.uv_face_eye_mask + uv_coarse_normals*(1.-self.uv_face_eye_mask)
         return uv_detail_normals
 
@@ -144,11 +153,12 @@ class DECA(nn.Module):
                 parameters = self.E_flame(images)
         else:
             parameters = self.E_flame(images)
-        codedict = self.decompose_code(parameters, self.param_dict)
+        # codes are fp32 even if the encoders run under autocast, FLAME/rendering are not run in half precision
+        codedict = self.decompose_code(parameters.float(), self.param_dict)
         codedict['images'] = images
         if use_detail:
             detailcode = self.E_detail(images)
-            codedict['detail'] = detailcode
+            codedict['detail'] = detailcode.float()
         if self.cfg.model.jaw_type == 'euler':
             posecode = codedict['pose']
             euler_jaw_pose = posecode[:,3:].clone() # x for yaw (open mouth), y for pitch (left ang right), z for roll
@@ -159,13 +169,19 @@ class DECA(nn.Module):
 
     # @torch.no_grad()
     def decode(self, codedict, rendering=True, iddict=None, vis_lmk=True, return_vis=True, use_detail=True,
-                render_orig=False, original_image=None, tform=None):
+                render_orig=False, original_image=None, tform=None, session=None, draw_landmarks=True):
+        ''' session: AnimationSession, reuses identity-dependent products (albedo, detail normals, extracted texture)
+        draw_landmarks: False leaves the landmark images out of visdict, they can be drawn later (on cpu) from opdict
+        '''
         images = codedict['images']
         batch_size = images.shape[0]
         
         ## decode
         verts, landmarks2d, landmarks3d = self.flame(shape_params=codedict['shape'], expression_params=codedict['exp'], pose_params=codedict['pose'])
-        if self.cfg.model.use_tex:
+        if session is not None:
+            albedo = session.albedo
+        elif self.cfg.model.use_tex:
+            # repeated tex codes are served from the FLAMETex lru cache (cfg.model.tex_cache_size)
             albedo = self.flametex(codedict['tex'])
         else:
             albedo = torch.zeros([batch_size, 3, self.uv_size, self.uv_size], device=images.device) 
@@ -210,10 +226,13 @@ class DECA(nn.Module):
             opdict['albedo'] = albedo
             
         if use_detail:
-            uv_z = self.D_detail(torch.cat([codedict['pose'][:,3:], codedict['exp'], codedict['detail']], dim=1))
-            if iddict is not None:
-                uv_z = self.D_detail(torch.cat([iddict['pose'][:,3:], iddict['exp'], codedict['detail']], dim=1))
-            uv_detail_normals = self.displacement2normal(uv_z, verts, ops['normals'])
+            if session is not None:
+                uv_z, uv_detail_normals = session.detail(codedict, iddict)
+            else:
+                uv_z = self.D_detail(torch.cat([codedict['pose'][:,3:], codedict['exp'], codedict['detail']], dim=1))
+                if iddict is not None:
+                    uv_z = self.D_detail(torch.cat([iddict['pose'][:,3:], iddict['exp'], codedict['detail']], dim=1))
+                uv_detail_normals = self.displacement2normal(uv_z, verts, ops['normals'])
             uv_shading = self.render.add_SHlight(uv_detail_normals, codedict['light'])
             uv_texture = albedo*uv_shading
 
@@ -234,26 +253,29 @@ class DECA(nn.Module):
             shape_detail_images = self.render.render_shape(verts, trans_verts, detail_normal_images=detail_normal_images, h=h, w=w, images=background)
             
             ## extract texture
-            ## TODO: current resolution 256x256, support higher resolution, and add visibility
-            uv_pverts = self.render.world2uv(trans_verts)
-            uv_gt = F.grid_sample(images, uv_pverts.permute(0,2,3,1)[:,:,:,:2], mode='bilinear', align_corners=False)
-            if self.cfg.model.use_tex:
-                ## TODO: poisson blending should give better-looking results
-                if self.cfg.model.extract_tex:
-                    uv_texture_gt = uv_gt[:,:3,:,:]*self.uv_face_eye_mask + (uv_texture[:,:3,:,:]*(1-self.uv_face_eye_mask))
-                else:
-                    uv_texture_gt = uv_texture[:,:3,:,:]
+            ## TODO: add visibility
+            if session is not None and session.uv_texture_gt is not None:
+                # texture extracted from the identity image, not from the image under the new pose
+                uv_texture_gt = session.uv_texture_gt
             else:
-                uv_texture_gt = uv_gt[:,:3,:,:]*self.uv_face_eye_mask + (torch.ones_like(uv_gt[:,:3,:,:])*(1-self.uv_face_eye_mask)*0.7)
+                uv_pverts = self.render.world2uv(trans_verts)
+                uv_gt = F.grid_sample(images, uv_pverts.permute(0,2,3,1)[:,:,:,:2], mode='bilinear', align_corners=False)
+                if self.cfg.model.use_tex:
+                    ## TODO: poisson blending should give better-looking results
+                    if self.cfg.model.extract_tex:
+                        uv_texture_gt = uv_gt[:,:3,:,:]*self.uv_face_eye_mask + (uv_texture[:,:3,:,:]*(1-self.uv_face_eye_mask))
+                    else:
+                        uv_texture_gt = uv_texture[:,:3,:,:]
+                else:
+                    uv_texture_gt = uv_gt[:,:3,:,:]*self.uv_face_eye_mask + (torch.ones_like(uv_gt[:,:3,:,:])*(1-self.uv_face_eye_mask)*0.7)
             
             opdict['uv_texture_gt'] = uv_texture_gt
-            visdict = {
-                'inputs': images, 
-                'landmarks2d': util.tensor_vis_landmarks(images, landmarks2d),
-                'landmarks3d': util.tensor_vis_landmarks(images, landmarks3d),
-                'shape_images': shape_images,
-                'shape_detail_images': shape_detail_images
-            }
+            visdict = {'inputs': images}
+            if draw_landmarks:
+                visdict['landmarks2d'] = util.tensor_vis_landmarks(images, landmarks2d)
+                visdict['landmarks3d'] = util.tensor_vis_landmarks(images, landmarks3d)
+            visdict['shape_images'] = shape_images
+            visdict['shape_detail_images'] = shape_detail_images
             if self.cfg.model.use_tex:
                 visdict['rendered_images'] = ops['images']
 
@@ -303,7 +325,8 @@ class DECA(nn.Module):
         texture = texture[:,:,[2,1,0]]
         normals = opdict['normals'][i].cpu().numpy()
         displacement_map = opdict['displacement_map'][i].cpu().numpy().squeeze()
-        dense_vertices, dense_colors, dense_faces = util.upsample_mesh(vertices, normals, faces, displacement_map, texture, self.dense_template)
+        dense_vertices, dense_colors, dense_faces = util.upsample_mesh(vertices, normals, faces, displacement_map, texture, self.dense_template, 
+                                                                        chunk_size=self.detail_tile_rows*self.uv_size)
         util.write_obj(filename.replace('.obj', '_detail.obj'), 
                         dense_vertices, 
                         dense_faces,
@@ -313,15 +336,81 @@ class DECA(nn.Module):
     def run(self, imagepath, iscrop=True):
         ''' An api for running deca given an image path
         '''
-        testdata = datasets.TestData(imagepath)
-        images = testdata[0]['image'].to(self.device)[None,...]
+        testdata = datasets.TestData(imagepath, iscrop=iscrop)
+        images = testdata.crop(testdata[0], self.device)
         codedict = self.encode(images)
         opdict, visdict = self.decode(codedict)
         return codedict, opdict, visdict
 
+    def animation_session(self, codedict, opdict=None):
+        ''' create an AnimationSession for the identities in codedict
+        opdict: output of decode(codedict) if already available, its uv_texture_gt is reused
+        '''
+        return AnimationSession(self, codedict, opdict)
+
+    def tex_cache_info(self):
+        ''' hit/miss counters of the albedo cache
+        '''
+        if not self.cfg.model.use_tex:
+            return {'hits': 0, 'misses': 0, 'size': 0}
+        return {'hits': self.flametex.cache_hits, 'misses': self.flametex.cache_misses, 'size': len(self.flametex.cache)}
+
     def model_dict(self):
+        # modules wrapped in DistributedDataParallel by the trainer are saved without the 'module.' prefix
+        unwrap = lambda module: getattr(module, 'module', module)
         return {
-            'E_flame': self.E_flame.state_dict(),
-            'E_detail': self.E_detail.state_dict(),
-            'D_detail': self.D_detail.state_dict()
+            'E_flame': unwrap(self.E_flame).state_dict(),
+            'E_detail': unwrap(self.E_detail).state_dict(),
+            'D_detail': unwrap(self.D_detail).state_dict()
         }
+
+class AnimationSession(object):
+    ''' Identity-level cache for re-posing and expression transfer.
+    Keeps what only depends on the identity (detail code, albedo, extracted uv texture) and the detail normal map
+    of the last expression/jaw pose in the canonical (zero global pose) frame.
+    A change of global pose or camera only rotates the cached normals, a change of expression or jaw pose
+    reruns D_detail and displacement2normal once.
+    '''
+    def __init__(self, deca, codedict, opdict=None):
+        if 'detail' not in codedict:
+            raise ValueError('AnimationSession needs the detail code, encode the identity image with use_detail=True')
+        self.deca = deca
+        batch_size = codedict['shape'].shape[0]
+        with torch.no_grad():
+            self.shape = codedict['shape'].clone()
+            self.detail_code = codedict['detail'].clone()
+            if deca.cfg.model.use_tex:
+                self.albedo = deca.flametex(codedict['tex']).detach()
+            else:
+                self.albedo = torch.zeros([batch_size, 3, deca.uv_size, deca.uv_size], device=self.shape.device)
+            if opdict is not None and 'uv_texture_gt' in opdict:
+                self.uv_texture_gt = opdict['uv_texture_gt'].detach()
+            else:
+                self.uv_texture_gt = None
+        # detail normals of the last expression, in the canonical frame
+        self.detail_inputs = None
+        self.uv_z = None
+        self.canonical_detail_normals = None
+
+    def decode(self, codedict, **kwargs):
+        return self.deca.decode(codedict, session=self, **kwargs)
+
+    def detail(self, codedict, iddict=None):
+        ''' displacement map and detail normal map (world space) for the pose/expression in codedict
+        '''
+        deca = self.deca
+        condict = codedict if iddict is None else iddict
+        detail_inputs = torch.cat([codedict['exp'], codedict['pose'][:,3:], condict['exp'], condict['pose'][:,3:]], dim=1)
+        if self.detail_inputs is None or not torch.equal(self.detail_inputs, detail_inputs):
+            with torch.no_grad():
+                canonical_pose = codedict['pose'].clone()
+                canonical_pose[:,:3] = 0.
+                verts, _, _ = deca.flame(shape_params=self.shape, expression_params=codedict['exp'], pose_params=canonical_pose)
+                normals = util.vertex_normals(verts, deca.render.faces.expand(verts.shape[0], -1, -1))
+                self.uv_z = deca.D_detail(torch.cat([condict['pose'][:,3:], condict['exp'], self.detail_code], dim=1))
+                self.canonical_detail_normals = deca.displacement2normal(self.uv_z, verts, normals)
+            self.detail_inputs = detail_inputs.clone()
+        # global pose is a rigid rotation of the whole mesh (no pose correctives on the root joint)
+        R = batch_rodrigues(codedict['pose'][:,:3])
+        uv_detail_normals = torch.einsum('bij,bjhw->bihw', R, self.canonical_detail_normals)
+        return self.uv_z, uv_detail_normals
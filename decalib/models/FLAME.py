@@ -17,6 +17,10 @@ import torch
 import torch.nn as nn
 import numpy as np
 import pickle
+import struct
+import zipfile
+import hashlib
+from collections import OrderedDict
 import torch.nn.functional as F
 
 from .lbs import lbs, batch_rodrigues, vertices2landmarks, rot_mat_to_euler
@@ -215,6 +219,31 @@ class FLAME(nn.Module):
                                        self.full_lmk_bary_coords.repeat(bz, 1, 1))
         return vertices, landmarks2d, landmarks3d
 
+def load_npz_array(npz_path, key, mmap_mode='r'):
+    ''' Load one array from a .npz archive without reading the whole archive into memory.
+    Members stored without compression (np.savez) are memory-mapped in place,
+    compressed members (np.savez_compressed) fall back to a regular load.
+    '''
+    member = key + '.npy'
+    with zipfile.ZipFile(npz_path) as archive:
+        info = archive.getinfo(member)
+    if mmap_mode is None or info.compress_type != zipfile.ZIP_STORED:
+        return np.load(npz_path)[key]
+    with open(npz_path, 'rb') as f:
+        # local file header: 30 bytes + file name + extra field
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    order = 'F' if fortran_order else 'C'
+    return np.memmap(npz_path, dtype=dtype, mode=mmap_mode, shape=shape, order=order, offset=offset)
+
 class FLAMETex(nn.Module):
     """
     FLAME texture:
@@ -224,41 +253,92 @@ class FLAMETex(nn.Module):
     """
     def __init__(self, config):
         super(FLAMETex, self).__init__()
+        mmap_mode = 'r' if config.tex_mmap else None
         if config.tex_type == 'BFM':
             mu_key = 'MU'
             pc_key = 'PC'
             n_pc = 199
             tex_path = config.tex_path
-            tex_space = np.load(tex_path)
-            texture_mean = tex_space[mu_key].reshape(1, -1)
-            texture_basis = tex_space[pc_key].reshape(-1, n_pc)
-
+            tex_scale = 1.
         elif config.tex_type == 'FLAME':
             mu_key = 'mean'
             pc_key = 'tex_dir'
             n_pc = 200
             tex_path = config.flame_tex_path
-            tex_space = np.load(tex_path)
-            texture_mean = tex_space[mu_key].reshape(1, -1)/255.
-            texture_basis = tex_space[pc_key].reshape(-1, n_pc)/255.
+            tex_scale = 1./255.
         else:
             print('texture type ', config.tex_type, 'not exist!')
             raise NotImplementedError
+        texture_mean = load_npz_array(tex_path, mu_key, mmap_mode).reshape(-1)
+        texture_basis = load_npz_array(tex_path, pc_key, mmap_mode).reshape(-1, n_pc)
 
+        # texture space is stored as [512, 512, 3] (bgr), flattened.
+        # only the rows needed for the output resolution are gathered, already in [3, h, w] rgb order,
+        # so the full basis never has to be resident and forward is a single matmul
         n_tex = config.n_tex
-        num_components = texture_basis.shape[1]
-        texture_mean = torch.from_numpy(texture_mean).float()[None,...]
-        texture_basis = torch.from_numpy(texture_basis[:,:n_tex]).float()[None,...]
-        self.register_buffer('texture_mean', texture_mean)
-        self.register_buffer('texture_basis', texture_basis)
+        full_size = 512
+        self.uv_size = config.uv_size
+        self.tex_size = self.uv_size if config.tex_downsample else full_size
+        # same sampling as F.interpolate(mode='nearest'), which is linear, so it commutes with the basis sum
+        coords = (np.arange(self.tex_size)*full_size/self.tex_size).astype(np.int64)
+        pixel_ids = coords[:,None]*full_size + coords[None,:]
+        row_ids = (pixel_ids[None,:,:]*3 + np.array([2,1,0])[:,None,None]).reshape(-1)
+
+        texture_mean = torch.from_numpy(np.asarray(texture_mean[row_ids], dtype=np.float32)*tex_scale)
+        texture_basis = torch.from_numpy(np.asarray(texture_basis[row_ids, :n_tex], dtype=np.float32)*tex_scale)
+        self.register_buffer('texture_mean', texture_mean)      # [3*h*w]
+        self.register_buffer('texture_basis', texture_basis)    # [3*h*w, n_tex]
+
+        # lru cache of decoded textures, keyed by the tex code of one sample
+        self.cache_size = config.tex_cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def cache_key(self, code):
+        code = code.detach().float().cpu().numpy()
+        return hashlib.sha1(code.tobytes()).hexdigest()
+
+    def decode(self, texcode):
+        texture = F.linear(texcode, self.texture_basis, self.texture_mean)
+        texture = texture.reshape(texcode.shape[0], 3, self.tex_size, self.tex_size)
+        if self.tex_size != self.uv_size:
+            texture = F.interpolate(texture, [self.uv_size, self.uv_size])
+        return texture
+
+    def cached_decode(self, texcode):
+        ''' decode only the tex codes that are not in the cache, e.g. the same identity
+        re-rendered with different pose/expression
+        '''
+        keys = [self.cache_key(code) for code in texcode]
+        missing = [i for i, key in enumerate(keys) if key not in self.cache]
+        self.cache_misses += len(missing)
+        self.cache_hits += len(keys) - len(missing)
+        textures = {}
+        if len(missing) > 0:
+            new_textures = self.decode(texcode[missing]).detach()
+            for i, texture in zip(missing, new_textures):
+                textures[keys[i]] = texture
+                self.cache[keys[i]] = texture
+        for key in keys:
+            if key not in textures:
+                textures[key] = self.cache[key]
+            self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return torch.stack([textures[key] for key in keys])
 
     def forward(self, texcode):
         '''
         texcode: [batchsize, n_tex]
-        texture: [bz, 3, 256, 256], range: 0-1
+        texture: [bz, 3, uv_size, uv_size], range: 0-1
         '''
-        texture = self.texture_mean + (self.texture_basis*texcode[:,None,:]).sum(-1)
-        texture = texture.reshape(texcode.shape[0], 512, 512, 3).permute(0,3,1,2)
-        texture = F.interpolate(texture, [256, 256])
-        texture = texture[:,[2,1,0], :,:]
-        return texture
\ No newline at end of file
+        # cached textures carry no graph, only use the cache when no gradient is needed
+        if self.cache_size > 0 and not (torch.is_grad_enabled() and texcode.requires_grad):
+            return self.cached_decode(texcode)
+        return self.decode(texcode)
@@ -15,11 +15,14 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 class Generator(nn.Module):
-    def __init__(self, latent_dim=100, out_channels=1, out_scale=0.01, sample_mode = 'bilinear'):
+    def __init__(self, latent_dim=100, out_channels=1, out_scale=0.01, sample_mode = 'bilinear', out_size=256):
         super(Generator, self).__init__()
         self.out_scale = out_scale
+        self.out_size = out_size # the conv blocks output 256x256, larger sizes are upsampled
+        self.sample_mode = sample_mode
         
         self.init_size = 32 // 4  # Initial size before upsampling
         self.l1 = nn.Sequential(nn.Linear(latent_dim, 128 * self.init_size ** 2))
@@ -53,4 +56,6 @@ class Generator(nn.Module):
         out = self.l1(noise)
         out = out.view(out.shape[0], 128, self.init_size, self.init_size)
         img = self.conv_blocks(out)
+        if img.shape[-1] != self.out_size:
+            img = F.interpolate(img, [self.out_size, self.out_size], mode=self.sample_mode, align_corners=False)
         return img*self.out_scale
\ No newline at end of file
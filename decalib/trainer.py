@@ -14,11 +14,13 @@
 # For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
 
 import os, sys
+import contextlib
 import torch
 import torchvision
 import torch.nn.functional as F
 import torch.nn as nn
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.utils.data import DataLoader, IterableDataset, DistributedSampler
 import numpy as np
 from time import time
 from skimage.io import imread
@@ -38,7 +40,12 @@ from .datasets import datasets
 from .utils.config import cfg
 torch.backends.cudnn.benchmark = True
 from .utils import lossfunc
+from .utils.tensor_cropper import Cropper
+from .utils.checkpoint import CheckpointWriter, to_cpu
+from .utils.background import BackgroundWorker
+from .utils.now_eval import NoWEvaluator
 from .datasets import build_datasets
+from .datasets.feature_cache import FeatureCache
 
 class Trainer(object):
     def __init__(self, model, config=None, device='cuda:0'):
@@ -47,10 +54,21 @@ class Trainer(object):
         else:
             self.cfg = config
         self.device = device
+        # distributed data parallel (torchrun): one process per device, each trains on its own part of the data
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        self.is_main = self.rank == 0
+        # batch size per process and micro-batch, gradients are accumulated over accum_steps micro-batches
         self.batch_size = self.cfg.dataset.batch_size
+        self.accum_steps = self.cfg.train.accum_steps
         self.image_size = self.cfg.dataset.image_size
         self.uv_size = self.cfg.model.uv_size
         self.K = self.cfg.dataset.K
+        # mixed precision, autocast/GradScaler are no-ops when disabled
+        self.amp = self.cfg.train.amp and 'cuda' in str(device)
+        # random crop of the loose crops returned by datasets with crop_on_device
+        self.cropper = Cropper(self.image_size, scale=[self.cfg.dataset.scale_min, self.cfg.dataset.scale_max], trans_scale=self.cfg.dataset.trans_scale)
         # training stage: coarse and detail
         self.train_detail = self.cfg.train.train_detail
 
@@ -58,21 +76,35 @@ class Trainer(object):
         self.deca = model.to(self.device)
         self.configure_optimizers()
         self.load_checkpoint()
+        if self.distributed:
+            self.wrap_ddp()
 
         # initialize loss  
         # # initialize loss   
         if self.train_detail:     
-            self.mrf_loss = lossfunc.IDMRFLoss()
+            self.mrf_loss = lossfunc.IDMRFLoss(chunk_size=self.cfg.loss.mrf_chunk_size).to(self.device)
             self.face_attr_mask = util.load_local_mask(image_size=self.cfg.model.uv_size, mode='bbx')
         else:
-            self.id_loss = lossfunc.VGGFace2Loss(pretrained_model=self.cfg.model.fr_model_path)      
+            self.id_loss = lossfunc.VGGFace2Loss(pretrained_model=self.cfg.model.fr_model_path).to(self.device)
+            # identity features of the real images, filled during the first epoch or precomputed
+            self.id_feature_cache = FeatureCache(self.cfg.loss.id_feature_cache) if self.cfg.loss.id_feature_cache else None
         
+        # only rank 0 logs, visualizes, evaluates and saves checkpoints
+        if not self.is_main:
+            # other ranks only report warnings and errors
+            logger.remove()
+            logger.add(sys.stderr, level='WARNING')
+            return
         logger.add(os.path.join(self.cfg.output_dir, self.cfg.train.log_dir, 'train.log'))
+        self.checkpoint_writer = CheckpointWriter(keep_last=self.cfg.train.keep_checkpoints, async_write=self.cfg.train.async_checkpoint)
+        # visualization, validation images and evaluation results are written off the training thread
+        self.background = BackgroundWorker(enabled=self.cfg.train.async_vis)
         if self.cfg.train.write_summary:
             from torch.utils.tensorboard import SummaryWriter
             self.writer = SummaryWriter(log_dir=os.path.join(self.cfg.output_dir, self.cfg.train.log_dir))
     
     def configure_optimizers(self):
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp)
         if self.train_detail:
             self.opt = torch.optim.Adam(
                                 list(self.deca.E_detail.parameters()) + \
@@ -89,39 +121,77 @@ class Trainer(object):
         # resume training, including model weight, opt, steps
         # import ipdb; ipdb.set_trace()
         if self.cfg.train.resume and os.path.exists(os.path.join(self.cfg.output_dir, 'model.tar')):
-            checkpoint = torch.load(os.path.join(self.cfg.output_dir, 'model.tar'))
+            checkpoint = torch.load(os.path.join(self.cfg.output_dir, 'model.tar'), map_location=self.device)
             for key in model_dict.keys():
                 if key in checkpoint.keys():
                     util.copy_state_dict(model_dict[key], checkpoint[key])
             util.copy_state_dict(self.opt.state_dict(), checkpoint['opt'])
+            if 'scaler' in checkpoint.keys():
+                self.scaler.load_state_dict(checkpoint['scaler'])
             self.global_step = checkpoint['global_step']
             logger.info(f"resume training from {os.path.join(self.cfg.output_dir, 'model.tar')}")
             logger.info(f"training start from step {self.global_step}")
         # load model weights only
         elif os.path.exists(self.cfg.pretrained_modelpath):
-            checkpoint = torch.load(self.cfg.pretrained_modelpath)
+            checkpoint = torch.load(self.cfg.pretrained_modelpath, map_location=self.device)
             key = 'E_flame'
             util.copy_state_dict(model_dict[key], checkpoint[key])
             self.global_step = 0
         else:
             logger.info('model path not found, start training from scratch')
             self.global_step = 0
+        if self.distributed:
+            # every process resumes from the step of rank 0
+            global_step = torch.tensor([self.global_step], device=self.device)
+            dist.broadcast(global_step, src=0)
+            self.global_step = int(global_step.item())
+
+    def wrap_ddp(self):
+        ''' wrap the trained networks in DistributedDataParallel, the weights of rank 0 are broadcast to all processes
+        and gradients are averaged in backward. DECA.model_dict saves the unwrapped weights
+        '''
+        from torch.nn.parallel import DistributedDataParallel
+        device_ids = [torch.device(self.device)] if 'cuda' in str(self.device) else None
+        names = ['E_detail', 'D_detail'] if self.train_detail else ['E_flame']
+        for name in names:
+            # no buffer broadcast in forward, rank 0 alone runs visualization/validation through the same modules
+            setattr(self.deca, name, DistributedDataParallel(getattr(self.deca, name), device_ids=device_ids, broadcast_buffers=False))
+
+    def crop_batch(self, batch):
+        ''' random scale/translation crop of a batch of uint8 loose crops, on device
+        return: images [BxK, 3, size, size], landmarks [BxK, 68, 3] normalized to [-1, 1], masks [BxK, size, size]
+        '''
+        images = batch['image'].to(self.device, non_blocking=True); images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1])
+        masks = batch['mask'].to(self.device, non_blocking=True); masks = masks.view(-1, 1, images.shape[-2], images.shape[-1])
+        lmk = batch['landmark'].to(self.device); lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
+        bbox = batch['bbox'].to(self.device); bbox = bbox.view(-1, 3)
+        # image and mask are warped together
+        stacked = torch.cat([images, masks], dim=1).float()/255.
+        cropped, tform = self.cropper.crop_bbox(stacked, bbox[:,:2], bbox[:,2:])
+        lmk = self.cropper.transform_points(lmk, tform)
+        return cropped[:,:3], lmk, cropped[:,3]
 
     def training_step(self, batch, batch_nb, training_type='coarse'):
         self.deca.train()
         if self.train_detail:
             self.deca.E_flame.eval()
         # [B, K, 3, size, size] ==> [BxK, 3, size, size]
-        images = batch['image'].to(self.device); images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1]) 
-        lmk = batch['landmark'].to(self.device); lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
-        masks = batch['mask'].to(self.device); masks = masks.view(-1, images.shape[-2], images.shape[-1]) 
+        if 'bbox' in batch:
+            images, lmk, masks = self.crop_batch(batch)
+        else:
+            images = batch['image'].to(self.device); images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1]) 
+            lmk = batch['landmark'].to(self.device); lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
+            masks = batch['mask'].to(self.device); masks = masks.view(-1, images.shape[-2], images.shape[-1]) 
 
         #-- encoder
-        codedict = self.deca.encode(images, use_detail=self.train_detail)
+        with torch.autocast('cuda', enabled=self.amp):
+            codedict = self.deca.encode(images, use_detail=self.train_detail)
         
         ### shape constraints for coarse model
         ### detail consistency for detail model
         # import ipdb; ipdb.set_trace()
+        # number of input images, with consistency the batch is doubled and the second half repeats them
+        n_unique = images.shape[0]
         if self.cfg.loss.shape_consistency or self.cfg.loss.detail_consistency:
             '''
             make sure s0, s1 is something to make shape close
@@ -132,16 +202,15 @@ class Trainer(object):
             new_order = new_order.flatten()
             shapecode = codedict['shape']
             if self.train_detail:
+                # the second half only differs in the permuted detail code, the coarse codes are not doubled,
+                # FLAME, rendering and texture extraction are computed once in the detail branch
                 detailcode = codedict['detail']
                 detailcode_new = detailcode[new_order]
                 codedict['detail'] = torch.cat([detailcode, detailcode_new], dim=0)
-                codedict['shape'] = torch.cat([shapecode, shapecode], dim=0)
             else:
+                # the second half only differs in the permuted shape code, the other codes are not doubled before decoding,
+                # albedo is computed once and only FLAME and rendering are rerun for the new shapes in the coarse branch
                 shapecode_new = shapecode[new_order]
-                codedict['shape'] = torch.cat([shapecode, shapecode_new], dim=0)
-            for key in ['tex', 'exp', 'pose', 'cam', 'light', 'images']:
-                code = codedict[key]
-                codedict[key] = torch.cat([code, code], dim=0)
             ## append gt
             images = torch.cat([images, images], dim=0)# images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1]) 
             lmk = torch.cat([lmk, lmk], dim=0) #lmk = lmk.view(-1, lmk.shape[-2], lmk.shape[-1])
@@ -154,6 +223,27 @@ class Trainer(object):
             #-- decoder
             rendering = True if self.cfg.loss.photo>0 else False
             opdict = self.deca.decode(codedict, rendering = rendering, vis_lmk=False, return_vis=False, use_detail=False)
+            if batch_size > n_unique:
+                # shape consistency: permuted shapes with the expression, pose, camera and albedo of the first half
+                verts, landmarks2d, landmarks3d = self.deca.flame(shape_params=shapecode_new, expression_params=codedict['exp'], pose_params=codedict['pose'])
+                opdict_new = {'verts': verts, 'landmarks3d_world': landmarks3d.clone()}
+                landmarks2d = util.batch_orth_proj(landmarks2d, codedict['cam'])[:,:,:2]; landmarks2d[:,:,1:] = -landmarks2d[:,:,1:]
+                landmarks3d = util.batch_orth_proj(landmarks3d, codedict['cam']); landmarks3d[:,:,1:] = -landmarks3d[:,:,1:]
+                trans_verts = util.batch_orth_proj(verts, codedict['cam']); trans_verts[:,:,1:] = -trans_verts[:,:,1:]
+                opdict_new.update({'trans_verts': trans_verts, 'landmarks2d': landmarks2d, 'landmarks3d': landmarks3d})
+                if rendering:
+                    albedo = opdict['albedo'] if 'albedo' in opdict else torch.zeros([n_unique, 3, self.deca.uv_size, self.deca.uv_size], device=images.device)
+                    ops = self.deca.render(verts, trans_verts, albedo, h=self.deca.image_size, w=self.deca.image_size)
+                    opdict_new.update({'grid': ops['grid'], 'rendered_images': ops['images'], 'alpha_images': ops['alpha_images'], 'normal_images': ops['normal_images']})
+                if 'albedo' in opdict:
+                    opdict_new['albedo'] = opdict['albedo']
+                for key in opdict_new:
+                    opdict[key] = torch.cat([opdict[key], opdict_new[key]], dim=0)
+                # the losses and regularizations see both halves
+                codedict['shape'] = torch.cat([shapecode, shapecode_new], dim=0)
+                for key in ['tex', 'exp', 'pose', 'cam', 'light', 'images']:
+                    code = codedict[key]
+                    codedict[key] = torch.cat([code, code], dim=0)
             opdict['images'] = images
             opdict['lmk'] = lmk
 
@@ -190,7 +280,12 @@ class Trainer(object):
                 shading_images = self.deca.render.add_SHlight(opdict['normal_images'], codedict['light'].detach())
                 albedo_images = F.grid_sample(opdict['albedo'].detach(), opdict['grid'], align_corners=False)
                 overlay = albedo_images*shading_images*mask_face_eye + images*(1-mask_face_eye)
-                losses['identity'] = self.id_loss(overlay, images) * self.cfg.loss.id
+                tar_features = None
+                if self.id_feature_cache is not None and 'image_id' in batch:
+                    tar_features = self.cached_id_features(batch['image_id'], images[:n_unique])
+                with torch.autocast('cuda', enabled=self.amp):
+                    # features of the repeated input images are only computed once
+                    losses['identity'] = self.id_loss(overlay, images[:n_unique], tar_features=tar_features) * self.cfg.loss.id
             
             losses['shape_reg'] = (torch.sum(codedict['shape']**2)/2)*self.cfg.loss.reg_shape
             losses['expression_reg'] = (torch.sum(codedict['exp']**2)/2)*self.cfg.loss.reg_exp
@@ -213,6 +308,11 @@ class Trainer(object):
             detailcode = codedict['detail']
             cam = codedict['cam']
 
+            # FLAME, rendering and texture extraction only depend on the coarse codes, with detail consistency
+            # they are computed for the n_unique images and repeated for the permuted detail codes
+            n_rep = detailcode.shape[0]//n_unique
+            repeat = lambda x: x.repeat(n_rep, *[1]*(x.dim()-1))
+
             # FLAME - world space
             verts, landmarks2d, landmarks3d = self.deca.flame(shape_params=shapecode, expression_params=expcode, pose_params=posecode)
             landmarks2d = util.batch_orth_proj(landmarks2d, codedict['cam'])[:,:,:2]; landmarks2d[:,:,1:] = -landmarks2d[:,:,1:] #; landmarks2d = landmarks2d*self.image_size/2 + self.image_size/2
@@ -228,29 +328,36 @@ class Trainer(object):
             #------ rendering
             ops = self.deca.render(verts, trans_verts, albedo, lightcode) 
             # mask
-            mask_face_eye = F.grid_sample(self.deca.uv_face_eye_mask.expand(batch_size,-1,-1,-1), ops['grid'].detach(), align_corners=False)
+            mask_face_eye = F.grid_sample(self.deca.uv_face_eye_mask.expand(n_unique,-1,-1,-1), ops['grid'].detach(), align_corners=False)
             # images
             predicted_images = ops['images']*mask_face_eye*ops['alpha_images']
 
             masks = masks[:,None,:,:]
 
-            uv_z = self.deca.D_detail(torch.cat([posecode[:,3:], expcode, detailcode], dim=1))
-            # render detail
-            uv_detail_normals = self.deca.displacement2normal(uv_z, verts, ops['normals'])
-            uv_shading = self.deca.render.add_SHlight(uv_detail_normals, lightcode.detach())
-            uv_texture = albedo.detach()*uv_shading
-            predicted_detail_images = F.grid_sample(uv_texture, ops['grid'].detach(), align_corners=False)
-
             #--- extract texture
             uv_pverts = self.deca.render.world2uv(trans_verts).detach()
-            uv_gt = F.grid_sample(torch.cat([images, masks], dim=1), uv_pverts.permute(0,2,3,1)[:,:,:,:2], mode='bilinear', align_corners=False)
+            uv_gt = F.grid_sample(torch.cat([images[:n_unique], masks[:n_unique]], dim=1), uv_pverts.permute(0,2,3,1)[:,:,:,:2], mode='bilinear', align_corners=False)
             uv_texture_gt = uv_gt[:,:3,:,:].detach(); uv_mask_gt = uv_gt[:,3:,:,:].detach()
             # self-occlusion
-            normals = util.vertex_normals(trans_verts, self.deca.render.faces.expand(batch_size, -1, -1))
+            normals = util.vertex_normals(trans_verts, self.deca.render.faces.expand(n_unique, -1, -1))
             uv_pnorm = self.deca.render.world2uv(normals)
             uv_mask = (uv_pnorm[:,[-1],:,:] < -0.05).float().detach()
             ## combine masks
             uv_vis_mask = uv_mask_gt*uv_mask*self.deca.uv_face_eye_mask
+
+            if n_rep > 1:
+                posecode, expcode, lightcode, albedo = repeat(posecode), repeat(expcode), repeat(lightcode), repeat(albedo)
+                verts, trans_verts, landmarks2d, predicted_images = repeat(verts), repeat(trans_verts), repeat(landmarks2d), repeat(predicted_images)
+                ops['normals'], ops['grid'] = repeat(ops['normals']), repeat(ops['grid'])
+                uv_texture_gt, uv_vis_mask = repeat(uv_texture_gt), repeat(uv_vis_mask)
+
+            with torch.autocast('cuda', enabled=self.amp):
+                uv_z = self.deca.D_detail(torch.cat([posecode[:,3:], expcode, detailcode], dim=1)).float()
+            # render detail
+            uv_detail_normals = self.deca.displacement2normal(uv_z, verts, ops['normals'])
+            uv_shading = self.deca.render.add_SHlight(uv_detail_normals, lightcode.detach())
+            uv_texture = albedo.detach()*uv_shading
+            predicted_detail_images = F.grid_sample(uv_texture, ops['grid'].detach(), align_corners=False)
             
             #### ----------------------- Losses
             losses = {}
@@ -268,7 +375,8 @@ class Trainer(object):
             uv_vis_mask_patch = F.interpolate(uv_vis_mask[:, :, self.face_attr_mask[pi][2]:self.face_attr_mask[pi][3], self.face_attr_mask[pi][0]:self.face_attr_mask[pi][1]], [new_size, new_size], mode='bilinear')
             
             losses['photo_detail'] = (uv_texture_patch*uv_vis_mask_patch - uv_texture_gt_patch*uv_vis_mask_patch).abs().mean()*self.cfg.loss.photo_D
-            losses['photo_detail_mrf'] = self.mrf_loss(uv_texture_patch*uv_vis_mask_patch, uv_texture_gt_patch*uv_vis_mask_patch)*self.cfg.loss.photo_D*self.cfg.loss.mrf
+            with torch.autocast('cuda', enabled=self.amp):
+                losses['photo_detail_mrf'] = self.mrf_loss(uv_texture_patch*uv_vis_mask_patch, uv_texture_gt_patch*uv_vis_mask_patch)*self.cfg.loss.photo_D*self.cfg.loss.mrf
 
             losses['z_reg'] = torch.mean(uv_z.abs())*self.cfg.loss.reg_z
             losses['z_diff'] = lossfunc.shading_smooth_loss(uv_shading)*self.cfg.loss.reg_diff
@@ -292,6 +400,53 @@ class Trainer(object):
             all_loss = all_loss + losses[key]
         losses['all_loss'] = all_loss
         return losses, opdict
+
+    def cached_id_features(self, image_ids, images):
+        ''' identity features of the real images from the feature cache, missing ones are computed and added
+        '''
+        ids = image_ids.view(-1).tolist()
+        cached = self.id_feature_cache.get_many(ids)
+        missing = [i for i, key in enumerate(ids) if key not in cached]
+        if len(missing) > 0:
+            with torch.no_grad(), torch.autocast('cuda', enabled=self.amp):
+                features = self.id_loss.target_features(images[missing]).float().cpu().numpy()
+            self.id_feature_cache.put_many([ids[i] for i in missing], features)
+            for i, feature in zip(missing, features):
+                cached[ids[i]] = feature
+        return torch.from_numpy(np.stack([cached[key] for key in ids])).to(self.device)
+
+    def backward(self, all_loss):
+        ''' accumulate the gradients of one micro-batch, the loss is averaged over the accum_steps micro-batches
+        and scaled under amp
+        '''
+        self.scaler.scale(all_loss/self.accum_steps).backward()
+
+    def optimizer_step(self):
+        ''' update with the accumulated gradients, under amp steps with inf/nan gradients are skipped
+        '''
+        self.scaler.step(self.opt)
+        self.scaler.update()
+        self.opt.zero_grad()
+
+    def no_sync(self, skip):
+        ''' with ddp, skip the gradient all-reduce for all but the last micro-batch
+        '''
+        stack = contextlib.ExitStack()
+        if skip and self.distributed:
+            for module in [self.deca.E_flame, self.deca.E_detail, self.deca.D_detail]:
+                if hasattr(module, 'no_sync'):
+                    stack.enter_context(module.no_sync())
+        return stack
+
+    def next_batch(self, epoch):
+        try:
+            batch = next(self.train_iter)
+        except:
+            if self.train_sampler is not None:
+                self.train_sampler.set_epoch(epoch)
+            self.train_iter = iter(self.train_dataloader)
+            batch = next(self.train_iter)
+        return batch
         
     def validation_step(self):
         self.deca.eval()
@@ -303,71 +458,88 @@ class Trainer(object):
         images = batch['image'].to(self.device); images = images.view(-1, images.shape[-3], images.shape[-2], images.shape[-1]) 
         with torch.no_grad():
             codedict = self.deca.encode(images)
-            opdict, visdict = self.deca.decode(codedict)
-        savepath = os.path.join(self.cfg.output_dir, self.cfg.train.val_vis_dir, f'{self.global_step:08}.jpg')
-        grid_image = util.visualize_grid(visdict, savepath, return_gird=True)
-        self.writer.add_image('val_images', (grid_image/255.).astype(np.float32).transpose(2,0,1), self.global_step)
+            opdict, visdict = self.deca.decode(codedict, draw_landmarks=False)
+        landmarks = {'landmarks2d': opdict['landmarks2d'], 'landmarks3d': opdict['landmarks3d']}
+        self.background.submit(self.write_val_images, to_cpu(visdict), to_cpu(landmarks), self.global_step)
         self.deca.train()
 
+    def draw_landmarks(self, visdict, landmarks):
+        ''' landmark images after the inputs, the order of the grid rows
+        '''
+        out = {'inputs': visdict['inputs']}
+        for key in landmarks:
+            out[key] = util.tensor_vis_landmarks(visdict['inputs'], landmarks[key], isScale=True)
+        for key in visdict:
+            if key != 'inputs':
+                out[key] = visdict[key]
+        return out
+
+    def write_train_images(self, visdict, landmarks, global_step):
+        visdict = self.draw_landmarks(visdict, landmarks)
+        savepath = os.path.join(self.cfg.output_dir, self.cfg.train.vis_dir, f'{global_step:06}.jpg')
+        grid_image = util.visualize_grid(visdict, savepath, return_gird=True)
+        self.writer.add_image('train_images', (grid_image/255.).astype(np.float32).transpose(2,0,1), global_step)
+
+    def write_val_images(self, visdict, landmarks, global_step):
+        visdict = self.draw_landmarks(visdict, landmarks)
+        savepath = os.path.join(self.cfg.output_dir, self.cfg.train.val_vis_dir, f'{global_step:08}.jpg')
+        grid_image = util.visualize_grid(visdict, savepath, return_gird=True)
+        self.writer.add_image('val_images', (grid_image/255.).astype(np.float32).transpose(2,0,1), global_step)
+
     def evaluate(self):
         ''' NOW validation 
         '''
-        os.makedirs(os.path.join(self.cfg.output_dir, 'NOW_validation'), exist_ok=True)
         savefolder = os.path.join(self.cfg.output_dir, 'NOW_validation', f'step_{self.global_step:08}') 
         os.makedirs(savefolder, exist_ok=True)
         self.deca.eval()
-        # run now validation images
-        from .datasets.now import NoWDataset
-        dataset = NoWDataset(scale=(self.cfg.dataset.scale_min + self.cfg.dataset.scale_max)/2)
-        dataloader = DataLoader(dataset, batch_size=8, shuffle=False,
-                            num_workers=8,
-                            pin_memory=True,
-                            drop_last=False)
-        faces = self.deca.flame.faces_tensor.cpu().numpy()
-        for i, batch in enumerate(tqdm(dataloader, desc='now evaluation ')):
-            images = batch['image'].to(self.device)
-            imagename = batch['imagename']
-            with torch.no_grad():
-                codedict = self.deca.encode(images)
-                _, visdict = self.deca.decode(codedict)
-                codedict['exp'][:] = 0.
-                codedict['pose'][:] = 0.
-                opdict, _ = self.deca.decode(codedict)
-            #-- save results for evaluation
-            verts = opdict['verts'].cpu().numpy()
-            landmark_51 = opdict['landmarks3d_world'][:, 17:]
-            landmark_7 = landmark_51[:,[19, 22, 25, 28, 16, 31, 37]]
-            landmark_7 = landmark_7.cpu().numpy()
-            for k in range(images.shape[0]):
-                os.makedirs(os.path.join(savefolder, imagename[k]), exist_ok=True)
-                # save mesh
-                util.write_obj(os.path.join(savefolder, f'{imagename[k]}.obj'), vertices=verts[k], faces=faces)
-                # save 7 landmarks for alignment
-                np.save(os.path.join(savefolder, f'{imagename[k]}.npy'), landmark_7[k])
-                for vis_name in visdict.keys(): #['inputs', 'landmarks2d', 'shape_images']:
-                    if vis_name not in visdict.keys():
-                        continue
-                    # import ipdb; ipdb.set_trace()
-                    image = util.tensor2image(visdict[vis_name][k])
-                    name = imagename[k].split('/')[-1]
-                    # print(os.path.join(savefolder, imagename[k], name + '_' + vis_name +'.jpg'))
-                    cv2.imwrite(os.path.join(savefolder, imagename[k], name + '_' + vis_name +'.jpg'), image)
-            # visualize results to check
-            util.visualize_grid(visdict, os.path.join(savefolder, f'{i}.jpg'))
-
-        ## then please run main.py in https://github.com/soubhiksanyal/now_evaluation, it will take around 30min to get the metric results
+        vis_fn = None
+        if self.cfg.train.eval_vis:
+            def vis_fn(imagename, visdict, landmarks, i):
+                self.background.submit(self.write_now_images, savefolder, imagename, to_cpu(visdict), to_cpu(landmarks), i)
+        # meshes and landmarks are written, and the errors computed, by a process pool
+        evaluator = NoWEvaluator(self.deca, device=self.device, folder=self.cfg.train.now_dir or None,
+                                 scale=(self.cfg.dataset.scale_min + self.cfg.dataset.scale_max)/2,
+                                 processes=self.cfg.train.eval_processes, mesh_format=self.cfg.train.eval_mesh_format)
+        try:
+            metrics = evaluator.run(savefolder, vis_fn=vis_fn)
+        except Exception:
+            # a failed evaluation is logged, training goes on
+            logger.exception(f'NoW evaluation at step {self.global_step} failed')
+            metrics = {}
+        if len(metrics) > 0:
+            logger.info('NoW validation: ' + ', '.join([f'{k}: {v:.4f}' for k, v in metrics.items()]))
+            if self.cfg.train.write_summary:
+                for k, v in metrics.items():
+                    self.writer.add_scalar('now_error/'+k, v, global_step=self.global_step)
         self.deca.train()
 
+    def write_now_images(self, savefolder, imagename, visdict, landmarks, i):
+        visdict = self.draw_landmarks(visdict, landmarks)
+        for k in range(visdict['inputs'].shape[0]):
+            os.makedirs(os.path.join(savefolder, imagename[k]), exist_ok=True)
+            for vis_name in visdict.keys(): #['inputs', 'landmarks2d', 'shape_images']:
+                image = util.tensor2image(visdict[vis_name][k])
+                name = imagename[k].split('/')[-1]
+                cv2.imwrite(os.path.join(savefolder, imagename[k], name + '_' + vis_name +'.jpg'), image)
+        # visualize results to check
+        util.visualize_grid(visdict, os.path.join(savefolder, f'{i}.jpg'))
+
     def prepare_data(self):
         self.train_dataset = build_datasets.build_train(self.cfg.dataset)
         self.val_dataset = build_datasets.build_val(self.cfg.dataset)
         logger.info('---- training data numbers: ', len(self.train_dataset))
 
-        self.train_dataloader = DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=True,
+        # sharded datasets are iterable, shuffle themselves and split their shards across processes
+        iterable = isinstance(self.train_dataset, IterableDataset)
+        self.train_sampler = DistributedSampler(self.train_dataset, shuffle=True) if self.distributed and not iterable else None
+        self.train_dataloader = DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=not iterable and self.train_sampler is None,
+                            sampler=self.train_sampler,
                             num_workers=self.cfg.dataset.num_workers,
                             pin_memory=True,
                             drop_last=True)
         self.train_iter = iter(self.train_dataloader)
+        if not self.is_main:
+            return
         self.val_dataloader = DataLoader(self.val_dataset, batch_size=8, shuffle=True,
                             num_workers=8,
                             pin_memory=True,
@@ -377,65 +549,81 @@ class Trainer(object):
     def fit(self):
         self.prepare_data()
 
-        iters_every_epoch = int(len(self.train_dataset)/self.batch_size)
+        iters_every_epoch = int(len(self.train_dataset)/(self.batch_size*self.world_size*self.accum_steps))
         start_epoch = self.global_step//iters_every_epoch
         for epoch in range(start_epoch, self.cfg.train.max_epochs):
             # for step, batch in enumerate(tqdm(self.train_dataloader, desc=f"Epoch: {epoch}/{self.cfg.train.max_epochs}")):
-            for step in tqdm(range(iters_every_epoch), desc=f"Epoch[{epoch+1}/{self.cfg.train.max_epochs}]"):
+            for step in tqdm(range(iters_every_epoch), desc=f"Epoch[{epoch+1}/{self.cfg.train.max_epochs}]", disable=not self.is_main):
                 if epoch*iters_every_epoch + step < self.global_step:
                     continue
-                try:
-                    batch = next(self.train_iter)
-                except:
-                    self.train_iter = iter(self.train_dataloader)
-                    batch = next(self.train_iter)
-                losses, opdict = self.training_step(batch, step)
-                if self.global_step % self.cfg.train.log_steps == 0:
+                # every micro-batch keeps its own K-image groups and shape/detail consistency shuffle,
+                # logged losses are averaged over the micro-batches, visualization is the last micro-batch
+                step_losses = {}
+                for micro_step in range(self.accum_steps):
+                    batch = self.next_batch(epoch)
+                    with self.no_sync(micro_step < self.accum_steps - 1):
+                        losses, opdict = self.training_step(batch, step)
+                        self.backward(losses['all_loss'])
+                    for k, v in losses.items():
+                        v = v.detach() if torch.is_tensor(v) else v
+                        step_losses[k] = step_losses.get(k, 0.) + v/self.accum_steps
+                losses = step_losses
+                # side jobs below see (and checkpoints save) the weights after this step
+                self.optimizer_step()
+                if self.is_main and self.global_step % self.cfg.train.log_steps == 0:
                     loss_info = f"ExpName: {self.cfg.exp_name} \nEpoch: {epoch}, Iter: {step}/{iters_every_epoch}, Time: {datetime.now().strftime('%Y-%m-%d-%H:%M:%S')} \n"
                     for k, v in losses.items():
                         loss_info = loss_info + f'{k}: {v:.4f}, '
                         if self.cfg.train.write_summary:
                             self.writer.add_scalar('train_loss/'+k, v, global_step=self.global_step)                    
+                    if self.amp and self.cfg.train.write_summary:
+                        self.writer.add_scalar('train/loss_scale', self.scaler.get_scale(), global_step=self.global_step)
                     logger.info(loss_info)
 
-                if self.global_step % self.cfg.train.vis_steps == 0:
+                if self.is_main and self.global_step % self.cfg.train.vis_steps == 0:
                     visind = list(range(8))
                     shape_images = self.deca.render.render_shape(opdict['verts'][visind], opdict['trans_verts'][visind])
+                    # landmarks are drawn, the grid written and logged by the background worker
                     visdict = {
                         'inputs': opdict['images'][visind], 
-                        'landmarks2d_gt': util.tensor_vis_landmarks(opdict['images'][visind], opdict['lmk'][visind], isScale=True),
-                        'landmarks2d': util.tensor_vis_landmarks(opdict['images'][visind], opdict['landmarks2d'][visind], isScale=True),
                         'shape_images': shape_images,
                     }
                     if 'predicted_images' in opdict.keys():
                         visdict['predicted_images'] = opdict['predicted_images'][visind]
                     if 'predicted_detail_images' in opdict.keys():
                         visdict['predicted_detail_images'] = opdict['predicted_detail_images'][visind]
+                    landmarks = {'landmarks2d_gt': opdict['lmk'][visind], 'landmarks2d': opdict['landmarks2d'][visind]}
+                    self.background.submit(self.write_train_images, to_cpu(visdict), to_cpu(landmarks), self.global_step)
 
-                    savepath = os.path.join(self.cfg.output_dir, self.cfg.train.vis_dir, f'{self.global_step:06}.jpg')
-                    grid_image = util.visualize_grid(visdict, savepath, return_gird=True)
-                    # import ipdb; ipdb.set_trace()                    
-                    self.writer.add_image('train_images', (grid_image/255.).astype(np.float32).transpose(2,0,1), self.global_step)
-
-                if self.global_step>0 and self.global_step % self.cfg.train.checkpoint_steps == 0:
+                if self.is_main and self.global_step>0 and self.global_step % self.cfg.train.checkpoint_steps == 0:
                     model_dict = self.deca.model_dict()
                     model_dict['opt'] = self.opt.state_dict()
-                    model_dict['global_step'] = self.global_step
+                    model_dict['scaler'] = self.scaler.state_dict()
+                    # the step is already applied, resume from the next one
+                    model_dict['global_step'] = self.global_step + 1
                     model_dict['batch_size'] = self.batch_size
-                    torch.save(model_dict, os.path.join(self.cfg.output_dir, 'model' + '.tar'))   
+                    # cpu snapshot, written by the checkpoint thread while training continues
+                    model_dict = to_cpu(model_dict)
+                    self.checkpoint_writer.save(model_dict, os.path.join(self.cfg.output_dir, 'model' + '.tar'))
                     # 
-                    if self.global_step % self.cfg.train.checkpoint_steps*10 == 0:
-                        os.makedirs(os.path.join(self.cfg.output_dir, 'models'), exist_ok=True)
-                        torch.save(model_dict, os.path.join(self.cfg.output_dir, 'models', f'{self.global_step:08}.tar'))   
+                    if self.global_step % (self.cfg.train.checkpoint_steps*10) == 0:
+                        archive_path = os.path.join(self.cfg.output_dir, 'models', f'{self.global_step:08}.tar')
+                        if self.cfg.train.archive_format == 'bf16':
+                            # network weights only, enough for pretrained_modelpath or testing
+                            archive = {key: model_dict[key] for key in ['E_flame', 'E_detail', 'D_detail', 'global_step']}
+                            self.checkpoint_writer.save(archive, archive_path, dtype=torch.bfloat16, prune=True)
+                        else:
+                            self.checkpoint_writer.save(model_dict, archive_path, prune=True)
 
-                if self.global_step % self.cfg.train.val_steps == 0:
+                if self.is_main and self.global_step % self.cfg.train.val_steps == 0:
                     self.validation_step()
                 
-                if self.global_step % self.cfg.train.eval_steps == 0:
+                if self.is_main and self.global_step % self.cfg.train.eval_steps == 0:
                     self.evaluate()
 
-                all_loss = losses['all_loss']
-                self.opt.zero_grad(); all_loss.backward(); self.opt.step()
                 self.global_step += 1
                 if self.global_step > self.cfg.train.max_steps:
-                    break
\ No newline at end of file
+                    break
+        if self.is_main:
+            self.checkpoint_writer.close()
+            self.background.close()
\ No newline at end of file
@@ -0,0 +1,53 @@
+'''
+side jobs of the training loop (drawing landmarks, image grids, jpeg/obj files, tensorboard images) in a thread
+the training thread only copies the detached tensors to the cpu and queues the job
+'''
+import queue
+import threading
+from loguru import logger
+
+class BackgroundWorker(object):
+    def __init__(self, enabled=True, max_pending=4):
+        '''
+        enabled: False runs the jobs inline, in submit()
+        max_pending: queued jobs, submit() waits when the worker falls behind instead of piling up copies
+        '''
+        self.enabled = enabled
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        if enabled:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        ''' args should be cpu tensors/numpy arrays that are not modified afterwards
+        '''
+        if self.enabled:
+            self.queue.put((fn, args, kwargs))
+        else:
+            fn(*args, **kwargs)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            fn, args, kwargs = item
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                logger.error(f'background job {fn.__name__} failed: {e}')
+            self.queue.task_done()
+
+    def wait(self):
+        ''' wait until the queued jobs are done
+        '''
+        if self.enabled:
+            self.queue.join()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,88 @@
+'''
+checkpoint writing off the training thread
+the state is snapshotted to the cpu on the training thread (to_cpu), a background thread writes it
+to a temporary file and renames it, so an interrupted write never leaves a truncated checkpoint
+'''
+import os
+import queue
+import threading
+import torch
+from loguru import logger
+
+def to_cpu(state, dtype=None):
+    ''' copy of a (nested) state dict on the cpu
+    dtype: floating point tensors are cast to it, e.g. torch.bfloat16 for archives
+    '''
+    if torch.is_tensor(state):
+        state = state.detach().to('cpu', copy=True)
+        if dtype is not None and state.is_floating_point():
+            state = state.to(dtype)
+        return state
+    if isinstance(state, dict):
+        return {key: to_cpu(value, dtype) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)([to_cpu(value, dtype) for value in state])
+    return state
+
+def save_atomic(state, path):
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+class CheckpointWriter(object):
+    def __init__(self, keep_last=0, async_write=True):
+        '''
+        keep_last: number of checkpoints kept in folders written with prune=True, 0 keeps all
+        async_write: write from a background thread, otherwise save() blocks until written
+        '''
+        self.keep_last = keep_last
+        self.async_write = async_write
+        # at most two pending checkpoints, training waits instead of piling up cpu copies
+        self.queue = queue.Queue(maxsize=2)
+        self.thread = None
+        if async_write:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def save(self, state, path, dtype=None, prune=False):
+        '''
+        state: cpu snapshot (to_cpu), it must not be modified afterwards
+        dtype: floating point tensors are cast to it before writing
+        prune: remove the oldest checkpoints of the folder of path, keeping keep_last
+        '''
+        if self.async_write:
+            self.queue.put((state, path, dtype, prune))
+        else:
+            self.write(state, path, dtype, prune)
+
+    def write(self, state, path, dtype=None, prune=False):
+        if dtype is not None:
+            state = to_cpu(state, dtype)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        save_atomic(state, path)
+        if prune and self.keep_last > 0:
+            folder = os.path.dirname(os.path.abspath(path))
+            # archives are named by zero-padded step, sorted by name is sorted by step
+            names = sorted([name for name in os.listdir(folder) if name.endswith('.tar')])
+            for name in names[:-self.keep_last]:
+                os.remove(os.path.join(folder, name))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            try:
+                self.write(*item)
+            except Exception as e:
+                logger.error(f'writing checkpoint {item[1]} failed: {e}')
+            self.queue.task_done()
+
+    def close(self):
+        ''' wait for the pending checkpoints
+        '''
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
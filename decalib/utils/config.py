@@ -31,7 +31,10 @@ cfg.model.face_eye_mask_path = os.path.join(cfg.deca_dir, 'data', 'uv_face_eye_m
 cfg.model.mean_tex_path = os.path.join(cfg.deca_dir, 'data', 'mean_texture.jpg') 
 cfg.model.tex_path = os.path.join(cfg.deca_dir, 'data', 'FLAME_albedo_from_BFM.npz') 
 cfg.model.tex_type = 'BFM' # BFM, FLAME, albedoMM
-cfg.model.uv_size = 256
+cfg.model.tex_mmap = True # memory-map the texture basis instead of loading the whole npz
+cfg.model.tex_downsample = True # resample texture mean/basis to uv_size at load time
+cfg.model.tex_cache_size = 0 # number of decoded albedos kept in FLAMETex lru cache, 0 to disable
+cfg.model.uv_size = 256 # detail/texture resolution, e.g. 512 or 1024 for finer wrinkles
 cfg.model.param_list = ['shape', 'tex', 'exp', 'pose', 'cam', 'light']
 cfg.model.n_shape = 100
 cfg.model.n_tex = 50
@@ -47,6 +50,7 @@ cfg.model.fr_model_path = os.path.join(cfg.deca_dir, 'data', 'resnet50_ft_weight
 ## details
 cfg.model.n_detail = 128
 cfg.model.max_z = 0.01
+cfg.model.detail_tile_rows = 0 # rows of the uv map processed at once in displacement2normal/upsample_mesh, 0 for all
 
 # ---------------------------------------------------------------------------- #
 # Options for Dataset
@@ -64,6 +68,13 @@ cfg.dataset.image_size = 224
 cfg.dataset.scale_min = 1.4
 cfg.dataset.scale_max = 1.8
 cfg.dataset.trans_scale = 0.
+# folder of packed training shards (python -m decalib.datasets.shards), replaces training_data when set
+cfg.dataset.shard_dir = ''
+# folder of the memory-mapped landmark/mask index (python -m decalib.datasets.annotation_index), '' to read the .npy files
+cfg.dataset.annotation_index = ''
+# workers return uint8 loose crops, the random scale/translation crop is done batched on the training device
+# (cv2 loose crop + kornia warp instead of the skimage warp, off until parity with the default path is shown)
+cfg.dataset.crop_on_device = False
 
 # ---------------------------------------------------------------------------- #
 # Options for training
@@ -79,10 +90,31 @@ cfg.train.vis_dir = 'train_images'
 cfg.train.vis_steps = 200
 cfg.train.write_summary = True
 cfg.train.checkpoint_steps = 500
+# write checkpoints from a background thread, training only waits for the copy to the cpu
+cfg.train.async_checkpoint = True
+# archived checkpoints (output_dir/models, every 10 checkpoints): 'full' as model.tar, or 'bf16' network weights only
+cfg.train.archive_format = 'full'
+# number of archived checkpoints kept, 0 keeps all
+cfg.train.keep_checkpoints = 0
 cfg.train.val_steps = 500
 cfg.train.val_vis_dir = 'val_images'
+# draw, write and log visualization/validation images and evaluation results in a background thread
+cfg.train.async_vis = True
 cfg.train.eval_steps = 5000
+# NoW dataset folder (imagepathsvalidation.txt, final_release_version/...), '' for the paths in datasets/now.py
+# with final_release_version/scans and scans_lmks_onlypp, the scan-to-mesh errors are computed and logged
+cfg.train.now_dir = ''
+# also decode and write the visualization images of the NoW images, otherwise only the neutral meshes are decoded
+cfg.train.eval_vis = False
+# processes writing the NoW meshes and computing the errors, 0 to do it in the training process
+cfg.train.eval_processes = 8
+# NoW meshes: 'ply' (binary) or 'obj'
+cfg.train.eval_mesh_format = 'ply'
 cfg.train.resume = True
+# mixed precision (cuda only): encoders, D_detail and the identity/mrf networks run under autocast, FLAME and rendering in fp32
+cfg.train.amp = False
+# gradient accumulation, every optimizer step uses accum_steps micro-batches of dataset.batch_size K-image groups
+cfg.train.accum_steps = 1
 
 # ---------------------------------------------------------------------------- #
 # Options for Losses
@@ -96,6 +128,8 @@ cfg.loss.photo = 2.0
 cfg.loss.useSeg = True
 cfg.loss.id = 0.2
 cfg.loss.id_shape_only = True
+# sqlite cache of the identity features of the training images (python -m decalib.datasets.feature_cache), '' to disable
+cfg.loss.id_feature_cache = ''
 cfg.loss.reg_shape = 1e-04
 cfg.loss.reg_exp = 1e-04
 cfg.loss.reg_tex = 1e-04
@@ -107,6 +141,8 @@ cfg.loss.shape_consistency = True
 cfg.loss.detail_consistency = True
 cfg.loss.useConstraint = True
 cfg.loss.mrf = 5e-2
+# samples per batched mrf patch matching ([chunk, HW, HW] cosine maps), 0 for the whole batch
+cfg.loss.mrf_chunk_size = 0
 cfg.loss.photo_D = 2.
 cfg.loss.reg_sym = 0.005
 cfg.loss.reg_z = 0.005
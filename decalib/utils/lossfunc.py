@@ -145,9 +145,9 @@ def batch_kp_2d_l1_loss(real_2d_kp, predicted_2d_kp, weights=None):
 def landmark_loss(predicted_landmarks, landmarks_gt, weight=1.):
     # (predicted_theta, predicted_verts, predicted_landmarks) = ringnet_outputs[-1]
     if torch.is_tensor(landmarks_gt) is not True:
-        real_2d = torch.cat(landmarks_gt).cuda()
+        real_2d = torch.cat(landmarks_gt).to(predicted_landmarks.device)
     else:
-        real_2d = torch.cat([landmarks_gt, torch.ones((landmarks_gt.shape[0], 68, 1)).cuda()], dim=-1)
+        real_2d = torch.cat([landmarks_gt, torch.ones((landmarks_gt.shape[0], 68, 1), device=landmarks_gt.device)], dim=-1)
     # real_2d = torch.cat(landmarks_gt).cuda()
 
     loss_lmk_2d = batch_kp_2d_l1_loss(real_2d, predicted_landmarks)
@@ -164,9 +164,9 @@ def eye_dis(landmarks):
 
 def eyed_loss(predicted_landmarks, landmarks_gt, weight=1.):
     if torch.is_tensor(landmarks_gt) is not True:
-        real_2d = torch.cat(landmarks_gt).cuda()
+        real_2d = torch.cat(landmarks_gt).to(predicted_landmarks.device)
     else:
-        real_2d = torch.cat([landmarks_gt, torch.ones((landmarks_gt.shape[0], 68, 1)).cuda()], dim=-1)
+        real_2d = torch.cat([landmarks_gt, torch.ones((landmarks_gt.shape[0], 68, 1), device=landmarks_gt.device)], dim=-1)
     pred_eyed = eye_dis(predicted_landmarks[:,:,:2])
     gt_eyed = eye_dis(real_2d[:,:,:2])
 
@@ -183,9 +183,9 @@ def lip_dis(landmarks):
 
 def lipd_loss(predicted_landmarks, landmarks_gt, weight=1.):
     if torch.is_tensor(landmarks_gt) is not True:
-        real_2d = torch.cat(landmarks_gt).cuda()
+        real_2d = torch.cat(landmarks_gt).to(predicted_landmarks.device)
     else:
-        real_2d = torch.cat([landmarks_gt, torch.ones((landmarks_gt.shape[0], 68, 1)).cuda()], dim=-1)
+        real_2d = torch.cat([landmarks_gt, torch.ones((landmarks_gt.shape[0], 68, 1), device=landmarks_gt.device)], dim=-1)
     pred_lipd = lip_dis(predicted_landmarks[:,:,:2])
     gt_lipd = lip_dis(real_2d[:,:,:2])
 
@@ -197,7 +197,7 @@ def weighted_landmark_loss(predicted_landmarks, landmarks_gt, weight=1.):
     # (predicted_theta, predicted_verts, predicted_landmarks) = ringnet_outputs[-1]
     # import ipdb; ipdb.set_trace()
     real_2d = landmarks_gt
-    weights = torch.ones((68,)).cuda()
+    weights = torch.ones((68,), device=predicted_landmarks.device)
     weights[5:7] = 2
     weights[10:12] = 2
     # nose points
@@ -335,21 +335,51 @@ def laplacian_hq_loss(prediction, gt):
     return ((lap_pre - lap_gt)**2).mean()
 
 
+def batched_mrf_loss(gen, tar, bias=1.0, nn_stretch_sigma=0.5, chunk_size=0):
+    ''' mrf loss of normalized feature maps [bz, C, H, W], shared by IDMRFLoss and VGGLoss
+    every target feature vector (1x1 patch) against every generated one, [bz, HW_tar, HW_gen],
+    the same as a conv2d of gen with the target patches as kernels, for the whole batch with one bmm.
+    chunk_size: samples per bmm, bounds the memory of the [chunk, HW, HW] maps, 0 for the whole batch
+    '''
+    BatchSize, C, H, W = gen.shape
+    chunk_size = chunk_size if chunk_size > 0 else BatchSize
+    div_mrf_l = []
+    for i in range(0, BatchSize, chunk_size):
+        tar_mat = tar[i:i+chunk_size].reshape(-1, C, H*W).transpose(1, 2)
+        gen_mat = gen[i:i+chunk_size].reshape(-1, C, H*W)
+        cosine_dist = torch.bmm(tar_mat, gen_mat)
+        cosine_dist_zero_2_one = - (cosine_dist - 1) / 2
+        # relative distances, then exp and sum normalization over the target patches
+        relative_dist = cosine_dist_zero_2_one / (torch.min(cosine_dist_zero_2_one, dim=1, keepdim=True)[0] + 1e-5)
+        dist_before_norm = torch.exp((bias - relative_dist)/nn_stretch_sigma)
+        rela_dist = dist_before_norm / torch.sum(dist_before_norm, dim=1, keepdim=True)
+        k_max_nc = torch.max(rela_dist, dim=2)[0]
+        div_mrf_l.append(torch.mean(k_max_nc, dim=1))
+    div_mrf = torch.cat(div_mrf_l, dim=0)
+    div_mrf_sum = -torch.log(div_mrf)
+    div_mrf_sum = torch.sum(div_mrf_sum)
+    return div_mrf_sum
+
 ## 
 class VGG19FeatLayer(nn.Module):
     def __init__(self):
         super(VGG19FeatLayer, self).__init__()
-        self.vgg19 = models.vgg19(pretrained=True).features.eval().cuda()
-        self.mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1).cuda()
-        self.std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1).cuda()
-
-    def forward(self, x):
+        self.vgg19 = models.vgg19(pretrained=True).features.eval()
+        self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
+
+    def forward(self, x, layers=None):
+        '''
+        layers: names of the needed feature maps, the network stops after the deepest one. None for all layers
+        '''
         out = {}
         x = x - self.mean
         x = x/self.std
         ci = 1
         ri = 0
         for layer in self.vgg19.children():
+            if layers is not None and all([name in out for name in layers]):
+                break
             if isinstance(layer, nn.Conv2d):
                 ri += 1
                 name = 'conv{}_{}'.format(ci, ri)
@@ -371,9 +401,13 @@ class VGG19FeatLayer(nn.Module):
         return out
 
 class IDMRFLoss(nn.Module):
-    def __init__(self, featlayer=VGG19FeatLayer):
+    def __init__(self, featlayer=VGG19FeatLayer, chunk_size=0):
+        '''
+        chunk_size: samples per batched patch matching, 0 for the whole batch at once
+        '''
         super(IDMRFLoss, self).__init__()
         self.featlayer = featlayer()
+        self.chunk_size = chunk_size
         self.feat_style_layers = {'relu3_2': 1.0, 'relu4_2': 1.0}
         self.feat_content_layers = {'relu4_2': 1.0}
         self.bias = 1.0
@@ -381,31 +415,6 @@ class IDMRFLoss(nn.Module):
         self.lambda_style = 1.0
         self.lambda_content = 1.0
 
-    def sum_normalize(self, featmaps):
-        reduce_sum = torch.sum(featmaps, dim=1, keepdim=True)
-        return featmaps / reduce_sum
-
-    def patch_extraction(self, featmaps):
-        patch_size = 1
-        patch_stride = 1
-        patches_as_depth_vectors = featmaps.unfold(2, patch_size, patch_stride).unfold(3, patch_size, patch_stride)
-        self.patches_OIHW = patches_as_depth_vectors.permute(0, 2, 3, 1, 4, 5)
-        dims = self.patches_OIHW.size()
-        self.patches_OIHW = self.patches_OIHW.view(-1, dims[3], dims[4], dims[5])
-        return self.patches_OIHW
-
-    def compute_relative_distances(self, cdist):
-        epsilon = 1e-5
-        div = torch.min(cdist, dim=1, keepdim=True)[0]
-        relative_dist = cdist / (div + epsilon)
-        return relative_dist
-
-    def exp_norm_relative_dist(self, relative_dist):
-        scaled_dist = relative_dist
-        dist_before_norm = torch.exp((self.bias - scaled_dist)/self.nn_stretch_sigma)
-        self.cs_NCHW = self.sum_normalize(dist_before_norm)
-        return self.cs_NCHW
-
     def mrf_loss(self, gen, tar):
         meanT = torch.mean(tar, 1, keepdim=True)
         gen_feats, tar_feats = gen - meanT, tar - meanT
@@ -416,44 +425,26 @@ class IDMRFLoss(nn.Module):
         gen_normalized = gen_feats / gen_feats_norm
         tar_normalized = tar_feats / tar_feats_norm
 
-        cosine_dist_l = []
-        BatchSize = tar.size(0)
-
-        for i in range(BatchSize):
-            tar_feat_i = tar_normalized[i:i+1, :, :, :]
-            gen_feat_i = gen_normalized[i:i+1, :, :, :]
-            patches_OIHW = self.patch_extraction(tar_feat_i)
-
-            cosine_dist_i = F.conv2d(gen_feat_i, patches_OIHW)
-            cosine_dist_l.append(cosine_dist_i)
-        cosine_dist = torch.cat(cosine_dist_l, dim=0)
-        cosine_dist_zero_2_one = - (cosine_dist - 1) / 2
-        relative_dist = self.compute_relative_distances(cosine_dist_zero_2_one)
-        rela_dist = self.exp_norm_relative_dist(relative_dist)
-        dims_div_mrf = rela_dist.size()
-        k_max_nc = torch.max(rela_dist.view(dims_div_mrf[0], dims_div_mrf[1], -1), dim=2)[0]
-        div_mrf = torch.mean(k_max_nc, dim=1)
-        div_mrf_sum = -torch.log(div_mrf)
-        div_mrf_sum = torch.sum(div_mrf_sum)
-        return div_mrf_sum
+        return batched_mrf_loss(gen_normalized, tar_normalized, self.bias, self.nn_stretch_sigma, self.chunk_size)
 
     def forward(self, gen, tar):
         ## gen: [bz,3,h,w] rgb [0,1]
-        gen_vgg_feats = self.featlayer(gen)
-        tar_vgg_feats = self.featlayer(tar)
-        style_loss_list = [self.feat_style_layers[layer] * self.mrf_loss(gen_vgg_feats[layer], tar_vgg_feats[layer]) for layer in self.feat_style_layers]
-        self.style_loss = reduce(lambda x, y: x+y, style_loss_list) * self.lambda_style
-
-        content_loss_list = [self.feat_content_layers[layer] * self.mrf_loss(gen_vgg_feats[layer], tar_vgg_feats[layer]) for layer in self.feat_content_layers]
-        self.content_loss = reduce(lambda x, y: x+y, content_loss_list) * self.lambda_content
+        # gen and tar in one pass, only up to the deepest style/content layer
+        layers = list(set(self.feat_style_layers.keys()) | set(self.feat_content_layers.keys()))
+        vgg_feats = self.featlayer(torch.cat([gen, tar], dim=0), layers=layers)
+        bz = gen.shape[0]
+        # under autocast the vgg features are half precision, the patch matching (normalization, exp, log) stays fp32
+        with torch.autocast('cuda', enabled=False):
+            # a layer used for both style and content (relu4_2) is matched once
+            mrf = {layer: self.mrf_loss(vgg_feats[layer][:bz].float(), vgg_feats[layer][bz:].float()) for layer in layers}
+            style_loss_list = [self.feat_style_layers[layer] * mrf[layer] for layer in self.feat_style_layers]
+            self.style_loss = reduce(lambda x, y: x+y, style_loss_list) * self.lambda_style
+
+            content_loss_list = [self.feat_content_layers[layer] * mrf[layer] for layer in self.feat_content_layers]
+            self.content_loss = reduce(lambda x, y: x+y, content_loss_list) * self.lambda_content
 
         return self.style_loss + self.content_loss
 
-        # loss = 0
-        # for key in self.feat_style_layers.keys():
-        #     loss += torch.mean((gen_vgg_feats[key] - tar_vgg_feats[key])**2)
-        # return loss
-
 
 
 ######################################################## vgg16 face
@@ -550,11 +541,15 @@ class VGG_16(nn.Module):
         return out
 
 class VGGLoss(nn.Module):
-    def __init__(self):
+    def __init__(self, chunk_size=0):
+        '''
+        chunk_size: samples per batched patch matching, 0 for the whole batch at once
+        '''
         super(VGGLoss, self).__init__()
         self.featlayer = VGG_16().float()
         self.featlayer.load_weights(path="data/face_recognition_model/vgg_face_torch/VGG_FACE.t7")
         self.featlayer = self.featlayer.cuda().eval()
+        self.chunk_size = chunk_size
         self.feat_style_layers = {'relu3_2': 1.0, 'relu4_2': 1.0}
         self.feat_content_layers = {'relu4_2': 1.0}
         self.bias = 1.0
@@ -562,31 +557,6 @@ class VGGLoss(nn.Module):
         self.lambda_style = 1.0
         self.lambda_content = 1.0
 
-    def sum_normalize(self, featmaps):
-        reduce_sum = torch.sum(featmaps, dim=1, keepdim=True)
-        return featmaps / reduce_sum
-
-    def patch_extraction(self, featmaps):
-        patch_size = 1
-        patch_stride = 1
-        patches_as_depth_vectors = featmaps.unfold(2, patch_size, patch_stride).unfold(3, patch_size, patch_stride)
-        self.patches_OIHW = patches_as_depth_vectors.permute(0, 2, 3, 1, 4, 5)
-        dims = self.patches_OIHW.size()
-        self.patches_OIHW = self.patches_OIHW.view(-1, dims[3], dims[4], dims[5])
-        return self.patches_OIHW
-
-    def compute_relative_distances(self, cdist):
-        epsilon = 1e-5
-        div = torch.min(cdist, dim=1, keepdim=True)[0]
-        relative_dist = cdist / (div + epsilon)
-        return relative_dist
-
-    def exp_norm_relative_dist(self, relative_dist):
-        scaled_dist = relative_dist
-        dist_before_norm = torch.exp((self.bias - scaled_dist)/self.nn_stretch_sigma)
-        self.cs_NCHW = self.sum_normalize(dist_before_norm)
-        return self.cs_NCHW
-
     def mrf_loss(self, gen, tar):
         meanT = torch.mean(tar, 1, keepdim=True)
         gen_feats, tar_feats = gen - meanT, tar - meanT
@@ -597,42 +567,25 @@ class VGGLoss(nn.Module):
         gen_normalized = gen_feats / gen_feats_norm
         tar_normalized = tar_feats / tar_feats_norm
 
-        cosine_dist_l = []
-        BatchSize = tar.size(0)
-
-        for i in range(BatchSize):
-            tar_feat_i = tar_normalized[i:i+1, :, :, :]
-            gen_feat_i = gen_normalized[i:i+1, :, :, :]
-            patches_OIHW = self.patch_extraction(tar_feat_i)
-
-            cosine_dist_i = F.conv2d(gen_feat_i, patches_OIHW)
-            cosine_dist_l.append(cosine_dist_i)
-        cosine_dist = torch.cat(cosine_dist_l, dim=0)
-        cosine_dist_zero_2_one = - (cosine_dist - 1) / 2
-        relative_dist = self.compute_relative_distances(cosine_dist_zero_2_one)
-        rela_dist = self.exp_norm_relative_dist(relative_dist)
-        dims_div_mrf = rela_dist.size()
-        k_max_nc = torch.max(rela_dist.view(dims_div_mrf[0], dims_div_mrf[1], -1), dim=2)[0]
-        div_mrf = torch.mean(k_max_nc, dim=1)
-        div_mrf_sum = -torch.log(div_mrf)
-        div_mrf_sum = torch.sum(div_mrf_sum)
-        return div_mrf_sum
+        return batched_mrf_loss(gen_normalized, tar_normalized, self.bias, self.nn_stretch_sigma, self.chunk_size)
 
     def forward(self, gen, tar):
         ## gen: [bz,3,h,w] rgb [0,1]
-        gen_vgg_feats = self.featlayer(gen)
-        tar_vgg_feats = self.featlayer(tar)
-        style_loss_list = [self.feat_style_layers[layer] * self.mrf_loss(gen_vgg_feats[layer], tar_vgg_feats[layer]) for layer in self.feat_style_layers]
-        self.style_loss = reduce(lambda x, y: x+y, style_loss_list) * self.lambda_style
-
-        content_loss_list = [self.feat_content_layers[layer] * self.mrf_loss(gen_vgg_feats[layer], tar_vgg_feats[layer]) for layer in self.feat_content_layers]
-        self.content_loss = reduce(lambda x, y: x+y, content_loss_list) * self.lambda_content
+        # gen and tar in one pass (VGG_16 always runs the whole network)
+        layers = list(set(self.feat_style_layers.keys()) | set(self.feat_content_layers.keys()))
+        vgg_feats = self.featlayer(torch.cat([gen, tar], dim=0))
+        bz = gen.shape[0]
+        # under autocast the vgg features are half precision, the patch matching (normalization, exp, log) stays fp32
+        with torch.autocast('cuda', enabled=False):
+            # a layer used for both style and content (relu4_2) is matched once
+            mrf = {layer: self.mrf_loss(vgg_feats[layer][:bz].float(), vgg_feats[layer][bz:].float()) for layer in layers}
+            style_loss_list = [self.feat_style_layers[layer] * mrf[layer] for layer in self.feat_style_layers]
+            self.style_loss = reduce(lambda x, y: x+y, style_loss_list) * self.lambda_style
+
+            content_loss_list = [self.feat_content_layers[layer] * mrf[layer] for layer in self.feat_content_layers]
+            self.content_loss = reduce(lambda x, y: x+y, content_loss_list) * self.lambda_content
 
         return self.style_loss + self.content_loss
-        # loss = 0
-        # for key in self.feat_style_layers.keys():
-        #     loss += torch.mean((gen_vgg_feats[key] - tar_vgg_feats[key])**2)
-        # return loss
 
 ##############################################
 ## ref: https://github.com/cydonia999/VGGFace2-pytorch
@@ -640,9 +593,9 @@ from ..models.frnet import resnet50, load_state_dict
 class VGGFace2Loss(nn.Module):
     def __init__(self, pretrained_model, pretrained_data='vggface2'):
         super(VGGFace2Loss, self).__init__()
-        self.reg_model = resnet50(num_classes=8631, include_top=False).eval().cuda()
+        self.reg_model = resnet50(num_classes=8631, include_top=False).eval()
         load_state_dict(self.reg_model, pretrained_model)
-        self.mean_bgr = torch.tensor([91.4953, 103.8827, 131.0912]).cuda()
+        self.register_buffer('mean_bgr', torch.tensor([91.4953, 103.8827, 131.0912]))
 
     def reg_features(self, x):
         # out = []
@@ -652,7 +605,8 @@ class VGGFace2Loss(nn.Module):
         x = F.interpolate(x*2. - 1., [224,224], mode='bilinear')
         # import ipdb; ipdb.set_trace()
         feature = self.reg_model(x)
-        feature = feature.view(x.size(0), -1)
+        # fp32 for the cosine similarity when the network runs under autocast
+        feature = feature.view(x.size(0), -1).float()
         return feature
 
     def transform(self, img):
@@ -664,12 +618,21 @@ class VGGFace2Loss(nn.Module):
     def _cos_metric(self, x1, x2):
         return 1.0 - F.cosine_similarity(x1, x2, dim=1)
 
-    def forward(self, gen, tar, is_crop=True):
-        gen = self.transform(gen)
-        tar = self.transform(tar)
+    def target_features(self, tar):
+        ''' features of the real images, can be precomputed/cached (FeatureCache) since they need no gradient
+        '''
+        return self.reg_features(self.transform(tar))
 
+    def forward(self, gen, tar, is_crop=True, tar_features=None):
+        '''
+        tar_features: cached target_features(tar), the recognition network then only runs on gen
+        '''
+        gen = self.transform(gen)
         gen_out = self.reg_features(gen)
-        tar_out = self.reg_features(tar)
+        tar_out = self.target_features(tar) if tar_features is None else tar_features
+        # gen can be several repeats of tar (shape consistency), tar features are computed once
+        if tar_out.shape[0] != gen_out.shape[0]:
+            tar_out = tar_out.repeat(gen_out.shape[0]//tar_out.shape[0], 1)
         # loss = ((gen_out - tar_out)**2).mean()
         loss = self._cos_metric(gen_out, tar_out).mean()
         return loss
\ No newline at end of file
@@ -0,0 +1,298 @@
+'''
+NoW validation without the external now_evaluation step
+the training process only encodes the images and decodes the neutral geometry (zero expression and pose),
+a process pool writes the meshes/landmarks and computes the scan-to-mesh errors:
+the predicted mesh is aligned to the scan with the 7 landmarks (similarity transform), the alignment is refined
+rigidly on the scan-to-mesh correspondences, then the distance of every scan point to the mesh surface is measured
+'''
+import os
+import re
+import functools
+import multiprocessing
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.spatial import cKDTree
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from loguru import logger
+
+# flame landmarks (of the 51 inner landmarks) picked in the NoW scans
+NOW_LANDMARKS = [19, 22, 25, 28, 16, 31, 37]
+
+## mesh writing
+def write_ply(path, vertices, faces):
+    ''' binary ply, same face orientation as util.write_obj
+    '''
+    header = ('ply\nformat binary_little_endian 1.0\n'
+              f'element vertex {vertices.shape[0]}\nproperty float x\nproperty float y\nproperty float z\n'
+              f'element face {faces.shape[0]}\nproperty list uchar int vertex_indices\nend_header\n')
+    face_data = np.empty(faces.shape[0], dtype=[('n', 'u1'), ('vertex_indices', '<i4', (3,))])
+    face_data['n'] = 3
+    face_data['vertex_indices'] = faces[:, ::-1]
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(np.ascontiguousarray(vertices, dtype='<f4').tobytes())
+        f.write(face_data.tobytes())
+
+def write_obj(path, vertices, faces):
+    ''' same mesh as util.write_obj (no texture), formatted in one call per block instead of per line
+    '''
+    with open(path, 'w') as f:
+        np.savetxt(f, vertices, fmt='v %.8f %.8f %.8f')
+        np.savetxt(f, faces[:, ::-1] + 1, fmt='f %d %d %d')
+
+MESH_WRITERS = {'ply': write_ply, 'obj': write_obj}
+
+## ground truth
+def load_scan(path):
+    ''' vertices of an obj scan
+    '''
+    with open(path) as f:
+        lines = [line.split()[1:4] for line in f if line.startswith('v ')]
+    return np.array(lines, dtype=np.float64)
+
+def load_pp(path):
+    ''' picked points of a scan (meshlab .pp), [7, 3]
+    '''
+    points = []
+    with open(path) as f:
+        for line in f:
+            if '<point' in line:
+                values = dict(re.findall(r'(\w+)="([^"]*)"', line))
+                points.append([float(values['x']), float(values['y']), float(values['z'])])
+    return np.array(points, dtype=np.float64)
+
+## alignment and distances
+def similarity_transform(src, dst, with_scale=True):
+    ''' s, R, t minimizing ||s*R*src + t - dst|| (Umeyama)
+    src, dst: [N, 3] corresponding points
+    '''
+    mu_src = src.mean(0); mu_dst = dst.mean(0)
+    src_c = src - mu_src; dst_c = dst - mu_dst
+    U, S, Vt = np.linalg.svd(dst_c.T @ src_c / src.shape[0])
+    D = np.eye(3)
+    if np.linalg.det(U)*np.linalg.det(Vt) < 0:
+        D[2, 2] = -1
+    R = U @ D @ Vt
+    s = np.trace(np.diag(S) @ D)/src_c.var(0).sum() if with_scale else 1.
+    t = mu_dst - s*R @ mu_src
+    return s, R, t
+
+def closest_points_on_triangles(p, a, b, c):
+    ''' closest point to p on the triangle abc, all [N, 3]
+    (Ericson, Real-Time Collision Detection, 5.1.5), regions are applied from the lowest priority up
+    '''
+    def safe(x):
+        return np.where(x == 0, 1., x)
+    ab = b - a; ac = c - a; bc = c - b
+    ap = p - a; bp = p - b; cp = p - c
+    d1 = (ab*ap).sum(-1); d2 = (ac*ap).sum(-1)
+    d3 = (ab*bp).sum(-1); d4 = (ac*bp).sum(-1)
+    d5 = (ab*cp).sum(-1); d6 = (ac*cp).sum(-1)
+    va = d3*d6 - d5*d4; vb = d5*d2 - d1*d6; vc = d1*d4 - d3*d2
+    # face interior
+    denom = safe(va + vb + vc)
+    out = a + ab*(vb/denom)[:, None] + ac*(vc/denom)[:, None]
+    # edge bc
+    cond = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+    out = np.where(cond[:, None], b + bc*((d4 - d3)/safe((d4 - d3) + (d5 - d6)))[:, None], out)
+    # edge ac
+    cond = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+    out = np.where(cond[:, None], a + ac*(d2/safe(d2 - d6))[:, None], out)
+    # vertex c
+    cond = (d6 >= 0) & (d5 <= d6)
+    out = np.where(cond[:, None], c, out)
+    # edge ab
+    cond = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+    out = np.where(cond[:, None], a + ab*(d1/safe(d1 - d3))[:, None], out)
+    # vertex b
+    cond = (d3 >= 0) & (d4 <= d3)
+    out = np.where(cond[:, None], b, out)
+    # vertex a
+    cond = (d1 <= 0) & (d2 <= 0)
+    out = np.where(cond[:, None], a, out)
+    return out
+
+def vertex_faces(faces, n_verts):
+    ''' [n_verts, max_degree] faces around each vertex, padded with the first face of the vertex
+    '''
+    adjacency = [[] for _ in range(n_verts)]
+    for f, face in enumerate(faces):
+        for v in face:
+            adjacency[v].append(f)
+    max_degree = max(len(fs) for fs in adjacency)
+    out = np.zeros([n_verts, max_degree], dtype=np.int64)
+    for v, fs in enumerate(adjacency):
+        if len(fs) > 0:
+            out[v] = fs + [fs[0]]*(max_degree - len(fs))
+    return out
+
+def closest_points_on_mesh(points, verts, faces, adjacency, k=4, chunk_size=20000):
+    ''' closest surface points, searched on the faces around the k nearest vertices (kd-tree over the mesh vertices)
+    return: closest points [N, 3], distances [N]
+    '''
+    tree = cKDTree(verts)
+    closest = np.empty_like(points); distances = np.empty(points.shape[0])
+    for start in range(0, points.shape[0], chunk_size):
+        p = points[start:start+chunk_size]
+        _, nearest = tree.query(p, k=k)
+        candidates = adjacency[nearest].reshape(p.shape[0], -1)
+        n = candidates.shape[1]
+        tri = verts[faces[candidates]]
+        p_rep = np.repeat(p, n, axis=0)
+        cp = closest_points_on_triangles(p_rep, tri[:,:,0].reshape(-1, 3), tri[:,:,1].reshape(-1, 3), tri[:,:,2].reshape(-1, 3)).reshape(p.shape[0], n, 3)
+        dist = ((cp - p[:, None])**2).sum(-1)
+        best = dist.argmin(1)
+        index = np.arange(p.shape[0])
+        closest[start:start+chunk_size] = cp[index, best]
+        distances[start:start+chunk_size] = np.sqrt(dist[index, best])
+    return closest, distances
+
+def scan_to_mesh_distances(verts, faces, adjacency, landmarks, scan, scan_landmarks, icp_iters=10):
+    ''' distance of every scan point to the predicted mesh, in the units of the scan
+    verts: [V, 3] predicted neutral mesh, landmarks: [7, 3] its NoW landmarks
+    scan: [N, 3], scan_landmarks: [7, 3]
+    '''
+    verts = verts.astype(np.float64)
+    s, R, t = similarity_transform(landmarks.astype(np.float64), scan_landmarks)
+    verts = s*verts @ R.T + t
+    for _ in range(icp_iters):
+        closest, _ = closest_points_on_mesh(scan, verts, faces, adjacency)
+        _, R, t = similarity_transform(closest, scan, with_scale=False)
+        verts = verts @ R.T + t
+    _, distances = closest_points_on_mesh(scan, verts, faces, adjacency)
+    return distances
+
+## pool workers
+_worker = {}
+
+def init_worker(faces, mesh_format, scan_folder, lmk_folder, icp_iters):
+    _worker.update(faces=faces, adjacency=vertex_faces(faces, faces.max() + 1), write_mesh=MESH_WRITERS[mesh_format],
+                   mesh_format=mesh_format, scan_folder=scan_folder, lmk_folder=lmk_folder, icp_iters=icp_iters)
+
+@functools.lru_cache(maxsize=4)
+def load_ground_truth(subject):
+    scan_paths = glob(os.path.join(_worker['scan_folder'], subject, '*.obj'))
+    lmk_paths = glob(os.path.join(_worker['lmk_folder'], subject, '*.pp'))
+    if len(scan_paths) == 0 or len(lmk_paths) == 0:
+        raise FileNotFoundError(f'no scan (.obj) or scan landmarks (.pp) of {subject}')
+    return load_scan(scan_paths[0]), load_pp(lmk_paths[0])
+
+def process_batch(savefolder, imagenames, verts, landmarks):
+    ''' write the meshes and landmarks of a batch, and measure them against the scans
+    return: dict, imagename -> distances (empty without ground truth); dict, imagename -> error message of failed images
+    '''
+    results = {}; failures = {}
+    for name, v, lmk in zip(imagenames, verts, landmarks):
+        # one bad image (missing scan, unreadable file) does not stop the evaluation
+        try:
+            path = os.path.join(savefolder, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _worker['write_mesh'](f"{path}.{_worker['mesh_format']}", v, _worker['faces'])
+            # 7 landmarks for alignment, as read by now_evaluation
+            np.save(f'{path}.npy', lmk)
+            if _worker['scan_folder'] is not None:
+                scan, scan_landmarks = load_ground_truth(name.split('/')[0])
+                results[name] = scan_to_mesh_distances(v, _worker['faces'], _worker['adjacency'], lmk, scan, scan_landmarks,
+                                                       icp_iters=_worker['icp_iters']).astype(np.float32)
+        except Exception as e:
+            failures[name] = f'{type(e).__name__}: {e}'
+    return results, failures
+
+class NoWEvaluator(object):
+    def __init__(self, deca, device='cuda', folder=None, scale=1.6, batch_size=8, num_workers=8,
+                 processes=8, mesh_format='ply', icp_iters=10):
+        '''
+        folder: NoW dataset (imagepathsvalidation.txt, final_release_version/...), None for the paths in datasets/now.py.
+            errors are computed when final_release_version/scans and scans_lmks_onlypp are there
+        processes: pool writing the meshes and computing the errors, 0 to do it in this process
+        mesh_format: 'ply' (binary) or 'obj'
+        '''
+        self.deca = deca
+        self.device = device
+        self.folder = folder
+        self.scale = scale
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.processes = processes
+        self.mesh_format = mesh_format
+        self.icp_iters = icp_iters
+        self.scan_folder = self.lmk_folder = None
+        if folder is not None and os.path.exists(os.path.join(folder, 'final_release_version', 'scans')):
+            self.scan_folder = os.path.join(folder, 'final_release_version', 'scans')
+            self.lmk_folder = os.path.join(folder, 'final_release_version', 'scans_lmks_onlypp')
+
+    def run(self, savefolder, vis_fn=None):
+        '''
+        vis_fn: vis_fn(imagename, visdict, landmarks, i) is called with the full decode of every batch,
+            None decodes only the neutral geometry
+        return: dict of the error statistics (median, mean, std), empty without ground truth
+        '''
+        from ..datasets.now import NoWDataset
+        os.makedirs(savefolder, exist_ok=True)
+        dataset = NoWDataset(scale=self.scale, folder=self.folder, return_original=False)
+        dataloader = DataLoader(dataset, batch_size=self.batch_size, shuffle=False,
+                            num_workers=self.num_workers,
+                            pin_memory=True,
+                            drop_last=False)
+        faces = self.deca.flame.faces_tensor.cpu().numpy()
+        initargs = (faces, self.mesh_format, self.scan_folder, self.lmk_folder, self.icp_iters)
+        if self.processes > 0:
+            # spawn, the training process holds cuda and background threads
+            pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=init_worker, initargs=initargs)
+        else:
+            pool = None
+            init_worker(*initargs)
+        distances = {}; failures = {}
+        try:
+            jobs = []
+            for i, batch in enumerate(tqdm(dataloader, desc='now evaluation ')):
+                images = batch['image'].to(self.device)
+                imagename = batch['imagename']
+                with torch.no_grad():
+                    codedict = self.deca.encode(images)
+                    if vis_fn is not None:
+                        opdict, visdict = self.deca.decode(codedict, draw_landmarks=False)
+                        vis_fn(imagename, visdict, {'landmarks2d': opdict['landmarks2d'], 'landmarks3d': opdict['landmarks3d']}, i)
+                    # neutral geometry only, no rendering
+                    shape = codedict['shape']
+                    verts, _, landmarks3d = self.deca.flame(shape_params=shape,
+                                                           expression_params=torch.zeros_like(codedict['exp']),
+                                                           pose_params=torch.zeros_like(codedict['pose']))
+                verts = verts.cpu().numpy()
+                landmark_7 = landmarks3d[:, 17:][:, NOW_LANDMARKS].cpu().numpy()
+                if pool is not None:
+                    jobs.append((imagename, pool.submit(process_batch, savefolder, imagename, verts, landmark_7)))
+                else:
+                    jobs.append((imagename, process_batch(savefolder, imagename, verts, landmark_7)))
+
+            for imagename, job in jobs:
+                try:
+                    batch_distances, batch_failures = job.result() if pool is not None else job
+                except Exception as e:
+                    # e.g. a worker process died, the whole batch is lost
+                    batch_distances = {}; batch_failures = {name: f'{type(e).__name__}: {e}' for name in imagename}
+                distances.update(batch_distances); failures.update(batch_failures)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        for name, message in failures.items():
+            logger.warning(f'NoW evaluation of {name} failed: {message}')
+        if len(distances) == 0:
+            return {}
+        return self.write_errors(savefolder, distances)
+
+    def write_errors(self, savefolder, distances):
+        ''' statistics over all scan points of all images, as reported by the NoW challenge
+        '''
+        names = sorted(distances.keys())
+        all_distances = np.concatenate([distances[name] for name in names])
+        metrics = {'median': float(np.median(all_distances)), 'mean': float(all_distances.mean()), 'std': float(all_distances.std())}
+        with open(os.path.join(savefolder, 'errors.txt'), 'w') as f:
+            f.write(' '.join([f'{k} {v:.6f}' for k, v in metrics.items()]) + '\n')
+            for name in names:
+                f.write(f'{name} median {np.median(distances[name]):.6f} mean {distances[name].mean():.6f}\n')
+        return metrics
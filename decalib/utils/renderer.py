@@ -194,8 +194,6 @@ class SRenderY(nn.Module):
             NotImplementedError
 
         # faces
-        dense_triangles = util.generate_triangles(uv_size, uv_size)
-        self.register_buffer('dense_faces', torch.from_numpy(dense_triangles).long()[None,:,:])
         self.register_buffer('faces', faces)
         self.register_buffer('raw_uvcoords', uvcoords)
 
@@ -447,6 +445,49 @@ class SRenderY(nn.Module):
         images = rendering[:, :3, :, :]* alpha_images
         return images
 
+    def generate_dense_template(self, uv_mask=None, margin_x=2, margin_y=5):
+        '''
+        build the dense mesh template used by util.upsample_mesh at the current uv_size
+        (same fields as texture_data_256.npy): for every valid uv pixel, the coarse face it lies in and
+        its barycentric coords, plus the faces of the dense grid over the valid pixels
+        uv_mask: [h, w] or [1, 1, h, w], only pixels inside the mask become dense vertices
+        '''
+        h = w = self.uv_size
+        faces = self.faces
+        n_faces = faces.shape[1]
+        device = faces.device
+        # rasterize per-corner one-hot barycentrics and the face index in uv space
+        bary_attributes = torch.eye(3, device=device)[None, None, :, :].expand(1, n_faces, -1, -1)
+        face_attributes = torch.arange(n_faces, device=device).float()[None, :, None, None].expand(1, -1, 3, 1)
+        attributes = torch.cat([bary_attributes, face_attributes], -1).contiguous()
+        rendering = self.uv_rasterizer(self.uvcoords, self.uvfaces, attributes)
+        b_coords = rendering[0, :3].permute(1, 2, 0).reshape(-1, 3).cpu().numpy()
+        face_ids = torch.round(rendering[0, 3]).long().reshape(-1).cpu().numpy()
+        valid = (rendering[0, -1] > 0).reshape(-1).cpu().numpy()
+        if uv_mask is not None:
+            uv_mask = torch.as_tensor(uv_mask).reshape(h, w)
+            valid = valid & (uv_mask > 0.5).reshape(-1).cpu().numpy()
+
+        valid_pixel_ids = np.nonzero(valid)[0]
+        x_coords = np.tile(np.arange(w), h).astype(np.float32)
+        y_coords = np.repeat(np.arange(h), w).astype(np.float32)
+        valid_pixel_3d_faces = faces[0].cpu().numpy()[face_ids[valid_pixel_ids]]
+        valid_pixel_b_coords = b_coords[valid_pixel_ids]
+        # dense faces: grid triangles whose three pixels are valid, indexed into the valid pixels
+        dense_ids = np.full(h*w, -1, dtype=np.int64)
+        dense_ids[valid_pixel_ids] = np.arange(valid_pixel_ids.shape[0])
+        triangles = dense_ids[util.generate_triangles(h, w, margin_x, margin_y)]
+        dense_faces = triangles[(triangles >= 0).all(1)]
+        return {
+            'img_size': h,
+            'f': dense_faces,
+            'x_coords': x_coords,
+            'y_coords': y_coords,
+            'valid_pixel_ids': valid_pixel_ids,
+            'valid_pixel_3d_faces': valid_pixel_3d_faces,
+            'valid_pixel_b_coords': valid_pixel_b_coords,
+        }
+
     def world2uv(self, vertices):
         '''
         warp vertices from world space to uv space
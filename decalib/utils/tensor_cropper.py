@@ -91,6 +91,9 @@ class Cropper(object):
     def crop(self, image, points, points_scale=None):
         # points to bbox
         center, bbox_size = points2bbox(points.clone(), points_scale)
+        return self.crop_bbox(image, center, bbox_size)
+
+    def crop_bbox(self, image, center, bbox_size):
         # argument bbox. TODO: add rotation?
         center, bbox_size = augment_bbox(center, bbox_size, scale=self.scale, trans_scale=self.trans_scale)
         # crop
@@ -24,15 +24,16 @@ from skimage.io import imsave
 import cv2
 import torchvision
 
-def upsample_mesh(vertices, normals, faces, displacement_map, texture_map, dense_template):
+def upsample_mesh(vertices, normals, faces, displacement_map, texture_map, dense_template, chunk_size=None):
     ''' Credit to Timo
     upsampling coarse mesh (with displacment map)
         vertices: vertices of coarse mesh, [nv, 3]
         normals: vertex normals, [nv, 3]
         faces: faces of coarse mesh, [nf, 3]
-        texture_map: texture map, [256, 256, 3]
-        displacement_map: displacment map, [256, 256]
+        texture_map: texture map, [uv_size, uv_size, 3]
+        displacement_map: displacment map, [uv_size, uv_size]
         dense_template: 
+        chunk_size: number of dense vertices processed at once, bounds memory for large uv sizes
     Returns: 
         dense_vertices: upsampled vertices with details, [number of dense vertices, 3]
         dense_colors: vertex color, [number of dense vertices, 3]
@@ -46,18 +47,28 @@ def upsample_mesh(vertices, normals, faces, displacement_map, texture_map, dense
     valid_pixel_3d_faces = dense_template['valid_pixel_3d_faces']
     valid_pixel_b_coords = dense_template['valid_pixel_b_coords']
 
-    pixel_3d_points = vertices[valid_pixel_3d_faces[:, 0], :] * valid_pixel_b_coords[:, 0][:, np.newaxis] + \
-                    vertices[valid_pixel_3d_faces[:, 1], :] * valid_pixel_b_coords[:, 1][:, np.newaxis] + \
-                    vertices[valid_pixel_3d_faces[:, 2], :] * valid_pixel_b_coords[:, 2][:, np.newaxis]
+    n_dense = valid_pixel_ids.shape[0]
+    if chunk_size is None or chunk_size <= 0:
+        chunk_size = n_dense
+    dense_vertices = np.zeros([n_dense, 3], dtype=vertices.dtype)
+    dense_colors = np.zeros([n_dense, texture_map.shape[-1]], dtype=texture_map.dtype)
     vertex_normals = normals
-    pixel_3d_normals = vertex_normals[valid_pixel_3d_faces[:, 0], :] * valid_pixel_b_coords[:, 0][:, np.newaxis] + \
-                    vertex_normals[valid_pixel_3d_faces[:, 1], :] * valid_pixel_b_coords[:, 1][:, np.newaxis] + \
-                    vertex_normals[valid_pixel_3d_faces[:, 2], :] * valid_pixel_b_coords[:, 2][:, np.newaxis]
-    pixel_3d_normals = pixel_3d_normals / np.linalg.norm(pixel_3d_normals, axis=-1)[:, np.newaxis]
-    displacements = displacement_map[y_coords[valid_pixel_ids].astype(int), x_coords[valid_pixel_ids].astype(int)]
-    dense_colors = texture_map[y_coords[valid_pixel_ids].astype(int), x_coords[valid_pixel_ids].astype(int)]
-    offsets = np.einsum('i,ij->ij', displacements, pixel_3d_normals)
-    dense_vertices = pixel_3d_points + offsets
+    for start in range(0, n_dense, chunk_size):
+        end = min(start + chunk_size, n_dense)
+        pixel_3d_faces = valid_pixel_3d_faces[start:end]
+        b_coords = valid_pixel_b_coords[start:end]
+        pixel_ids = valid_pixel_ids[start:end]
+        pixel_3d_points = vertices[pixel_3d_faces[:, 0], :] * b_coords[:, 0][:, np.newaxis] + \
+                        vertices[pixel_3d_faces[:, 1], :] * b_coords[:, 1][:, np.newaxis] + \
+                        vertices[pixel_3d_faces[:, 2], :] * b_coords[:, 2][:, np.newaxis]
+        pixel_3d_normals = vertex_normals[pixel_3d_faces[:, 0], :] * b_coords[:, 0][:, np.newaxis] + \
+                        vertex_normals[pixel_3d_faces[:, 1], :] * b_coords[:, 1][:, np.newaxis] + \
+                        vertex_normals[pixel_3d_faces[:, 2], :] * b_coords[:, 2][:, np.newaxis]
+        pixel_3d_normals = pixel_3d_normals / np.linalg.norm(pixel_3d_normals, axis=-1)[:, np.newaxis]
+        displacements = displacement_map[y_coords[pixel_ids].astype(int), x_coords[pixel_ids].astype(int)]
+        dense_colors[start:end] = texture_map[y_coords[pixel_ids].astype(int), x_coords[pixel_ids].astype(int)]
+        offsets = np.einsum('i,ij->ij', displacements, pixel_3d_normals)
+        dense_vertices[start:end] = pixel_3d_points + offsets
     return dense_vertices, dense_colors, dense_faces
 
 # borrowed from https://github.com/YadiraF/PRNet/blob/master/utils/write.py
@@ -214,14 +225,12 @@ def generate_triangles(h, w, margin_x=2, margin_y=5, mask = None):
     # w w+1
     #.
     # w*h
-    triangles = []
-    for x in range(margin_x, w-1-margin_x):
-        for y in range(margin_y, h-1-margin_y):
-            triangle0 = [y*w + x, y*w + x + 1, (y+1)*w + x]
-            triangle1 = [y*w + x + 1, (y+1)*w + x + 1, (y+1)*w + x]
-            triangles.append(triangle0)
-            triangles.append(triangle1)
-    triangles = np.array(triangles)
+    # quads ordered x-major, two triangles per quad
+    x, y = np.meshgrid(np.arange(margin_x, w-1-margin_x), np.arange(margin_y, h-1-margin_y), indexing='ij')
+    x = x.reshape(-1); y = y.reshape(-1)
+    triangle0 = np.stack([y*w + x, y*w + x + 1, (y+1)*w + x], -1)
+    triangle1 = np.stack([y*w + x + 1, (y+1)*w + x + 1, (y+1)*w + x], -1)
+    triangles = np.stack([triangle0, triangle1], 1).reshape(-1, 3)
     triangles = triangles[:,[0,2,1]]
     return triangles
 
@@ -280,6 +289,46 @@ def vertex_normals(vertices, faces):
     # pytorch only supports long and byte tensors for indexing
     return normals
 
+def grid_vertex_normals(vertices, margin_x=2, margin_y=5, tile_rows=0):
+    """ vertex normals of the regular dense grid mesh built by generate_triangles, without index_add_ scatters
+    :param vertices: [batch size, 3, h, w], vertex positions in image layout
+    :param tile_rows: if > 0, process bands of rows to bound memory for large uv sizes
+    :return: [batch size, 3, h, w], same result as vertex_normals(vertices, generate_triangles(h, w, margin_x, margin_y))
+    """
+    h = vertices.shape[-2]
+    if tile_rows <= 0 or tile_rows >= h:
+        return _grid_vertex_normals(vertices, margin_x, margin_y, 0, h)
+    normals = []
+    for start in range(0, h, tile_rows):
+        end = min(start + tile_rows, h)
+        # normals of rows [start, end) depend on one more row of vertices on each side
+        lo = max(start - 1, 0); hi = min(end + 1, h)
+        tile_normals = _grid_vertex_normals(vertices[:, :, lo:hi], margin_x, margin_y, lo, h)
+        normals.append(tile_normals[:, :, start-lo:end-lo])
+    return torch.cat(normals, 2)
+
+def _grid_vertex_normals(vertices, margin_x, margin_y, row_start, height):
+    h, w = vertices.shape[-2:]
+    # each quad (y, x) is split into triangle a: (y,x),(y+1,x),(y,x+1) and b: (y,x+1),(y+1,x),(y+1,x+1)
+    v00 = vertices[:, :, :-1, :-1]; v01 = vertices[:, :, :-1, 1:]
+    v10 = vertices[:, :, 1:, :-1]; v11 = vertices[:, :, 1:, 1:]
+    # every vertex of a triangle receives the same (area weighted) face normal
+    normals_a = torch.cross(v10 - v00, v01 - v00, dim=1)
+    normals_b = torch.cross(v10 - v01, v11 - v01, dim=1)
+    # only quads inside the margins have triangles
+    rows = torch.arange(row_start, row_start + h - 1, device=vertices.device)
+    cols = torch.arange(w - 1, device=vertices.device)
+    row_mask = (rows >= margin_y) & (rows < height - 1 - margin_y)
+    col_mask = (cols >= margin_x) & (cols < w - 1 - margin_x)
+    quad_mask = (row_mask[:, None] & col_mask[None, :]).to(vertices.dtype)
+    normals_a = normals_a*quad_mask; normals_b = normals_b*quad_mask
+    # gather the face normals at each vertex by shifting the quad maps, F.pad order: (left, right, top, bottom)
+    normals_ab = normals_a + normals_b
+    normals = F.pad(normals_a, (0, 1, 0, 1)) + F.pad(normals_ab, (0, 1, 1, 0)) \
+            + F.pad(normals_ab, (1, 0, 0, 1)) + F.pad(normals_b, (1, 0, 1, 0))
+    normals = F.normalize(normals, eps=1e-6, dim=1)
+    return normals
+
 def batch_orth_proj(X, camera):
     ''' orthgraphic projection
         X:  3d vertices, [bz, n_point, 3]
@@ -673,10 +722,10 @@ def load_local_mask(image_size=256, mode='bbx'):
         eye_nose = np.array([490, 1558, 700, 1050+50])
         mouth = np.array([574, 1474, 1050, 1550])
         ratio = image_size / 2048.
-        face = (face * ratio).astype(np.int)
-        forehead = (forehead * ratio).astype(np.int)
-        eye_nose = (eye_nose * ratio).astype(np.int)
-        mouth = (mouth * ratio).astype(np.int)
+        face = (face * ratio).astype(int)
+        forehead = (forehead * ratio).astype(int)
+        eye_nose = (eye_nose * ratio).astype(int)
+        mouth = (mouth * ratio).astype(int)
         regional_mask = np.array([face, forehead, eye_nose, mouth])
 
     return regional_mask
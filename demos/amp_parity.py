@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at deca@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+
+''' loss parity of mixed precision training
+runs the first steps of a training config twice, fp32 and amp, from the same weights and the same batches,
+and writes the per-step losses of both runs to a csv and their all_loss curves to losses.png
+'''
+import os, sys
+import random
+import argparse
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from decalib.deca import DECA
+from decalib.trainer import Trainer
+from decalib.utils.config import get_cfg_defaults, update_cfg
+
+def run(cfg, amp, steps, seed):
+    random.seed(seed); np.random.seed(seed); torch.manual_seed(seed)
+    cfg = cfg.clone()
+    cfg.train.amp = amp
+    cfg.output_dir = os.path.join(cfg.output_dir, 'amp' if amp else 'fp32')
+    os.makedirs(os.path.join(cfg.output_dir, cfg.train.log_dir), exist_ok=True)
+    trainer = Trainer(model=DECA(cfg), config=cfg)
+    trainer.prepare_data()
+    history = []
+    for step in range(steps):
+        # losses of a step are averaged over its accumulated micro-batches
+        step_losses = {}
+        for micro_step in range(trainer.accum_steps):
+            losses, _ = trainer.training_step(trainer.next_batch(0), step)
+            trainer.backward(losses['all_loss'])
+            for k, v in losses.items():
+                step_losses[k] = step_losses.get(k, 0.) + float(v)/trainer.accum_steps
+        trainer.optimizer_step()
+        history.append(step_losses)
+    return history
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DECA: fp32 vs amp training losses')
+    parser.add_argument('--cfg', type=str, required=True, help='training cfg file path')
+    parser.add_argument('--steps', type=int, default=200, help='number of training steps of each run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='amp_parity', help='output folder, losses.csv is written there')
+    args = parser.parse_args()
+
+    cfg = update_cfg(get_cfg_defaults(), args.cfg)
+    cfg.output_dir = args.output
+    cfg.rasterizer_type = 'standard'
+    # same start and same batches for both runs
+    cfg.train.resume = False
+    cfg.train.write_summary = False
+    cfg.dataset.num_workers = 0
+
+    fp32 = run(cfg, False, args.steps, args.seed)
+    amp = run(cfg, True, args.steps, args.seed)
+
+    keys = list(fp32[0].keys())
+    with open(os.path.join(args.output, 'losses.csv'), 'w') as f:
+        f.write('step,' + ','.join([f'{k}_fp32,{k}_amp' for k in keys]) + '\n')
+        for step in range(args.steps):
+            f.write(f'{step},' + ','.join([f'{fp32[step][k]:.6f},{amp[step][k]:.6f}' for k in keys]) + '\n')
+    all_fp32 = np.array([h['all_loss'] for h in fp32]); all_amp = np.array([h['all_loss'] for h in amp])
+    rel = np.abs(all_amp - all_fp32)/np.abs(all_fp32)
+    print(f'all_loss relative difference over {args.steps} steps: mean {rel.mean():.4f}, max {rel.max():.4f}')
+    print(f'losses written to {os.path.join(args.output, "losses.csv")}')
+
+    # parity curves of the total loss
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, (ax_loss, ax_rel) = plt.subplots(2, 1, figsize=(8, 6), sharex=True)
+    ax_loss.plot(all_fp32, label='fp32'); ax_loss.plot(all_amp, label='amp')
+    ax_loss.set_ylabel('all_loss'); ax_loss.legend()
+    ax_rel.plot(rel); ax_rel.set_ylabel('relative difference'); ax_rel.set_xlabel('step')
+    fig.tight_layout()
+    fig.savefig(os.path.join(args.output, 'losses.png'))
+    print(f'curves written to {os.path.join(args.output, "losses.png")}')
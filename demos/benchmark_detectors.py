@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at deca@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+
+import os, sys
+import numpy as np
+from time import time
+import argparse
+import scipy.io
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from decalib.datasets import datasets, detectors
+
+def crop_box(bbox, bbox_type, scale=1.25):
+    ''' square crop [left, top, right, bottom] as used by TestData
+    '''
+    old_size, center = datasets.TestData.bbox2point(None, bbox[0], bbox[2], bbox[1], bbox[3], type=bbox_type)
+    size = old_size*scale
+    return np.array([center[0]-size/2, center[1]-size/2, center[0]+size/2, center[1]+size/2])
+
+def iou(a, b):
+    w = max(min(a[2], b[2]) - max(a[0], b[0]), 0); h = max(min(a[3], b[3]) - max(a[1], b[1]), 0)
+    inter = w*h
+    return inter/((a[2]-a[0])*(a[3]-a[1]) + (b[2]-b[0])*(b[3]-b[1]) - inter)
+
+def load_kpt(imagepath):
+    kpt_matpath = os.path.splitext(imagepath)[0]+'.mat'
+    kpt_txtpath = os.path.splitext(imagepath)[0]+'.txt'
+    if os.path.exists(kpt_matpath):
+        return scipy.io.loadmat(kpt_matpath)['pt3d_68'].T
+    elif os.path.exists(kpt_txtpath):
+        return np.loadtxt(kpt_txtpath)
+    return None
+
+def main(args):
+    testdata = datasets.TestData(args.inputpath, face_detector=args.reference, detect_batch_size=args.batch_size)
+    imagepath_list = testdata.imagepath_list[:args.max_images] if args.max_images > 0 else testdata.imagepath_list
+    images = [datasets.imread_rgb(imagepath) for imagepath in imagepath_list]
+
+    # reference crops: kpt files next to the images (e.g. AFLW2000), otherwise the reference detector
+    references = []
+    ref_boxes, ref_types = testdata.detector_batcher.run(images)
+    for imagepath, bbox, bbox_type in zip(imagepath_list, ref_boxes, ref_types):
+        kpt = load_kpt(imagepath)
+        if kpt is not None:
+            bbox = [np.min(kpt[:,0]), np.min(kpt[:,1]), np.max(kpt[:,0]), np.max(kpt[:,1])]; bbox_type = 'kpt68'
+        references.append(crop_box(bbox, bbox_type) if len(bbox) == 4 else None)
+
+    rows = []
+    for name in args.detectors.split(','):
+        try:
+            batcher = detectors.DetectorBatcher(name, batch_size=args.batch_size, det_size=args.det_size)
+        except Exception as e:
+            print(f'skip {name}: {e}')
+            continue
+        batcher.run(images[:args.batch_size]) # warm up
+        start = time()
+        boxes, types = batcher.run(images)
+        elapsed = (time() - start)/len(images)*1000
+        ious = []; misses = 0
+        for bbox, bbox_type, reference in zip(boxes, types, references):
+            if reference is None:
+                continue
+            if len(bbox) < 4:
+                misses += 1; ious.append(0.)
+            else:
+                ious.append(iou(crop_box(bbox, bbox_type), reference))
+        rows.append([name, elapsed, np.mean(ious) if len(ious) > 0 else float('nan'), misses/max(len(ious), 1)*100])
+
+    print(f'{len(images)} images, batch size {args.batch_size}, detection size {args.det_size}')
+    print('| detector | ms / image | crop IoU | missed (%) |')
+    print('| --- | --- | --- | --- |')
+    for name, elapsed, mean_iou, missed in rows:
+        print(f'| {name} | {elapsed:.1f} | {mean_iou:.3f} | {missed:.1f} |')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DECA: face detector speed vs. crop quality')
+
+    parser.add_argument('-i', '--inputpath', default='TestSamples/examples', type=str,
+                        help='image folder, images with .mat/.txt 68 landmarks (e.g. AFLW2000) are compared to those')
+    parser.add_argument('--detectors', default='fan,sfd,blazeface,mtcnn,haar,opencv_dnn', type=str,
+                        help='comma separated detector names, check decalib/datasets/detectors.py' )
+    parser.add_argument('--reference', default='fan', type=str,
+                        help='detector giving the reference crop for images without landmark files' )
+    parser.add_argument('--batch_size', default=8, type=int,
+                        help='number of images the detector runs on at once' )
+    parser.add_argument('--det_size', default=640, type=int,
+                        help='detection resolution' )
+    parser.add_argument('--max_images', default=0, type=int,
+                        help='only use the first images, 0 for all' )
+    main(parser.parse_args())
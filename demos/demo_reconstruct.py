@@ -39,7 +39,9 @@ def main(args):
     os.makedirs(savefolder, exist_ok=True)
 
     # load test images 
-    testdata = datasets.TestData(args.inputpath, iscrop=args.iscrop, face_detector=args.detector, sample_step=args.sample_step)
+    testdata = datasets.TestData(args.inputpath, iscrop=args.iscrop, face_detector=args.detector, sample_step=args.sample_step,
+                                 max_original_size=args.max_orig_size, detect_batch_size=args.detect_batch_size,
+                                 detection_cache=args.detection_cache if args.detection_cache else None, multi_face=args.multi_face)
     
     # 使用 NoW 中的图片作测试
     # testdata = now.NoWDataset()
@@ -50,47 +52,54 @@ def main(args):
     deca_cfg.model.extract_tex = args.extractTex
     deca = DECA(config = deca_cfg, device=device)
     # for i in range(len(testdata)):
-    for i in tqdm(range(len(testdata))):
-        name = testdata[i]['imagename']
-        images = testdata[i]['image'].to(device)[None,...]
+    # all faces of one image go through DECA as one batch
+    for indices in tqdm(testdata.image_groups()):
+        data_list = [testdata[i] for i in indices]
         with torch.no_grad():
+            images = testdata.crop(data_list, device)
             codedict = deca.encode(images)
-            opdict, visdict = deca.decode(codedict) #tensor
+            batch_opdict, batch_visdict = deca.decode(codedict) #tensor
             if args.render_orig:
-                tform = testdata[i]['tform'][None, ...]
+                original_image, tform = testdata.load_original(data_list)
                 tform = torch.inverse(tform).transpose(1,2).to(device)
-                original_image = testdata[i]['original_image'][None, ...].to(device)
-                _, orig_visdict = deca.decode(codedict, render_orig=True, original_image=original_image, tform=tform)    
-                orig_visdict['inputs'] = original_image            
+                original_image = original_image[None, ...].to(device).float().repeat(len(data_list), 1, 1, 1)/255.
+                _, batch_orig_visdict = deca.decode(codedict, render_orig=True, original_image=original_image, tform=tform)    
+                batch_orig_visdict['inputs'] = original_image            
 
-        if args.saveDepth or args.saveKpt or args.saveObj or args.saveMat or args.saveImages:
-            os.makedirs(os.path.join(savefolder, name), exist_ok=True)
-        # -- save results
-        if args.saveDepth:
-            depth_image = deca.render.render_depth(opdict['trans_verts']).repeat(1,3,1,1)
-            visdict['depth_images'] = depth_image
-            cv2.imwrite(os.path.join(savefolder, name, name + '_depth.jpg'), util.tensor2image(depth_image[0]))
-        if args.saveKpt:
-            np.savetxt(os.path.join(savefolder, name, name + '_kpt2d.txt'), opdict['landmarks2d'][0].cpu().numpy())
-            np.savetxt(os.path.join(savefolder, name, name + '_kpt3d.txt'), opdict['landmarks3d'][0].cpu().numpy())
-        if args.saveObj:
-            deca.save_obj(os.path.join(savefolder, name, name + '.obj'), opdict)
-        if args.saveMat:
-            opdict = util.dict_tensor2npy(opdict)
-            savemat(os.path.join(savefolder, name, name + '.mat'), opdict)
-        if args.saveVis:
-            cv2.imwrite(os.path.join(savefolder, name + '_vis.jpg'), deca.visualize(visdict))
+        for k, data in enumerate(data_list):
+            name = data['imagename']
+            opdict = {key: batch_opdict[key][k:k+1] for key in batch_opdict}
+            visdict = {key: batch_visdict[key][k:k+1] for key in batch_visdict}
             if args.render_orig:
-                cv2.imwrite(os.path.join(savefolder, name + '_vis_original_size.jpg'), deca.visualize(orig_visdict))
-        if args.saveImages:
-            for vis_name in ['inputs', 'rendered_images', 'albedo_images', 'shape_images', 'shape_detail_images', 'landmarks2d']:
-                if vis_name not in visdict.keys():
-                    continue
-                image = util.tensor2image(visdict[vis_name][0])
-                cv2.imwrite(os.path.join(savefolder, name, name + '_' + vis_name +'.jpg'), util.tensor2image(visdict[vis_name][0]))
+                orig_visdict = {key: batch_orig_visdict[key][k:k+1] for key in batch_orig_visdict}
+            if args.saveDepth or args.saveKpt or args.saveObj or args.saveMat or args.saveImages:
+                os.makedirs(os.path.join(savefolder, name), exist_ok=True)
+            # -- save results
+            if args.saveDepth:
+                depth_image = deca.render.render_depth(opdict['trans_verts']).repeat(1,3,1,1)
+                visdict['depth_images'] = depth_image
+                cv2.imwrite(os.path.join(savefolder, name, name + '_depth.jpg'), util.tensor2image(depth_image[0]))
+            if args.saveKpt:
+                np.savetxt(os.path.join(savefolder, name, name + '_kpt2d.txt'), opdict['landmarks2d'][0].cpu().numpy())
+                np.savetxt(os.path.join(savefolder, name, name + '_kpt3d.txt'), opdict['landmarks3d'][0].cpu().numpy())
+            if args.saveObj:
+                deca.save_obj(os.path.join(savefolder, name, name + '.obj'), opdict)
+            if args.saveMat:
+                opdict = util.dict_tensor2npy(opdict)
+                savemat(os.path.join(savefolder, name, name + '.mat'), opdict)
+            if args.saveVis:
+                cv2.imwrite(os.path.join(savefolder, name + '_vis.jpg'), deca.visualize(visdict))
                 if args.render_orig:
-                    image = util.tensor2image(orig_visdict[vis_name][0])
-                    cv2.imwrite(os.path.join(savefolder, name, 'orig_' + name + '_' + vis_name +'.jpg'), util.tensor2image(orig_visdict[vis_name][0]))
+                    cv2.imwrite(os.path.join(savefolder, name + '_vis_original_size.jpg'), deca.visualize(orig_visdict))
+            if args.saveImages:
+                for vis_name in ['inputs', 'rendered_images', 'albedo_images', 'shape_images', 'shape_detail_images', 'landmarks2d']:
+                    if vis_name not in visdict.keys():
+                        continue
+                    image = util.tensor2image(visdict[vis_name][0])
+                    cv2.imwrite(os.path.join(savefolder, name, name + '_' + vis_name +'.jpg'), util.tensor2image(visdict[vis_name][0]))
+                    if args.render_orig:
+                        image = util.tensor2image(orig_visdict[vis_name][0])
+                        cv2.imwrite(os.path.join(savefolder, name, 'orig_' + name + '_' + vis_name +'.jpg'), util.tensor2image(orig_visdict[vis_name][0]))
     print(f'-- please check the results in {savefolder}')
         
 if __name__ == '__main__':
@@ -108,12 +117,20 @@ if __name__ == '__main__':
     parser.add_argument('--sample_step', default=10, type=int,
                         help='sample images from video data for every step' )
     parser.add_argument('--detector', default='fan', type=str,
-                        help='detector for cropping face, check decalib/detectors.py for details' )
+                        help='detector for cropping face: fan, sfd, blazeface, mtcnn, haar, opencv_dnn, check decalib/datasets/detectors.py for details' )
+    parser.add_argument('--detect_batch_size', default=8, type=int,
+                        help='number of images or video frames the face detector runs on at once' )
+    parser.add_argument('--multi_face', default=False, type=lambda x: x.lower() in ['true', '1'],
+                        help='reconstruct every detected face of an image, results are named imagename_face{k}' )
+    parser.add_argument('--detection_cache', default='', type=str,
+                        help='sqlite file caching detected boxes by image content, prewarm with python -m decalib.datasets.detection_cache' )
     # rendering option
     parser.add_argument('--rasterizer_type', default='standard', type=str,
                         help='rasterizer type: pytorch3d or standard' )
     parser.add_argument('--render_orig', default=True, type=lambda x: x.lower() in ['true', '1'],
                         help='whether to render results in original image size, currently only works when rasterizer_type=standard')
+    parser.add_argument('--max_orig_size', default=0, type=int,
+                        help='downscale the original image to this longer side before render_orig, 0 to keep full resolution' )
     # save
     parser.add_argument('--useTex', default=False, type=lambda x: x.lower() in ['true', '1'],
                         help='whether to use FLAME texture model to generate uv texture map, \
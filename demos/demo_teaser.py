@@ -40,15 +40,19 @@ def main(args):
     expdata = datasets.TestData(args.exp_path, iscrop=args.iscrop, face_detector=args.detector)
     # DECA
     deca_cfg.rasterizer_type = args.rasterizer_type
+    deca_cfg.model.tex_cache_size = args.tex_cache_size
     deca = DECA(config=deca_cfg, device=device)
 
     visdict_list_list = []
     for i in range(len(testdata)):
-        name = testdata[i]['imagename']
-        images = testdata[i]['image'].to(device)[None,...]
+        data = testdata[i]
+        name = data['imagename']
+        images = testdata.crop(data, device)
         with torch.no_grad():
             codedict = deca.encode(images)
             opdict, visdict = deca.decode(codedict) #tensor
+        # identity-dependent products are computed once, each view/expression below is a lightweight decode
+        session = deca.animation_session(codedict, opdict)
         ### show shape with different views and expressions
         visdict_list = []
         max_yaw = 30
@@ -63,7 +67,7 @@ def main(args):
             codedict['pose'][:,:3] = global_pose
             codedict['cam'][:,:] = 0.
             codedict['cam'][:,0] = 8
-            _, visdict_view = deca.decode(codedict)   
+            _, visdict_view = session.decode(codedict)   
             visdict = {x:visdict[x] for x in ['inputs', 'shape_detail_images']}         
             visdict['pose'] = visdict_view['shape_detail_images']
             visdict_list.append(visdict)
@@ -79,18 +83,18 @@ def main(args):
             euler_pose[:,2] = 0#(torch.rand((self.batch_size))*60 - 30)*(2./euler_pose[:,1].abs())
             jaw_pose = batch_euler2axis(deg2rad(euler_pose[:,:3].cuda())) 
             codedict['pose'][:,3:] = jaw_pose
-            _, visdict_view = deca.decode(codedict)     
+            _, visdict_view = session.decode(codedict)     
             visdict_list[i]['exp'] = visdict_view['shape_detail_images']
             count = i
 
         for (i,k) in enumerate(range(len(expdata))): #jaw angle from -50 to 50        
             # expression: jaw pose
-            exp_images = expdata[i]['image'].to(device)[None,...]
+            exp_images = expdata.crop(expdata[i], device)
             exp_codedict = deca.encode(exp_images)
             # transfer exp code
             codedict['pose'][:,3:] = exp_codedict['pose'][:,3:]
             codedict['exp'] = exp_codedict['exp']
-            _, exp_visdict = deca.decode(codedict)
+            _, exp_visdict = session.decode(codedict)
             visdict_list[i+count]['exp'] = exp_visdict['shape_detail_images']
 
         visdict_list_list.append(visdict_list)
@@ -106,6 +110,7 @@ def main(args):
         grid_image_all = rescale(grid_image_all, 0.6, multichannel=True) # resize for showing in github
         writer.append_data(grid_image_all[:,:,[2,1,0]])
 
+    print(f'-- albedo cache: {deca.tex_cache_info()}')
     print(f'-- please check the teaser figure in {savefolder}')
 
         
@@ -123,6 +128,8 @@ if __name__ == '__main__':
     # rendering option
     parser.add_argument('--rasterizer_type', default='standard', type=str,
                         help='rasterizer type: pytorch3d or standard' )
+    parser.add_argument('--tex_cache_size', default=16, type=int,
+                        help='number of decoded albedo maps to cache, the same identity is decoded for every pose/expression' )
     # process test images
     parser.add_argument('--iscrop', default=True, type=lambda x: x.lower() in ['true', '1'],
                         help='whether to crop input image, set false only when the test image are well cropped' )
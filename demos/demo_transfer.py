@@ -38,12 +38,14 @@ def main(args):
     # run DECA
     deca_cfg.model.use_tex = args.useTex
     deca_cfg.rasterizer_type = args.rasterizer_type
+    deca_cfg.model.tex_cache_size = args.tex_cache_size
     deca = DECA(config = deca_cfg, device=device)
     # identity reference
     i = 0
-    name = testdata[i]['imagename']
+    data = testdata[i]
+    name = data['imagename']
     savepath = '{}/{}.jpg'.format(savefolder, name)
-    images = testdata[i]['image'].to(device)[None,...]
+    images = testdata.crop(data, device)
     with torch.no_grad():
         id_codedict = deca.encode(images)
     id_opdict, id_visdict = deca.decode(id_codedict)
@@ -51,17 +53,18 @@ def main(args):
 
     # -- expression transfer
     # exp code from image
-    exp_images = expdata[i]['image'].to(device)[None,...]
+    exp_images = expdata.crop(expdata[i], device)
     with torch.no_grad():
         exp_codedict = deca.encode(exp_images)
     # transfer exp code
     id_codedict['pose'][:,3:] = exp_codedict['pose'][:,3:]
     id_codedict['exp'] = exp_codedict['exp']
-    transfer_opdict, transfer_visdict = deca.decode(id_codedict)
+    # reuse albedo, detail code and extracted texture of the identity
+    session = deca.animation_session(id_codedict, id_opdict)
+    transfer_opdict, transfer_visdict = session.decode(id_codedict)
     id_visdict['transferred_shape'] = transfer_visdict['shape_detail_images']
     cv2.imwrite(os.path.join(savefolder, name + '_animation.jpg'), deca.visualize(id_visdict))
 
-    transfer_opdict['uv_texture_gt'] = id_opdict['uv_texture_gt']
     if args.saveDepth or args.saveKpt or args.saveObj or args.saveMat or args.saveImages:
         os.makedirs(os.path.join(savefolder, name, 'reconstruction'), exist_ok=True)
         os.makedirs(os.path.join(savefolder, name, 'animation'), exist_ok=True)
@@ -107,6 +110,8 @@ if __name__ == '__main__':
     # rendering option
     parser.add_argument('--rasterizer_type', default='standard', type=str,
                         help='rasterizer type: pytorch3d or standard' )
+    parser.add_argument('--tex_cache_size', default=16, type=int,
+                        help='number of decoded albedo maps to cache, the same identity is decoded for every pose/expression' )
     # process test images
     parser.add_argument('--iscrop', default=True, type=lambda x: x.lower() in ['true', '1'],
                         help='whether to crop input image, set false only when the test image are well cropped' )
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at deca@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+
+
+''' NoW validation of a DECA model
+writes the neutral meshes and the 7 landmarks of the NoW validation images, and the scan-to-mesh errors when the
+scans are in the NoW folder
+'''
+import os, sys
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from decalib.deca import DECA
+from decalib.utils.config import cfg as deca_cfg
+from decalib.utils.now_eval import NoWEvaluator
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DECA: NoW validation')
+    parser.add_argument('--now_dir', type=str, default=None, help='NoW dataset folder, default: the paths in datasets/now.py')
+    parser.add_argument('-s', '--savefolder', default='TestSamples/now_validation', type=str,
+                        help='path to the output directory, where meshes, landmarks and errors.txt are stored')
+    parser.add_argument('--device', default='cuda', type=str,
+                        help='set device, cpu for using cpu' )
+    parser.add_argument('--processes', default=8, type=int, help='processes writing the meshes and computing the errors')
+    parser.add_argument('--mesh_format', default='ply', type=str, help='ply (binary) or obj')
+    args = parser.parse_args()
+
+    deca = DECA(config = deca_cfg, device=args.device)
+    deca.eval()
+    evaluator = NoWEvaluator(deca, device=args.device, folder=args.now_dir, processes=args.processes, mesh_format=args.mesh_format)
+    metrics = evaluator.run(args.savefolder)
+    for k, v in metrics.items():
+        print(f'{k}: {v:.4f}')
+    print(f'-- please check the results in {args.savefolder}')
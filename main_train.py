@@ -6,20 +6,40 @@ import yaml
 import torch
 import torch.backends.cudnn as cudnn
 import torch
+import torch.distributed as dist
 import shutil
 from copy import deepcopy
+from datetime import timedelta
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '.')))
-np.random.seed(0)
+
+def setup_distributed():
+    ''' torchrun sets WORLD_SIZE/RANK/LOCAL_RANK, one process per gpu with nccl, or per cpu process with gloo
+    return: device, rank
+    '''
+    if int(os.environ.get('WORLD_SIZE', 1)) == 1:
+        return 'cuda:0', 0
+    local_rank = int(os.environ['LOCAL_RANK'])
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        backend = 'nccl'; device = f'cuda:{local_rank}'
+    else:
+        backend = 'gloo'; device = 'cpu'
+    # other ranks wait in the next all-reduce while rank 0 runs validation/evaluation
+    dist.init_process_group(backend=backend, timeout=timedelta(hours=2))
+    return device, dist.get_rank()
 
 def main(cfg):
+    device, rank = setup_distributed()
+    np.random.seed(rank)
     # creat folders 
     os.makedirs(os.path.join(cfg.output_dir, cfg.train.log_dir), exist_ok=True)
     os.makedirs(os.path.join(cfg.output_dir, cfg.train.vis_dir), exist_ok=True)
     os.makedirs(os.path.join(cfg.output_dir, cfg.train.val_vis_dir), exist_ok=True)
-    with open(os.path.join(cfg.output_dir, cfg.train.log_dir, 'full_config.yaml'), 'w') as f:
-        yaml.dump(cfg, f, default_flow_style=False)                                              # 将python字典写入yaml文件
-    shutil.copy(cfg.cfg_file, os.path.join(cfg.output_dir, 'config.yaml'))
+    if rank == 0:
+        with open(os.path.join(cfg.output_dir, cfg.train.log_dir, 'full_config.yaml'), 'w') as f:
+            yaml.dump(cfg, f, default_flow_style=False)                                              # 将python字典写入yaml文件
+        shutil.copy(cfg.cfg_file, os.path.join(cfg.output_dir, 'config.yaml'))
     
     # cudnn related setting
     cudnn.benchmark = True
@@ -30,12 +50,14 @@ def main(cfg):
     # deca model
     from decalib.deca import DECA
     from decalib.trainer import Trainer
-    cfg.rasterizer_type = 'standard'               # 改为标准渲染
-    deca = DECA(cfg)
-    trainer = Trainer(model=deca, config=cfg)
+    cfg.rasterizer_type = 'standard' if 'cuda' in device else 'pytorch3d'              # 改为标准渲染, the standard rasterizer is cuda only
+    deca = DECA(cfg, device=device)
+    trainer = Trainer(model=deca, config=cfg, device=device)
 
     ## start train
     trainer.fit()
+    if dist.is_initialized():
+        dist.destroy_process_group()
 
 if __name__ == '__main__':
     from decalib.utils.config import parse_args
@@ -46,4 +68,6 @@ if __name__ == '__main__':
     main(cfg)
 
 # run:
-# python main_train.py --cfg configs/release_version/deca_pretrain.yml 
\ No newline at end of file
+# python main_train.py --cfg configs/release_version/deca_pretrain.yml
+# multi gpu (or multi process on cpu with gloo):
+# torchrun --nproc_per_node=4 main_train.py --cfg configs/release_version/deca_coarse.yml 
\ No newline at end of file
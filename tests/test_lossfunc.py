@@ -0,0 +1,39 @@
+''' batched mrf patch matching against the per-sample conv2d loop it replaced
+'''
+import os, sys
+from types import SimpleNamespace
+import pytest
+torch = pytest.importorskip('torch')
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from decalib.utils import lossfunc
+
+def reference_mrf_loss(gen, tar, bias=1.0, nn_stretch_sigma=0.5):
+    meanT = torch.mean(tar, 1, keepdim=True)
+    gen_feats, tar_feats = gen - meanT, tar - meanT
+    gen_normalized = gen_feats / torch.norm(gen_feats, p=2, dim=1, keepdim=True)
+    tar_normalized = tar_feats / torch.norm(tar_feats, p=2, dim=1, keepdim=True)
+    cosine_dist_l = []
+    for i in range(tar.size(0)):
+        patches = tar_normalized[i:i+1].unfold(2, 1, 1).unfold(3, 1, 1).permute(0, 2, 3, 1, 4, 5)
+        patches = patches.reshape(-1, patches.shape[3], 1, 1)
+        cosine_dist_l.append(F.conv2d(gen_normalized[i:i+1], patches))
+    cosine_dist = torch.cat(cosine_dist_l, dim=0)
+    cosine_dist_zero_2_one = - (cosine_dist - 1) / 2
+    relative_dist = cosine_dist_zero_2_one / (torch.min(cosine_dist_zero_2_one, dim=1, keepdim=True)[0] + 1e-5)
+    dist_before_norm = torch.exp((bias - relative_dist)/nn_stretch_sigma)
+    rela_dist = dist_before_norm / torch.sum(dist_before_norm, dim=1, keepdim=True)
+    k_max_nc = torch.max(rela_dist.view(rela_dist.shape[0], rela_dist.shape[1], -1), dim=2)[0]
+    return torch.sum(-torch.log(torch.mean(k_max_nc, dim=1)))
+
+@pytest.mark.parametrize('loss_class', [lossfunc.IDMRFLoss, lossfunc.VGGLoss])
+@pytest.mark.parametrize('chunk_size', [0, 1, 2, 3])
+def test_batched_mrf_loss(loss_class, chunk_size):
+    torch.manual_seed(0)
+    gen = torch.rand(5, 16, 7, 6, dtype=torch.float64)
+    tar = torch.rand(5, 16, 7, 6, dtype=torch.float64)
+    # mrf_loss only reads the matching parameters, no vgg weights are needed
+    loss = SimpleNamespace(bias=1.0, nn_stretch_sigma=0.5, chunk_size=chunk_size)
+    out = loss_class.mrf_loss(loss, gen, tar)
+    assert torch.allclose(out, reference_mrf_loss(gen, tar), rtol=1e-10, atol=1e-10)
@@ -0,0 +1,28 @@
+''' dense-grid vertex normals against the generic scatter version
+'''
+import os, sys
+import pytest
+torch = pytest.importorskip('torch')
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from decalib.utils import util
+
+def random_grid(bz, h, w):
+    # a noisy height field, a random point cloud would give degenerate normals
+    y, x = torch.meshgrid(torch.linspace(-1, 1, h), torch.linspace(-1, 1, w), indexing='ij')
+    grid = torch.stack([x, y, torch.zeros_like(x)], 0)[None].repeat(bz, 1, 1, 1)
+    return grid + 0.05*torch.randn(bz, 3, h, w)
+
+# h = 23 rows: tile_rows 5 and 7 leave a shorter last tile, 1 is the smallest tile, 22 leaves a single-row tile
+@pytest.mark.parametrize('tile_rows', [0, 1, 5, 7, 22])
+def test_grid_vertex_normals(tile_rows):
+    torch.manual_seed(0)
+    bz, h, w = 2, 23, 19
+    vertices = random_grid(bz, h, w)
+    normals = util.grid_vertex_normals(vertices, tile_rows=tile_rows)
+
+    faces = torch.from_numpy(util.generate_triangles(h, w)).int()[None].repeat(bz, 1, 1)
+    vertex_list = vertices.permute(0, 2, 3, 1).reshape(bz, -1, 3)
+    expected = util.vertex_normals(vertex_list, faces).reshape(bz, h, w, 3).permute(0, 3, 1, 2)
+    assert normals.shape == expected.shape
+    assert torch.allclose(normals, expected, atol=1e-5)